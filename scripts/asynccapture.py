@@ -0,0 +1,399 @@
+"""
+Asynchronous capture engine for locally rendered xxLINK sites
+
+A single asyncio event loop (in a background thread) keeps a small pool of
+persistent HTTP/1.1 connections to each host (VirtualHost), and pipelines
+requests on them: up to PIPELINE_DEPTH requests are written to a connection
+before the first response has arrived, and responses are read back in
+order. Connections are replaced after REQUESTS_PER_CONNECTION requests (like
+Apache's MaxKeepAliveRequests); requests that are left unanswered when a
+server closes a connection are sent again on a new one.
+
+Requests and response heads are written to the WARC exactly as they went
+over the wire (see sitecapture.RawHeaders), and payload and block digests
+are computed while the body is read, so there is no HTTP library or proxy
+layer in between. Only chunked responses (which don't occur for static
+files) are stored de-chunked, with a Content-Length header instead.
+
+The engine has the same fetch method as the HTTP engine, plus a submit
+method that returns a future, which captureUrls uses to keep many requests
+in flight without a thread for each.
+
+"""
+
+import asyncio
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+from warcio.statusandheaders import StatusAndHeaders
+from sitecapture import Exchange, warcDate, warcDigest, CHUNK_SIZE, SPOOL_SIZE, \
+    MAX_REDIRECTS, TIMEOUT
+from directcapture import requestHeaders
+
+# Persistent connections per host
+CONNECTIONS_PER_HOST = 2
+
+# Maximum number of requests that are sent ahead on one connection
+PIPELINE_DEPTH = 8
+
+# Number of requests after which a connection is replaced
+REQUESTS_PER_CONNECTION = 100
+
+# Number of times a request is sent before giving up
+MAX_ATTEMPTS = 3
+
+# Statuses of redirects that are followed, and of responses without body
+REDIRECT_STATUSES = [301, 302, 303, 307, 308]
+NO_BODY_STATUSES = [204, 304]
+
+# Maximum number of header lines in a response
+MAX_HEADERS = 100
+
+CONNECT_TIMEOUT, READ_TIMEOUT = TIMEOUT
+
+
+class ConnectionClosed(ConnectionError):
+    """Connection was closed before the response to a request was read"""
+
+
+def headerValue(headers, name):
+    """Return value of header name (case-insensitive) in list of headers, or
+    None"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def requestBytes(url):
+    """Return request line, headers and raw bytes of GET request for url"""
+    parts = urlsplit(url)
+    target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    requestLine = "GET " + target + " HTTP/1.1"
+    headers = requestHeaders(parts.netloc)
+    raw = "".join([requestLine + "\r\n"] + [name + ": " + value + "\r\n"
+                                           for name, value in headers] + ["\r\n"])
+    return requestLine, headers, raw.encode("latin-1")
+
+
+class Connection:
+    """Persistent connection to one host, with pipelined requests"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.reader = None
+        self.writer = None
+        # Requests sent (or waiting to be sent) that have no response yet
+        self.pending = deque()
+        self.sent = 0
+        self.closed = False
+        self.wake = asyncio.Event()
+        self.remoteIP = None
+
+    def available(self):
+        """Return True if another request can be sent on this connection"""
+        return (not self.closed and len(self.pending) < self.pool.fetcher.pipelineDepth and
+                self.sent < self.pool.fetcher.requestsPerConnection)
+
+    def send(self, url, future):
+        """Queue GET request for url; future is resolved with its Exchange"""
+        requestLine, headers, raw = requestBytes(url)
+        self.pending.append((url, requestLine, headers, raw, future))
+        self.sent += 1
+        if self.writer is not None:
+            self.writer.write(raw)
+        self.wake.set()
+
+    async def open(self, address):
+        """Connect to address (host, port), and send queued requests"""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(*address), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.close(e)
+            return
+        peer = self.writer.get_extra_info("peername")
+        self.remoteIP = peer[0] if peer else None
+        for request in self.pending:
+            self.writer.write(request[3])
+        asyncio.ensure_future(self.readLoop())
+
+    async def readLoop(self):
+        """Read responses in order of the requests"""
+        try:
+            while not self.closed:
+                if not self.pending:
+                    if self.sent >= self.pool.fetcher.requestsPerConnection:
+                        break
+                    self.wake.clear()
+                    await self.wake.wait()
+                    continue
+                url, requestLine, headers, raw, future = self.pending[0]
+                exchange, keepAlive = await self.readResponse(url)
+                exchange.requestLine = requestLine
+                exchange.requestHeaders = headers
+                exchange.rawRequest = raw
+                self.pending.popleft()
+                if not future.done():
+                    future.set_result(exchange)
+                self.pool.notify()
+                if not keepAlive:
+                    break
+            self.close(ConnectionClosed("connection closed by server"))
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ValueError) as e:
+            self.close(e)
+
+    async def readLine(self):
+        """Read one line of response head"""
+        line = await asyncio.wait_for(self.reader.readline(), READ_TIMEOUT)
+        if not line:
+            raise ConnectionClosed("connection closed by server")
+        return line
+
+    async def readResponse(self, url):
+        """Read response to request for url, and return Exchange and whether
+        the connection can be reused"""
+        lines = [await self.readLine()]
+        while lines[-1] not in [b"\r\n", b"\n"]:
+            if len(lines) > MAX_HEADERS:
+                raise ValueError("too many headers in response to " + url)
+            lines.append(await self.readLine())
+
+        exchange = Exchange(url)
+        exchange.date = warcDate()
+        exchange.remoteIP = self.remoteIP
+        statusLine = lines[0].decode("latin-1").rstrip("\r\n")
+        protocol, _, exchange.statusLine = statusLine.partition(" ")
+        exchange.protocol = protocol
+        headers = []
+        for line in lines[1:-1]:
+            name, _, value = line.decode("latin-1").rstrip("\r\n").partition(":")
+            headers.append((name, value.strip()))
+        exchange.headers = headers
+        rawHead = b"".join(lines)
+
+        status = int(exchange.statusLine.split()[0])
+        connection = (headerValue(headers, "Connection") or "").lower()
+        if protocol == "HTTP/1.0":
+            keepAlive = connection == "keep-alive"
+        else:
+            keepAlive = connection != "close"
+
+        payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        payloadSha1 = hashlib.sha1()
+        blockSha1 = hashlib.sha1(rawHead)
+        length = 0
+        contentLength = headerValue(headers, "Content-Length")
+        chunked = "chunked" in (headerValue(headers, "Transfer-Encoding") or "").lower()
+
+        if status in NO_BODY_STATUSES or status < 200:
+            chunks = self.readExactly(0)
+        elif chunked:
+            chunks = self.readChunked()
+        elif contentLength is not None:
+            chunks = self.readExactly(int(contentLength))
+        else:
+            # Body ends when server closes connection
+            chunks = self.readToEnd()
+            keepAlive = False
+
+        async for chunk in chunks:
+            payload.write(chunk)
+            payloadSha1.update(chunk)
+            blockSha1.update(chunk)
+            length += len(chunk)
+        payload.seek(0)
+
+        if chunked:
+            # Stored de-chunked, so head is serialized again with the actual
+            # length
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ["transfer-encoding", "content-length"]]
+            headers.append(("Content-Length", str(length)))
+            exchange.headers = headers
+            blockSha1 = hashlib.sha1(StatusAndHeaders(exchange.statusLine, headers,
+                                                      protocol=protocol).to_bytes())
+            for chunk in iter(lambda: payload.read(CHUNK_SIZE), b""):
+                blockSha1.update(chunk)
+            payload.seek(0)
+        else:
+            exchange.rawHead = rawHead
+
+        exchange.payload = payload
+        exchange.length = length
+        exchange.digest = warcDigest(payloadSha1)
+        exchange.blockDigest = warcDigest(blockSha1)
+        return exchange, keepAlive
+
+    async def readExactly(self, size):
+        """Yield chunks of body of size bytes"""
+        while size > 0:
+            chunk = await asyncio.wait_for(self.reader.readexactly(min(size, CHUNK_SIZE)),
+                                           READ_TIMEOUT)
+            size -= len(chunk)
+            yield chunk
+
+    async def readToEnd(self):
+        """Yield chunks of body until connection is closed"""
+        while True:
+            chunk = await asyncio.wait_for(self.reader.read(CHUNK_SIZE), READ_TIMEOUT)
+            if not chunk:
+                return
+            yield chunk
+
+    async def readChunked(self):
+        """Yield chunks of chunked body"""
+        while True:
+            sizeLine = await self.readLine()
+            size = int(sizeLine.split(b";")[0].strip(), 16)
+            if size == 0:
+                # Skip trailers
+                while (await self.readLine()) not in [b"\r\n", b"\n"]:
+                    pass
+                return
+            async for chunk in self.readExactly(size):
+                yield chunk
+            await self.readLine()
+
+    def close(self, error):
+        """Close connection, and fail all requests without response with
+        error (they are then retried by the pool)"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        while self.pending:
+            future = self.pending.popleft()[4]
+            if not future.done():
+                future.set_exception(error)
+        self.wake.set()
+        self.pool.remove(self)
+
+
+class HostPool:
+    """Persistent connections to one host"""
+
+    def __init__(self, fetcher, address):
+        self.fetcher = fetcher
+        self.address = address
+        self.connections = []
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        """Wake up requests that wait for a free connection"""
+        self.changed.set()
+
+    def remove(self, connection):
+        """Remove closed connection from pool"""
+        if connection in self.connections:
+            self.connections.remove(connection)
+        self.notify()
+
+    async def connection(self):
+        """Return connection that can take another request, opening a new one
+        if all are busy and the pool is not full"""
+        while True:
+            available = [c for c in self.connections if c.available()]
+            if available:
+                return min(available, key=lambda c: len(c.pending))
+            if len(self.connections) < self.fetcher.connectionsPerHost:
+                connection = Connection(self)
+                self.connections.append(connection)
+                asyncio.ensure_future(connection.open(self.address))
+                return connection
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def get(self, url):
+        """Fetch url, retrying on a new connection if the connection is
+        closed before the response arrives; returns Exchange"""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            future = asyncio.get_running_loop().create_future()
+            (await self.connection()).send(url, future)
+            try:
+                return await future
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                self.fetcher.retries += 1
+
+
+class AsyncFetcher:
+    """Fetches URLs over pipelined persistent connections. If address
+    (host, port) is given, all connections go there (e.g. the stand-in
+    server), and host names are only used in the Host header"""
+
+    def __init__(self, connectionsPerHost=CONNECTIONS_PER_HOST, pipelineDepth=PIPELINE_DEPTH,
+                 requestsPerConnection=REQUESTS_PER_CONNECTION, address=None):
+        self.connectionsPerHost = max(1, connectionsPerHost)
+        self.pipelineDepth = max(1, pipelineDepth)
+        self.requestsPerConnection = max(1, requestsPerConnection)
+        self.address = address
+        self.pools = {}
+        # Number of requests that were sent again on a new connection
+        self.retries = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def pool(self, url):
+        """Return connection pool for host of url"""
+        parts = urlsplit(url)
+        host = parts.netloc.lower()
+        if host not in self.pools:
+            address = self.address or (parts.hostname, parts.port or 80)
+            self.pools[host] = HostPool(self, address)
+        return self.pools[host]
+
+    async def fetchChain(self, url):
+        """Fetch url and any redirects that follow from it; return list of
+        Exchange objects"""
+        exchanges = []
+        chain = set()
+        while True:
+            chain.add(url)
+            exchange = await self.pool(url).get(url)
+            exchanges.append(exchange)
+
+            # Follow redirects (Apache's RedirectMatch, directory slashes)
+            status = int(exchange.statusLine.split()[0])
+            location = headerValue(exchange.headers, "Location")
+            if status not in REDIRECT_STATUSES or location is None or \
+                    len(exchanges) > MAX_REDIRECTS:
+                break
+            url = urljoin(url, location)
+            if url in chain:
+                break
+        return exchanges
+
+    def submit(self, url):
+        """Start fetching url, and return future with list of Exchange
+        objects"""
+        return asyncio.run_coroutine_threadsafe(self.fetchChain(url), self.loop)
+
+    def fetch(self, url):
+        """Fetch url (and its redirects), and return list of Exchange objects"""
+        return self.submit(url).result()
+
+    def close(self):
+        """Close all connections, and stop event loop"""
+        def closeAll():
+            for pool in list(self.pools.values()):
+                for connection in list(pool.connections):
+                    connection.close(ConnectionClosed("fetcher closed"))
+            self.loop.stop()
+
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(closeAll)
+            self.thread.join()
+        # Finish read loops of closed connections
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
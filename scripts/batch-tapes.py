@@ -0,0 +1,406 @@
+#! /usr/bin/env python3
+
+"""
+Restore and capture a batch of xxLINK tapes in one pipelined run
+
+For each tape in the tape list (a CSV file with columns tape, input, format
+and, optionally, output), the sites are restored with restore-sites.py or
+restore-sites-DLT.py (which also write the tape's sites.conf and hosts
+entries), the tape's configuration is activated on the web server, and the
+sites are captured to WARC with scrape-local.py. Tapes are processed as a
+pipeline on a shared pool: restores run in parallel (--restore-jobs), while
+captures take turns on the web server (--capture-jobs, default 1, because
+each capture needs its own tape's configuration to be active). So the
+restore of the next tapes overlaps the capture of the current one. With
+--serve, each capture uses scrape-local.py's built-in stand-in server
+instead of Apache, so captures of several tapes can run at the same time.
+
+Formats: dds (extracted DDS tape directory), dlt (extracted DLT tape
+directory), tar and dump (tape images; see restore-sites.py). If format is
+empty, it is taken from the tape catalog (--catalog).
+
+The --activate command is run (by the shell) before each capture, with
+{tape}, {conf}, {hosts} and {dir} replaced by tape name, the tape's
+sites.conf and hosts files and its output directory, e.g.:
+
+sudo cp {conf} /etc/apache2/sites-available/xxLINK-{tape}.conf && sudo a2dissite '*' && sudo a2ensite xxLINK-{tape} && sudo systemctl reload apache2
+
+Output of each stage goes to a log file (logs/TAPE-STAGE.log in the WARC
+root directory). When all tapes are done, a combined report (one line per
+tape) is written to batch-report.csv, and the capture statistics of all
+sites to batch-sites.csv. Captures run with --resume, and restores only
+copy what changed, so an interrupted batch can simply be started again.
+
+Example command line:
+
+sudo python3 ~/kb/xxLINK-resources/scripts/batch-tapes.py tapes.csv /var/www /home/johan/kb/xxLINK/warc --activate "$(cat activate.sh)"
+
+"""
+
+import os
+import sys
+import csv
+import time
+import shlex
+import threading
+import argparse
+import subprocess as sub
+from concurrent.futures import ThreadPoolExecutor
+from siteinventory import formatDuration
+from metrics import Metrics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Restore command for each tape format
+RESTORE_COMMANDS = {"dds": ["restore-sites.py"],
+                    "tar": ["restore-sites.py", "--tar"],
+                    "dump": ["restore-sites.py", "--dump"],
+                    "dlt": ["restore-sites-DLT.py"]}
+
+# Capture statistics that are added up for each tape
+CAPTURE_TOTALS = ["urls", "records", "payloadBytes", "warcBytes", "revisits", "savedBytes"]
+
+REPORT_FIELDS = ["tape", "format", "input", "output", "restore", "restoreSeconds",
+                 "capture", "captureSeconds", "sites"] + CAPTURE_TOTALS
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('tapesFile',
+                        action='store',
+                        type=str,
+                        help='CSV file with tape, input, format and (optional) output \
+                        columns')
+    parser.add_argument('wwwRoot',
+                        action='store',
+                        type=str,
+                        help='directory for restored tapes (default output of each tape \
+                        is wwwRoot/xxLINK-TAPE)')
+    parser.add_argument('warcRoot',
+                        action='store',
+                        type=str,
+                        help='directory for captures (one subdirectory for each tape), \
+                        logs and report')
+    parser.add_argument('--restore-jobs',
+                        action='store',
+                        type=int,
+                        default=2,
+                        help='number of tapes that are restored at the same time (default: 2)')
+    parser.add_argument('--capture-jobs',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of tapes that are captured at the same time; only use \
+                        more than 1 with --serve, or if the web server serves all tapes at \
+                        once (default: 1)')
+    parser.add_argument('--site-jobs',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of sites of one tape that are restored or captured in \
+                        parallel (--jobs of the restore and capture scripts; default: 1)')
+    parser.add_argument('--activate',
+                        action='store',
+                        type=str,
+                        help='shell command that activates the configuration of a tape on \
+                        the web server before it is captured')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='capture from the stand-in server of scrape-local.py instead of \
+                        Apache (--activate is not needed)')
+    parser.add_argument('--catalog',
+                        action='store',
+                        type=str,
+                        help='tape catalog (see catalog-tapes.py), for tapes without format')
+    parser.add_argument('--dedup-index',
+                        action='store',
+                        type=str,
+                        help='digest index that is shared by the captures of all tapes \
+                        (see scrape-local.py)')
+    parser.add_argument('--restore-args',
+                        action='store',
+                        type=str,
+                        default='',
+                        help='additional arguments for the restore scripts, e.g. \
+                        "--store /var/www/store"')
+    parser.add_argument('--capture-args',
+                        action='store',
+                        type=str,
+                        default='',
+                        help='additional arguments for scrape-local.py, e.g. "--engine direct"')
+    parser.add_argument('--metrics',
+                        action='store',
+                        type=str,
+                        help='JSON-lines file to which the time of each stage of each tape \
+                        is appended; it is also passed to the restore and capture scripts, \
+                        which add the timings of each site')
+    parser.add_argument('--stages',
+                        action='store',
+                        type=str,
+                        default='restore,capture',
+                        help='comma-separated stages that are run (default: restore,capture)')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only print the commands for each tape')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+class Tape:
+    """Tape in the batch, with status and time of each stage"""
+    __slots__ = ("name", "input", "format", "dirOut", "warcDir", "status", "seconds")
+
+    def __init__(self, name, input, format, dirOut, warcDir):
+        self.name = name
+        self.input = input
+        self.format = format
+        self.dirOut = dirOut
+        self.warcDir = warcDir
+        self.status = {}
+        self.seconds = {}
+
+    def configFile(self):
+        """Return path of the tape's Apache config file"""
+        return os.path.join(self.dirOut, "etc", "sites.conf")
+
+    def hostsFile(self):
+        """Return path of the tape's hosts file"""
+        return os.path.join(self.dirOut, "etc", "hosts")
+
+
+def readTapes(tapesFile, wwwRoot, warcRoot, catalog=None):
+    """Read tape list, and return list of tapes"""
+    tapes = []
+    try:
+        with open(tapesFile, encoding="utf-8", newline="") as fIn:
+            for row in csv.DictReader(fIn):
+                name = row["tape"].strip()
+                tapeFormat = (row.get("format") or "").strip().lower()
+                if tapeFormat == "" and catalog is None:
+                    errorExit("no format for tape " + name + ", and no catalog")
+                if tapeFormat not in RESTORE_COMMANDS and tapeFormat != "":
+                    errorExit("unknown format " + tapeFormat + " for tape " + name)
+                dirOut = (row.get("output") or "").strip() or \
+                    os.path.join(wwwRoot, "xxLINK-" + name)
+                tapes.append(Tape(name, os.path.abspath(row["input"].strip()), tapeFormat,
+                                  os.path.abspath(dirOut),
+                                  os.path.join(os.path.abspath(warcRoot), name)))
+    except (IOError, KeyError) as e:
+        errorExit("cannot read tape list " + tapesFile + ": " + str(e))
+    names = [tape.name for tape in tapes]
+    if len(set(names)) != len(names):
+        errorExit("duplicate tape names in " + tapesFile)
+    return tapes
+
+
+class Batch:
+    """Pipelined restore and capture of all tapes"""
+
+    def __init__(self, args):
+        self.args = args
+        self.stages = args.stages.split(",")
+        self.logDir = os.path.join(os.path.abspath(args.warcRoot), "logs")
+        self.restoreSlots = threading.Semaphore(max(1, args.restore_jobs))
+        self.captureSlots = threading.Semaphore(max(1, args.capture_jobs))
+        self.printLock = threading.Lock()
+        self.timeStart = time.time()
+
+    def log(self, tape, msg):
+        """Print progress line with elapsed time"""
+        with self.printLock:
+            print("[{}] {}: {}".format(formatDuration(time.time() - self.timeStart),
+                                       tape.name, msg), file=sys.stderr)
+
+    def restoreCommand(self, tape):
+        """Return restore command line for tape"""
+        if tape.format == "":
+            command = ["restore-sites.py", "--catalog", os.path.abspath(self.args.catalog)]
+        else:
+            command = list(RESTORE_COMMANDS[tape.format])
+        command[0] = os.path.join(SCRIPT_DIR, command[0])
+        return [sys.executable] + command + [tape.input, tape.dirOut,
+                                             "--jobs", str(self.args.site_jobs)] + \
+            self.metricsArgs() + shlex.split(self.args.restore_args)
+
+    def captureCommand(self, tape):
+        """Return capture command line for tape"""
+        command = [sys.executable, os.path.join(SCRIPT_DIR, "scrape-local.py"),
+                   tape.configFile(), "--resume", "--tape", tape.name,
+                   "--jobs", str(self.args.site_jobs)]
+        if self.args.serve:
+            command.append("--serve")
+        if self.args.dedup_index is not None:
+            command += ["--dedup-index", os.path.abspath(self.args.dedup_index)]
+        return command + self.metricsArgs() + shlex.split(self.args.capture_args)
+
+    def metricsArgs(self):
+        """Return metrics file arguments for the restore and capture scripts"""
+        if self.args.metrics is None:
+            return []
+        return ["--metrics", os.path.abspath(self.args.metrics)]
+
+    def activateCommand(self, tape):
+        """Return activation shell command for tape, or None"""
+        if self.args.activate is None or self.args.serve:
+            return None
+        return self.args.activate.format(tape=tape.name, conf=tape.configFile(),
+                                         hosts=tape.hostsFile(), dir=tape.dirOut)
+
+    def runStage(self, tape, stage, command, cwd=None, shell=False):
+        """Run command of stage for tape, with output to the stage's log file,
+        and record its status and time. Returns True on success"""
+        logFile = os.path.join(self.logDir, tape.name + "-" + stage + ".log")
+        self.log(tape, stage + " started")
+        timeStart = time.time()
+        try:
+            with open(logFile, "w", encoding="utf-8") as fLog:
+                exitStatus = sub.call(command, stdout=fLog, stderr=sub.STDOUT, cwd=cwd,
+                                      shell=shell)
+        except OSError as e:
+            print("ERROR running " + stage + " of tape " + tape.name + ": " + str(e),
+                  file=sys.stderr)
+            exitStatus = -99
+        seconds = time.time() - timeStart
+        tape.seconds[stage] = tape.seconds.get(stage, 0.0) + seconds
+        if self.args.metrics is not None:
+            metrics = Metrics(os.path.abspath(self.args.metrics), tape=tape.name, progress=False)
+            metrics.write(None, stage, {"seconds": seconds, "exitStatus": exitStatus})
+            metrics.close()
+        if exitStatus == 0:
+            tape.status[stage] = "ok"
+            self.log(tape, "{} done in {}".format(stage, formatDuration(seconds)))
+            return True
+        tape.status[stage] = "failed"
+        self.log(tape, "{} FAILED (exit status {}), see {}".format(stage, exitStatus, logFile))
+        return False
+
+    def runTape(self, tape):
+        """Run all stages of tape; a failed stage skips the ones after it"""
+        if "restore" in self.stages:
+            with self.restoreSlots:
+                if not self.runStage(tape, "restore", self.restoreCommand(tape)):
+                    tape.status["capture"] = "skipped"
+                    return
+        if "capture" not in self.stages:
+            return
+        if not os.path.isfile(tape.configFile()):
+            self.log(tape, "no " + tape.configFile() + ", capture skipped")
+            tape.status["capture"] = "skipped"
+            return
+        os.makedirs(tape.warcDir, exist_ok=True)
+        with self.captureSlots:
+            activate = self.activateCommand(tape)
+            if activate is not None and \
+                    not self.runStage(tape, "activate", activate, shell=True):
+                tape.status["capture"] = "skipped"
+                return
+            self.runStage(tape, "capture", self.captureCommand(tape), cwd=tape.warcDir)
+
+    def run(self, tapes):
+        """Run pipeline for all tapes (in tape list order)"""
+        os.makedirs(self.logDir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, len(tapes))) as pool:
+            for future in [pool.submit(self.runTape, tape) for tape in tapes]:
+                future.result()
+
+    def printCommands(self, tapes):
+        """Write commands of all tapes to stdout"""
+        for tape in tapes:
+            print("# " + tape.name)
+            if "restore" in self.stages:
+                print(" ".join(shlex.quote(c) for c in self.restoreCommand(tape)))
+            if "capture" in self.stages:
+                activate = self.activateCommand(tape)
+                if activate is not None:
+                    print(activate)
+                print("cd " + shlex.quote(tape.warcDir) + " && " +
+                      " ".join(shlex.quote(c) for c in self.captureCommand(tape)))
+
+
+def readSiteStats(tape):
+    """Return rows of the tape's sites-summary.csv (empty if there is none)"""
+    try:
+        with open(os.path.join(tape.warcDir, "sites-summary.csv"), encoding="utf-8",
+                  newline="") as fIn:
+            return list(csv.DictReader(fIn))
+    except FileNotFoundError:
+        return []
+
+
+def writeReport(tapes, warcRoot):
+    """Write combined report of all tapes and their sites, and print totals
+    to stderr"""
+    reportOut = os.path.join(warcRoot, "batch-report.csv")
+    sitesOut = os.path.join(warcRoot, "batch-sites.csv")
+    try:
+        with open(reportOut, "w", encoding="utf-8", newline="") as fReport, \
+                open(sitesOut, "w", encoding="utf-8", newline="") as fSites:
+            report = csv.DictWriter(fReport, fieldnames=REPORT_FIELDS)
+            report.writeheader()
+            sitesWriter = None
+            for tape in tapes:
+                siteStats = readSiteStats(tape) if tape.status.get("capture") == "ok" else []
+                row = {"tape": tape.name, "format": tape.format, "input": tape.input,
+                       "output": tape.dirOut,
+                       "restore": tape.status.get("restore", ""),
+                       "restoreSeconds": round(tape.seconds.get("restore", 0.0), 2),
+                       "capture": tape.status.get("capture", ""),
+                       "captureSeconds": round(tape.seconds.get("capture", 0.0), 2),
+                       "sites": len(siteStats)}
+                for field in CAPTURE_TOTALS:
+                    row[field] = sum(int(float(s.get(field) or 0)) for s in siteStats)
+                report.writerow(row)
+                for stats in siteStats:
+                    if sitesWriter is None:
+                        sitesWriter = csv.DictWriter(fSites, fieldnames=["tape"] + list(stats))
+                        sitesWriter.writeheader()
+                    sitesWriter.writerow(dict(stats, tape=tape.name))
+    except IOError:
+        errorExit("could not write file " + reportOut)
+
+    for stage in ["restore", "capture"]:
+        statuses = [tape.status[stage] for tape in tapes if stage in tape.status]
+        print("{}: {} ok, {} failed, {} skipped".format(
+              stage, statuses.count("ok"), statuses.count("failed"),
+              statuses.count("skipped")), file=sys.stderr)
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='Restore and capture batch of xxLINK tapes')
+    args = parseCommandLine(parser)
+
+    for stage in args.stages.split(","):
+        if stage not in ["restore", "capture"]:
+            errorExit("unknown stage " + stage)
+
+    warcRoot = os.path.abspath(args.warcRoot)
+    tapes = readTapes(args.tapesFile, os.path.abspath(args.wwwRoot), warcRoot, args.catalog)
+    batch = Batch(args)
+
+    if args.dry_run:
+        batch.printCommands(tapes)
+        return
+
+    batch.run(tapes)
+    writeReport(tapes, warcRoot)
+    print("Elapsed time: " + formatDuration(time.time() - batch.timeStart), file=sys.stderr)
+
+    if any(status == "failed" for tape in tapes for status in tape.status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
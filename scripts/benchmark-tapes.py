@@ -0,0 +1,408 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark the restore and capture scripts on synthetic xxLINK tapes
+
+Generates a DDS-shaped and a DLT-shaped tape tree (see tapefixtures.py) in
+a work directory (only once for each set of parameters), and then runs each
+benchmark stage:
+
+- parse: parse the CERN httpd.conf and the configdb directory (in-process,
+  without the parse cache)
+- restore: restore-sites.py on the DDS tree (from scratch)
+- restore-update: restore-sites.py again (nothing changed)
+- restore-dlt: restore-sites-DLT.py on the DLT tree
+- capture-ENGINE: scrape-local.py with the built-in stand-in server on the
+  restored DDS sites, for each capture engine (--engines)
+
+Scripts run as separate processes, with their own (empty) parse cache. For
+each stage the run time, throughput (files and bytes per second), peak RSS
+and RSS over time (sampled from /proc on Linux) are appended to a results
+file (JSON lines), together with the timings of the script's own stages
+(see metrics.py). Results are compared with the previous run with the same
+fixture parameters, so regressions show up; with --max-slowdown, the
+script exits with status 1 if any stage got slower than that.
+
+Example command line:
+
+python3 ~/kb/xxLINK-resources/scripts/benchmark-tapes.py ~/bench --sites 50 --files 1000 --label "copy engine"
+
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import resource
+import threading
+import subprocess as sub
+from datetime import datetime, timezone
+from siteconfig import readConfig
+from tapefixtures import generateTape, loadTape, LAYOUTS
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ["parse", "restore", "restore-update", "restore-dlt", "capture"]
+ENGINES = ["http", "direct", "async"]
+
+# Interval between RSS samples (seconds), and maximum number of samples
+# that are stored per stage
+RSS_INTERVAL = 0.1
+MAX_SAMPLES = 100
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('workDir',
+                        action='store',
+                        type=str,
+                        help='work directory for fixtures, restored trees and captures')
+    parser.add_argument('--sites',
+                        action='store',
+                        type=int,
+                        default=20,
+                        help='number of sites per tape (default: 20)')
+    parser.add_argument('--files',
+                        action='store',
+                        type=int,
+                        default=500,
+                        help='number of files per site (default: 500)')
+    parser.add_argument('--seed',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='random seed of the fixtures (default: 1)')
+    parser.add_argument('--stages',
+                        action='store',
+                        type=str,
+                        default=",".join(STAGES),
+                        help='comma-separated stages that are run (default: ' +
+                        ",".join(STAGES) + ')')
+    parser.add_argument('--engines',
+                        action='store',
+                        type=str,
+                        default='http,async',
+                        help='comma-separated capture engines (default: http,async)')
+    parser.add_argument('--repeat',
+                        action='store',
+                        type=int,
+                        default=20,
+                        help='number of times the configs are parsed in the parse stage \
+                        (default: 20)')
+    parser.add_argument('--results',
+                        action='store',
+                        type=str,
+                        help='JSON-lines file the results are appended to (default: \
+                        benchmark-results.jsonl in workDir)')
+    parser.add_argument('--label',
+                        action='store',
+                        type=str,
+                        default='',
+                        help='label that is stored with the results')
+    parser.add_argument('--max-slowdown',
+                        action='store',
+                        type=float,
+                        help='exit with status 1 if a stage is more than this percentage \
+                        slower than in the previous run')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+def gitCommit():
+    """Return short hash of the scripts' git commit, or empty string"""
+    try:
+        return sub.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR,
+                       capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def processRss(pid):
+    """Return resident set size of process pid in bytes (None if unknown)"""
+    try:
+        with open("/proc/{}/status".format(pid), encoding="ascii") as fIn:
+            for line in fIn:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def thinSamples(samples, maxSamples=MAX_SAMPLES):
+    """Return at most maxSamples of samples, keeping the peak"""
+    if len(samples) <= maxSamples:
+        return samples
+    step = len(samples) / maxSamples
+    thinned = [samples[int(i * step)] for i in range(maxSamples)]
+    peak = max(samples, key=lambda sample: sample[1])
+    if peak not in thinned:
+        thinned.append(peak)
+        thinned.sort()
+    return thinned
+
+
+def runMeasured(command, logFile, cwd=None, env=None):
+    """Run command with output to logFile, and return dictionary with its
+    exit status, run time, peak RSS and RSS samples"""
+    samples = []
+    with open(logFile, "w", encoding="utf-8") as fLog:
+        timeStart = time.time()
+        process = sub.Popen(command, stdout=fLog, stderr=sub.STDOUT, cwd=cwd, env=env)
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(RSS_INTERVAL):
+                rss = processRss(process.pid)
+                if rss is not None:
+                    samples.append([round(time.time() - timeStart, 2), rss])
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        # wait4 gives the peak RSS of this process only
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - timeStart
+        done.set()
+        sampler.join()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {"exitStatus": process.returncode, "seconds": seconds,
+            "peakRss": usage.ru_maxrss * 1024, "rss": thinSamples(samples)}
+
+
+def scriptStages(metricsFile):
+    """Return dictionary with total seconds of each stage in script metrics
+    file"""
+    stages = {}
+    try:
+        with open(metricsFile, encoding="utf-8") as fIn:
+            for line in fIn:
+                record = json.loads(line)
+                if record["stage"] != "total":
+                    stages[record["stage"]] = round(stages.get(record["stage"], 0.0) +
+                                                    record["seconds"], 3)
+    except (OSError, ValueError, KeyError):
+        pass
+    return stages
+
+
+def captureTotals(warcDir):
+    """Return (URLs, payload bytes) of all sites in sites-summary.csv"""
+    urls = payloadBytes = 0
+    try:
+        with open(os.path.join(warcDir, "sites-summary.csv"), encoding="utf-8",
+                  newline="") as fIn:
+            for row in csv.DictReader(fIn):
+                urls += int(row["urls"])
+                payloadBytes += int(row["payloadBytes"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return urls, payloadBytes
+
+
+class Benchmark:
+    """Fixtures, stage runs and results of one benchmark run"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workDir = os.path.abspath(args.workDir)
+        self.fixtureDir = os.path.join(self.workDir, "fixtures",
+                                       "{}x{}-{}".format(args.sites, args.files, args.seed))
+        self.outDir = os.path.join(self.workDir, "out")
+        self.logDir = os.path.join(self.workDir, "logs")
+        self.resultsFile = os.path.abspath(args.results or
+                                           os.path.join(self.workDir, "benchmark-results.jsonl"))
+        self.previous = self.loadPrevious()
+        self.commit = gitCommit()
+        self.tapes = {}
+        self.slower = []
+
+    def loadPrevious(self):
+        """Return latest earlier result of each stage with the same fixture
+        parameters"""
+        previous = {}
+        try:
+            with open(self.resultsFile, encoding="utf-8") as fIn:
+                for line in fIn:
+                    record = json.loads(line)
+                    if (record.get("sites"), record.get("filesPerSite"), record.get("seed")) == \
+                            (self.args.sites, self.args.files, self.args.seed):
+                        previous[record["stage"]] = record
+        except (OSError, ValueError):
+            pass
+        return previous
+
+    def fixtures(self):
+        """Generate fixture trees that don't exist yet"""
+        for layout in LAYOUTS:
+            treeDir = os.path.join(self.fixtureDir, layout)
+            totals = loadTape(treeDir)
+            if totals is None:
+                shutil.rmtree(treeDir, ignore_errors=True)
+                print("Generating {} tape with {} sites of {} files".format(
+                      layout, self.args.sites, self.args.files), file=sys.stderr)
+                timeStart = time.time()
+                totals = generateTape(treeDir, layout, self.args.sites, self.args.files,
+                                      self.args.seed)
+                print("Generated {files} files ({bytes} bytes), {links} links "
+                      "({brokenLinks} broken) in {seconds} s".format(
+                      seconds=round(time.time() - timeStart, 2), **totals), file=sys.stderr)
+            self.tapes[layout] = totals
+
+    def record(self, stage, result, files, bytesDone):
+        """Add throughput to result of stage, compare it with the previous
+        run, and append it to the results file"""
+        seconds = result["seconds"]
+        record = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                  "commit": self.commit, "label": self.args.label, "stage": stage,
+                  "sites": self.args.sites, "filesPerSite": self.args.files,
+                  "seed": self.args.seed, "files": files, "bytes": bytesDone}
+        record.update(result)
+        record["seconds"] = round(seconds, 3)
+        record["filesPerSecond"] = round(files / seconds, 1) if seconds > 0 else 0
+        record["bytesPerSecond"] = round(bytesDone / seconds, 1) if seconds > 0 else 0
+
+        line = "{:16} {:8.2f} s {:10.1f} files/s {:8.2f} MB/s  peak RSS {:7.1f} MB".format(
+            stage, seconds, record["filesPerSecond"], record["bytesPerSecond"] / 1e6,
+            record["peakRss"] / 1e6)
+        previous = self.previous.get(stage)
+        if previous is not None and previous["seconds"] > 0:
+            change = 100 * (seconds - previous["seconds"]) / previous["seconds"]
+            line += "  ({:+.1f}% time, {:+.1f} MB RSS vs {})".format(
+                change, (record["peakRss"] - previous["peakRss"]) / 1e6,
+                previous.get("commit") or previous["time"])
+            if self.args.max_slowdown is not None and change > self.args.max_slowdown:
+                self.slower.append(stage)
+        if record.get("exitStatus"):
+            line += "  FAILED (exit status {})".format(record["exitStatus"])
+        print(line, file=sys.stderr)
+
+        try:
+            with open(self.resultsFile, "a", encoding="utf-8") as fOut:
+                fOut.write(json.dumps(record) + "\n")
+        except IOError:
+            errorExit("could not write file " + self.resultsFile)
+
+    def runScript(self, stage, command, cwd=None):
+        """Run script for stage with its own parse cache and metrics file, and
+        return its measured result"""
+        homeDir = os.path.join(self.workDir, "home")
+        shutil.rmtree(homeDir, ignore_errors=True)
+        os.makedirs(homeDir)
+        metricsFile = os.path.join(self.logDir, stage + "-metrics.jsonl")
+        if os.path.exists(metricsFile):
+            os.remove(metricsFile)
+        env = dict(os.environ, HOME=homeDir)
+        command = [sys.executable, os.path.join(SCRIPT_DIR, command[0])] + command[1:] + \
+            ["--metrics", metricsFile]
+        result = runMeasured(command, os.path.join(self.logDir, stage + ".log"), cwd, env)
+        result["stages"] = scriptStages(metricsFile)
+        return result
+
+    def parse(self):
+        """Parse configs of both tapes repeatedly, without cache"""
+        configs = [(os.path.join(self.fixtureDir, layout, LAYOUTS[layout][0]), configFormat,
+                    os.path.join(self.fixtureDir, layout))
+                   for layout, configFormat in [("dds", "cern"), ("dlt", "apache")]]
+        configBytes = 0
+        for configPath, _, _ in configs:
+            if os.path.isdir(configPath):
+                configBytes += sum(os.path.getsize(os.path.join(configPath, name))
+                                   for name in os.listdir(configPath))
+            else:
+                configBytes += os.path.getsize(configPath)
+        sites = 0
+        timeStart = time.time()
+        for _ in range(self.args.repeat):
+            for configPath, configFormat, root in configs:
+                sites += len(readConfig(configPath, configFormat, root=root, cacheDir=None))
+        result = {"exitStatus": 0, "seconds": time.time() - timeStart,
+                  "peakRss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  "rss": []}
+        self.record("parse", result, sites, configBytes * self.args.repeat)
+
+    def restore(self, stage, layout, fresh=True):
+        """Restore tape of layout to the output directory"""
+        script = "restore-sites.py" if layout == "dds" else "restore-sites-DLT.py"
+        dirOut = os.path.join(self.outDir, layout)
+        if fresh:
+            shutil.rmtree(dirOut, ignore_errors=True)
+        tape = self.tapes[layout]
+        result = self.runScript(stage, [script, os.path.join(self.fixtureDir, layout), dirOut])
+        self.record(stage, result, tape["files"], tape["bytes"])
+
+    def capture(self, engine):
+        """Capture restored DDS sites with engine, using the stand-in server"""
+        stage = "capture-" + engine
+        configFile = os.path.join(self.outDir, "dds", "etc", "sites.conf")
+        if not os.path.isfile(configFile):
+            print("WARNING: no restored sites for " + stage + " (run restore stage first)",
+                  file=sys.stderr)
+            return
+        warcDir = os.path.join(self.outDir, "warc-" + engine)
+        shutil.rmtree(warcDir, ignore_errors=True)
+        os.makedirs(warcDir)
+        result = self.runScript(stage, ["scrape-local.py", configFile, "--serve",
+                                        "--engine", engine], cwd=warcDir)
+        urls, payloadBytes = captureTotals(warcDir)
+        self.record(stage, result, urls, payloadBytes)
+
+    def run(self, stages, engines):
+        """Run all stages"""
+        os.makedirs(self.logDir, exist_ok=True)
+        self.fixtures()
+        if "parse" in stages:
+            self.parse()
+        if "restore" in stages:
+            self.restore("restore", "dds")
+        if "restore-update" in stages:
+            self.restore("restore-update", "dds", fresh=False)
+        if "restore-dlt" in stages:
+            self.restore("restore-dlt", "dlt")
+        if "capture" in stages:
+            for engine in engines:
+                self.capture(engine)
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='Benchmark restore and capture scripts \
+                                     on synthetic xxLINK tapes')
+    args = parseCommandLine(parser)
+
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            errorExit("unknown stage " + stage)
+    engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in ENGINES:
+            errorExit("unknown engine " + engine)
+
+    benchmark = Benchmark(args)
+    benchmark.run(stages, engines)
+    print("Results written to " + benchmark.resultsFile, file=sys.stderr)
+
+    if benchmark.slower:
+        print("SLOWER by more than {}%: {}".format(args.max_slowdown,
+                                                    ", ".join(benchmark.slower)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+"""
+Build and query the catalog of xxLINK tape images
+
+The scan command identifies all .dd images below the given directories (in
+parallel, from their first header block only), and stores format, byte
+order, dump dates, file system, device and host of each image in an SQLite
+catalog. This replaces the hand-made xxlink-id.csv (file(1) output). The
+query command writes the paths (or selected columns, as CSV) of matching
+images to stdout, so other scripts can pick their inputs from the catalog.
+
+Example command lines:
+
+python3 ~/kb/xxLINK-resources/scripts/catalog-tapes.py scan xxlink-tapes.db /media/bcadmin/Elements/xxLINK/tapes-DDS /media/bcadmin/Elements/xxLINK/tapes-DLT
+
+python3 ~/kb/xxLINK-resources/scripts/catalog-tapes.py query xxlink-tapes.db --format dump --filesys /home
+
+"""
+
+import sys
+import csv
+import argparse
+from tapecatalog import TapeCatalog, COLUMNS, SCAN_WORKERS
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('command',
+                        action='store',
+                        choices=['scan', 'query'],
+                        help='scan tape images into catalog, or query catalog')
+    parser.add_argument('catalogFile',
+                        action='store',
+                        type=str,
+                        help='SQLite catalog file')
+    parser.add_argument('dirs',
+                        action='store',
+                        type=str,
+                        nargs='*',
+                        help='for scan: directories with tape images (e.g. tapes-DDS)')
+    parser.add_argument('--rescan',
+                        action='store_true',
+                        help='scan: identify images again, even if they did not change')
+    parser.add_argument('--workers',
+                        action='store',
+                        type=int,
+                        default=SCAN_WORKERS,
+                        help='scan: number of images that are read in parallel (default: ' +
+                        str(SCAN_WORKERS) + ')')
+    parser.add_argument('--format',
+                        action='store',
+                        type=str,
+                        help='query: image format (dump, tar, unknown)')
+    parser.add_argument('--tape-set',
+                        action='store',
+                        type=str,
+                        help='query: tape set (DDS, DLT)')
+    parser.add_argument('--tape',
+                        action='store',
+                        type=str,
+                        help='query: tape number')
+    parser.add_argument('--filesys',
+                        action='store',
+                        type=str,
+                        help='query: dumped file system (e.g. /home)')
+    parser.add_argument('--host',
+                        action='store',
+                        type=str,
+                        help='query: host the dump was made on')
+    parser.add_argument('--columns',
+                        action='store',
+                        type=str,
+                        help='query: comma-separated list of columns, written as CSV \
+                        (default: path only); available columns: ' + ", ".join(COLUMNS))
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='Build and query catalog of xxLINK tape images')
+    args = parseCommandLine(parser)
+
+    catalog = TapeCatalog(args.catalogFile)
+
+    if args.command == "scan":
+        if not args.dirs:
+            errorExit("no directories to scan")
+        scanned, skipped = catalog.scan(args.dirs, args.workers, args.rescan)
+        print("Scanned {} images; skipped {} unchanged images".format(scanned, skipped),
+              file=sys.stderr)
+    else:
+        try:
+            rows = catalog.query(format=args.format, tapeSet=args.tape_set, tape=args.tape,
+                                 filesys=args.filesys, host=args.host)
+        except ValueError as e:
+            errorExit(str(e))
+        if args.columns is None:
+            for row in rows:
+                print(row["path"])
+        else:
+            columns = args.columns.split(",")
+            unknown = [c for c in columns if c not in COLUMNS]
+            if unknown:
+                errorExit("unknown columns " + ", ".join(unknown))
+            writer = csv.writer(sys.stdout)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([row[c] for c in columns])
+
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
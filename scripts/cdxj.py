@@ -0,0 +1,128 @@
+"""
+CDXJ index generation for WARC captures
+
+Index lines are produced while the WARC records are written (using their
+offsets and lengths), so the WARCs don't need to be read again to index
+them. Lines are first appended to an unsorted spill file (which survives an
+interrupted capture); when a WARC segment is closed they are sorted into a
+CDXJ file next to it. The CDXJ files of all sites can be merged into one
+index for a pywb collection.
+
+"""
+
+import os
+import re
+import json
+import heapq
+from urllib.parse import urlsplit
+
+try:
+    # Same canonicalization as pywb, if available
+    import surt as surtLib
+except ImportError:
+    surtLib = None
+
+
+def surtUrl(url):
+    """Return SURT form of url, as used for pywb index keys"""
+    if surtLib is not None:
+        return surtLib.surt(url)
+
+    # Simplified version of the surt library's default canonicalization
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower().strip(".")
+    host = re.sub(r"^www\d*\.", "", host)
+    key = ",".join(reversed(host.split(".")))
+    if parts.port and parts.port != 80:
+        key += ":" + str(parts.port)
+    path = parts.path or "/"
+    key += ")" + path
+    if parts.query:
+        key += "?" + "&".join(sorted(parts.query.split("&")))
+    return key.lower()
+
+
+def cdxTimestamp(warcDate):
+    """Return 14-digit timestamp for WARC-Date value"""
+    return re.sub(r"[^0-9]", "", warcDate)[:14]
+
+
+def cdxjLine(record, filename, offset, length):
+    """Return CDXJ line for WARC response or revisit record, or None for
+    other record types"""
+    if record.rec_type not in ["response", "revisit"]:
+        return None
+
+    url = record.rec_headers.get_header("WARC-Target-URI")
+    fields = {"url": url}
+
+    if record.rec_type == "revisit":
+        fields["mime"] = "warc/revisit"
+    elif record.http_headers is not None:
+        mime = record.http_headers.get_header("Content-Type")
+        if mime:
+            fields["mime"] = mime.split(";")[0].strip()
+
+    if record.http_headers is not None:
+        fields["status"] = record.http_headers.get_statuscode()
+
+    digest = record.rec_headers.get_header("WARC-Payload-Digest")
+    if digest:
+        fields["digest"] = digest.split(":")[-1]
+
+    fields["length"] = str(length)
+    fields["offset"] = str(offset)
+    fields["filename"] = filename
+
+    timestamp = cdxTimestamp(record.rec_headers.get_header("WARC-Date"))
+    return surtUrl(url) + " " + timestamp + " " + json.dumps(fields)
+
+
+def indexName(warcFile):
+    """Return name of CDXJ file for WARC file"""
+    return re.sub(r"\.warc(\.gz)?$", "", warcFile) + ".cdxj"
+
+
+def spillName(warcFile):
+    """Return name of unsorted spill file for WARC file"""
+    return indexName(warcFile) + ".unsorted"
+
+
+def finalizeIndex(warcFile, maxOffset=None):
+    """Sort index lines of warcFile into its CDXJ file. If maxOffset is
+    set, lines of records at or beyond that offset are dropped (used for
+    segments that were truncated after an interrupted capture)"""
+
+    source = spillName(warcFile)
+    if not os.path.isfile(source):
+        source = indexName(warcFile)
+        if not os.path.isfile(source):
+            return
+
+    with open(source, "r", encoding="utf-8") as fIn:
+        lines = [line for line in fIn if line.strip()]
+
+    if maxOffset is not None:
+        lines = [line for line in lines
+                 if int(json.loads(line.split(" ", 2)[2])["offset"]) < maxOffset]
+
+    lines.sort()
+
+    tmpOut = indexName(warcFile) + ".tmp"
+    with open(tmpOut, "w", encoding="utf-8") as fOut:
+        fOut.writelines(lines)
+    os.replace(tmpOut, indexName(warcFile))
+
+    if os.path.isfile(spillName(warcFile)):
+        os.remove(spillName(warcFile))
+
+
+def mergeIndexes(indexFiles, indexOut):
+    """Merge sorted CDXJ files into one sorted index"""
+    inputs = [open(indexFile, "r", encoding="utf-8") for indexFile in indexFiles]
+    try:
+        with open(indexOut, "w", encoding="utf-8") as fOut:
+            fOut.writelines(heapq.merge(*inputs))
+    finally:
+        for fIn in inputs:
+            fIn.close()
@@ -17,6 +17,7 @@ import csv
 import argparse
 from shutil import which
 from shutil import copyfile
+from siteconfig import readConfig, mapSites, WWW_APACHE
 
 def parseCommandLine(parser):
     """Command line parser"""
@@ -42,71 +43,35 @@ def errorExit(msg):
     sys.exit(1)
 
 
-def readConfigDir(dirIn, dirOut):
+def readConfigDir(dirIn, wwwOut):
     """
-    Read config dir, filter site config files and return
-    list with dictionary for each site
+    Read config dir (resolving Include directives), and return
+    list of sites that can be restored
     """
 
     configDirIn = os.path.join(dirIn, "apache.intel/conf/configdb")
 
-    # List that holds individual site dictionaries
-    sites = []
+    if not os.path.isdir(configDirIn):
+        print("WARNING: directory " + configDirIn + " does not exist", file=sys.stderr)
+        return []
 
-    if os.path.exists(configDirIn):
-        for path in os.listdir(configDirIn):
-            thisPath = os.path.join(configDirIn, path)
-            if os.path.isfile(thisPath):
-                siteInfo = readApacheConfig(thisPath, dirIn, dirOut)
-                if siteInfo["isApacheConfig"]:
-                    sites.append(siteInfo)
-    return sites
-
-
-def readApacheConfig(configFile, dirIn, dirOut):
-    """
-    Read Apache config file, extract interesting bits and return
-    them in dictionary
-    """
-
-    siteInfo = {}
-    isApacheConfig = False
-
-    with open(configFile) as configIn:
-        # TODO: Include RewriteRule entries?
-        for line in configIn:
-            if line.startswith("<VirtualHost"):
-                isApacheConfig = True
-            if line.startswith("DocumentRoot"):
-                DocumentRoot = line.split()[1].strip()
-                siteInfo["DocumentRoot"] = DocumentRoot
-            if line.startswith("ServerName"):
-                ServerName = line.split()[1].strip()
-                siteInfo["ServerName"] = ServerName
-                if not ServerName.startswith("www."):
-                    ServerAlias = "www." + ServerName
-                    siteInfo["ServerAlias"] = ServerAlias
-
-    siteInfo["isApacheConfig"] = isApacheConfig
-
-    return siteInfo
+    sites = readConfig(configDirIn, "apache", root=dirIn)
+    return mapSites(sites, WWW_APACHE, os.path.join(dirIn, "www"), wwwOut)
 
 def writeConfig(site, configOut, hostsOut):
     """Write output Apache config records for site"""
 
     with open(configOut, "a", encoding="utf-8") as cOut:
         cOut.write("<VirtualHost *:80>\n")
-        cOut.write("ServerName " + site["ServerName"] + "\n")
-        try:
-            cOut.write("ServerAlias " + site["ServerAlias"] + "\n")
-        except KeyError:
-            pass
-        cOut.write("DocumentRoot " + site["pathOut"] + "\n")
+        cOut.write("ServerName " + site.serverName + "\n")
+        if not site.serverName.startswith("www."):
+            cOut.write("ServerAlias " + "www." + site.serverName + "\n")
+        cOut.write("DocumentRoot " + site.pathOut + "\n")
         cOut.write("</VirtualHost>" + "\n\n")
 
     with open(hostsOut, "a", encoding="utf-8") as hOut:
-        hOut.write("127.0.0.1 " + site["ServerName"] + "\n")
-        hOut.write("127.0.0.1 " + "http://" + site["ServerName"] + "\n")
+        hOut.write("127.0.0.1 " + site.serverName + "\n")
+        hOut.write("127.0.0.1 " + "http://" + site.serverName + "\n")
         #hOut.write("\n\n")
 
 def main():
@@ -118,9 +83,7 @@ def main():
     dirIn = os.path.abspath(args.dirIn)
     dirOut = os.path.abspath(args.dirOut)
 
-    # String constants
-    DocumentRootPrefix = "/export/home/local/www"
-    wwwIn = os.path.join(dirIn, "www")
+    # Restored sites are served from here
     wwwOut = os.path.join("/var/www", os.path.basename(dirOut))
 
     # Dir, files for output config
@@ -128,9 +91,10 @@ def main():
     httpdConfOut = os.path.join(dirOutEtc, "sites.conf")
     hostsOut = os.path.join(dirOutEtc, "hosts")
 
-    # Read info on sites from config file
-    #sites = readApacheConfig(dirIn, dirOut)
-    sites = readConfigDir(dirIn, dirOut)
+    # Read info on sites from config dir. Sites without ServerName or
+    # DocumentRoot (mostly .xxLINK domains) are skipped; DocumentRoot entries
+    # that are imported with Include (www.hospitalitynet.org) are resolved
+    sites = readConfigDir(dirIn, wwwOut)
 
     # Create output etc directory
     if not os.path.exists(dirOutEtc):
@@ -142,37 +106,9 @@ def main():
     if os.path.isfile(hostsOut):
         os.remove(hostsOut)
 
-    ## TODO: in some case either ServerName or DocumentRoot are missing from config
-    # file. Mostly happens for .xxLINK domains, but also for www.hospitalitynet.org
-    # which imports a value using INCLUDE file. For now ignore these.
-
     for site in sites:
-        hasServerName = True
-        hasDocumentRoot = True
-        try:
-            ServerName = site["ServerName"]
-        except KeyError:
-            hasServerName = False
-        try:
-            DocumentRoot = site["DocumentRoot"]
-        except KeyError:
-            if ServerName == "www.hospitalitynet.org":
-                # Fix for missing DocumentRoot hospitalitynet
-                DocumentRoot = "/export/home/local/www/hospitorg/root"
-            else:
-                hasDocumentRoot = False
-
-        if hasServerName and hasDocumentRoot:
-            # Construct source and destination paths
-            pathIn = DocumentRoot.replace(DocumentRootPrefix, wwwIn)
-            pathOut = DocumentRoot.replace(DocumentRootPrefix, wwwOut)
-            site["pathIn"] = pathIn
-            site["pathOut"] = pathOut
-            ## TEST
-            #print(ServerName, pathIn, pathOut)
-            ## TEST
-            # Write config entry
-            writeConfig(site, httpdConfOut, hostsOut)
+        # Write config entry
+        writeConfig(site, httpdConfOut, hostsOut)
 
 if __name__ == "__main__":
     main()
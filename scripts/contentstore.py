@@ -0,0 +1,189 @@
+"""
+Content-addressed storage of restored files
+
+Restored trees of different sites and tapes contain many identical files
+(shared icons, images and other assets that were linked from many sites).
+The content store keeps one copy of each distinct file in a store directory
+on the same volume as the restored trees, and replaces every duplicate by a
+hard link to (or a reflink of) that copy.
+
+Hard links share their metadata, so in hardlink mode files are only merged
+if their modification time and permission bits match as well (restored
+files must keep their own modification times, since these end up in the
+Last-Modified headers of the captures). Reflinks are separate files that
+only share their data blocks, so in reflink mode files are merged on
+content alone; this needs a file system with reflink support (e.g. Btrfs or
+XFS).
+
+"""
+
+import os
+import sys
+import stat
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from manifest import fileHash
+from copyengine import FICLONE, COPY_WORKERS
+
+MODES = ["hardlink", "reflink"]
+
+
+def reflink(sourcePath, destPath):
+    """Create destPath as a reflink copy of sourcePath, with the same mode
+    and modification time"""
+    sourceStat = os.stat(sourcePath)
+    fdIn = os.open(sourcePath, os.O_RDONLY)
+    try:
+        fdOut = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            fcntl.ioctl(fdOut, FICLONE, fdIn)
+            os.fchmod(fdOut, stat.S_IMODE(sourceStat.st_mode))
+            os.utime(fdOut, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns))
+        except OSError:
+            os.close(fdOut)
+            os.remove(destPath)
+            raise
+        os.close(fdOut)
+    finally:
+        os.close(fdIn)
+
+
+class ContentStore:
+    """Store of distinct file contents"""
+
+    def __init__(self, storeDir, mode="hardlink"):
+        if mode not in MODES:
+            raise ValueError("unknown content store mode " + mode)
+        self.storeDir = os.path.abspath(storeDir)
+        self.mode = mode
+        os.makedirs(self.storeDir, exist_ok=True)
+        if mode == "reflink":
+            self.checkReflink()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.duplicates = 0
+        self.savedBytes = 0
+
+    def checkReflink(self):
+        """Raise OSError if the store's file system doesn't support
+        reflinks"""
+        testIn = os.path.join(self.storeDir, ".reflink-test")
+        testOut = testIn + ".clone"
+        with open(testIn, "wb") as fOut:
+            fOut.write(b"reflink test\n")
+        try:
+            reflink(testIn, testOut)
+            os.remove(testOut)
+        finally:
+            os.remove(testIn)
+
+    def storePath(self, fileStat, digest):
+        """Return path of stored copy for file with fileStat and digest"""
+        if self.mode == "hardlink":
+            name = "%s-%x-%o" % (digest, fileStat.st_mtime_ns, stat.S_IMODE(fileStat.st_mode))
+        else:
+            name = digest
+        return os.path.join(self.storeDir, digest[:2], name)
+
+    def add(self, path, digest=None):
+        """Add regular file to store. If the store already holds the same
+        content, path is replaced by a link to it. Returns number of bytes
+        saved"""
+        fileStat = os.lstat(path)
+        if not stat.S_ISREG(fileStat.st_mode):
+            return 0
+        if digest is None:
+            digest = fileHash(path)
+        storePath = self.storePath(fileStat, digest)
+        saved = 0
+
+        try:
+            os.makedirs(os.path.dirname(storePath), exist_ok=True)
+            if self.mode == "hardlink":
+                os.link(path, storePath)
+            else:
+                reflink(path, storePath)
+        except FileExistsError:
+            saved = self.replace(path, fileStat, storePath)
+
+        with self.lock:
+            self.files += 1
+            if saved:
+                self.duplicates += 1
+                self.savedBytes += saved
+        return saved
+
+    def replace(self, path, fileStat, storePath):
+        """Replace path by link to storePath, and return number of bytes
+        saved"""
+        storeStat = os.stat(storePath)
+        if storeStat.st_size != fileStat.st_size:
+            # SHA-1 collisions don't happen in practice, but a truncated store
+            # file (from an interrupted run) might
+            print("WARNING: size mismatch for " + storePath + ", not deduplicating " + path,
+                  file=sys.stderr)
+            return 0
+        if self.mode == "hardlink" and storeStat.st_ino == fileStat.st_ino:
+            # Already linked
+            return 0
+
+        linkTmp = path + ".storetmp"
+        if self.mode == "hardlink":
+            os.link(storePath, linkTmp)
+        else:
+            reflink(storePath, linkTmp)
+            os.utime(linkTmp, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns))
+            os.chmod(linkTmp, stat.S_IMODE(fileStat.st_mode))
+        os.replace(linkTmp, path)
+
+        if self.mode == "hardlink" and fileStat.st_nlink > 1:
+            # Other links still hold the old data
+            return 0
+        return fileStat.st_size
+
+    def addTree(self, treeDir, workers=COPY_WORKERS):
+        """Add all regular files below treeDir (except the store itself).
+        Modification times of directories are preserved"""
+        pending = set()
+        maxPending = 4 * workers
+        dirTimes = []
+
+        def addOne(path):
+            try:
+                self.add(path)
+            except OSError as e:
+                print("ERROR deduplicating " + path + ": " + str(e), file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            stack = [os.path.abspath(treeDir)]
+            while stack:
+                current = stack.pop()
+                if current == self.storeDir:
+                    continue
+                try:
+                    dirTimes.append((current, os.stat(current)))
+                    with os.scandir(current) as it:
+                        entries = list(it)
+                except OSError as e:
+                    print("ERROR reading " + current + ": " + str(e), file=sys.stderr)
+                    continue
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        pending.add(pool.submit(addOne, entry.path))
+                        if len(pending) >= maxPending:
+                            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            wait(pending)
+
+        for current, dirStat in dirTimes:
+            try:
+                os.utime(current, ns=(dirStat.st_atime_ns, dirStat.st_mtime_ns))
+            except OSError:
+                pass
+
+    def summary(self):
+        """Return summary line"""
+        return ("Content store: {} files, {} duplicates, {} bytes saved"
+                .format(self.files, self.duplicates, self.savedBytes))
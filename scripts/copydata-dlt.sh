@@ -6,6 +6,29 @@
 #tapeNos=(1 2 4 6 7 12 14)
 tapeNos=(2 4 6 7 12 14)
 
+tapesDir="/media/johan/xxLINK/xxLINK-DLT/tapes-DLT"
+
+# Take tapes with a dump image from the tape catalog instead, if there is one
+# (see catalog-tapes.py). All DLT images are dumps (or empty); only tapes of
+# which the dump was extracted (file000001/www exists) are copied. The list
+# above is kept if the catalog doesn't give any such tapes
+catalog="/media/johan/xxLINK/xxLINK-DLT/xxlink-tapes.db"
+if [ -f "$catalog" ]; then
+    catalogNos=()
+    for i in $(python3 "$(dirname "$0")"/catalog-tapes.py query "$catalog" --tape-set DLT \
+        --format dump --columns tape | tail -n +2 | tr -d "\r" | sort -un)
+    do
+        if [ -d "$tapesDir"/"$i"/file000001/www ]; then
+            catalogNos+=("$i")
+        fi
+    done
+    if [ ${#catalogNos[@]} -gt 0 ]; then
+        tapeNos=("${catalogNos[@]}")
+    else
+        echo "No extracted DLT dumps in catalog ""$catalog"", using default tapes" >&2
+    fi
+fi
+
 #sudo rsync -avhl /media/johan/xxLINK/xxLINK-DLT/tapes-DLT/1/file000001/www/ /var/www/xxLINK-DLT-1
 #sudo find /var/www/xxLINK-DLT-1 -type d -exec chmod 755 {} \;
 #sudo find /var/www/xxLINK-DLT-1 -type f -exec chmod 644 {} \;
@@ -13,7 +36,7 @@ tapeNos=(2 4 6 7 12 14)
 for i in "${tapeNos[@]}"
 do
     echo "Processing tape ""$i"
-    rsync -avhl /media/johan/xxLINK/xxLINK-DLT/tapes-DLT/"$i"/file000001/www/ /var/www/xxLINK-DLT-"$i"
-    find /var/www/xxLINK-DLT-"$i" -type d -exec chmod 755 {} \;
-    find /var/www/xxLINK-DLT-"$i" -type f -exec chmod 644 {} \;
+    # Permissions are set by rsync while copying (dirs 755, files 644), so no
+    # separate chmod passes over the copied tree are needed
+    rsync -avhl --chmod=D755,F644 "$tapesDir"/"$i"/file000001/www/ /var/www/xxLINK-DLT-"$i"
 done
@@ -0,0 +1,318 @@
+"""
+Parallel, metadata-preserving copy engine for restoring xxLINK sites
+
+Replacement for distutils' copy_tree (which was removed in Python 3.12).
+Directory trees are walked with os.scandir, and files are copied on a pool
+of worker threads. File data is copied inside the kernel where possible:
+first a reflink (FICLONE, on file systems that support it), then
+copy_file_range, then sendfile, with a plain read/write loop as the last
+resort. Symbolic links are copied as links, and modification times are
+preserved. Permission bits are either preserved, or set to fixed final
+modes on the open file and directory handles while the tree is created, so
+no separate chmod pass over the copy is needed. Like copy_tree's update
+mode, files are only copied if the destination doesn't exist or is older
+than the source. If a restore manifest is given, sources that are
+unchanged since the previous restore are skipped without looking at the
+destination.
+
+"""
+
+import os
+import sys
+import stat
+import errno
+import fcntl
+import threading
+from manifest import ManifestEntry, fileHash
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Default number of copy threads
+COPY_WORKERS = 8
+
+# ioctl request for reflink copies (Linux FICLONE)
+FICLONE = 0x40049409
+
+# Chunk size for sendfile / read-write copies
+CHUNK_SIZE = 1048576
+
+# Errors that indicate that a copy method is not supported for a pair of files
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+# Copy methods that turned out to be unsupported on this system; these are
+# not tried again
+unsupportedMethods = set()
+unsupportedLock = threading.Lock()
+
+
+def markUnsupported(method):
+    """Don't try copy method again"""
+    with unsupportedLock:
+        unsupportedMethods.add(method)
+
+
+def copyData(fdIn, fdOut, size):
+    """Copy size bytes from fdIn to fdOut, using the fastest available
+    method"""
+
+    if "reflink" not in unsupportedMethods:
+        try:
+            fcntl.ioctl(fdOut, FICLONE, fdIn)
+            return
+        except OSError as e:
+            if e.errno in [errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL]:
+                markUnsupported("reflink")
+
+    copied = 0
+
+    if hasattr(os, "copy_file_range") and "copy_file_range" not in unsupportedMethods:
+        try:
+            while copied < size:
+                n = os.copy_file_range(fdIn, fdOut, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            if copied > 0 or e.errno not in UNSUPPORTED:
+                raise
+            if e.errno in [errno.ENOSYS, errno.EOPNOTSUPP]:
+                markUnsupported("copy_file_range")
+
+    if "sendfile" not in unsupportedMethods:
+        try:
+            while copied < size:
+                n = os.sendfile(fdOut, fdIn, copied, min(CHUNK_SIZE, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            if copied > 0 or e.errno not in UNSUPPORTED:
+                raise
+            markUnsupported("sendfile")
+
+    while True:
+        buf = os.read(fdIn, CHUNK_SIZE)
+        if not buf:
+            break
+        while buf:
+            buf = buf[os.write(fdOut, buf):]
+
+
+def lstatOrNone(path):
+    """Return lstat result for path, or None if it doesn't exist"""
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def copyFile(sourcePath, destPath, update=False, mode=None):
+    """Copy regular file, preserving its modification time. The file gets
+    permission bits mode, or those of the source if mode is None. Returns
+    number of bytes copied, or None if the file was skipped because the
+    destination is up to date"""
+
+    sourceStat = os.stat(sourcePath)
+    if mode is None:
+        mode = stat.S_IMODE(sourceStat.st_mode)
+
+    destStat = lstatOrNone(destPath)
+    if (update and destStat is not None and not stat.S_ISLNK(destStat.st_mode)
+            and sourceStat.st_mtime_ns <= destStat.st_mtime_ns):
+        # Up to date, but an earlier run may have left a different mode
+        if stat.S_IMODE(destStat.st_mode) == mode:
+            return None
+        if destStat.st_nlink == 1:
+            os.chmod(destPath, mode)
+            return None
+        # Hard linked to other files (content store), which must keep their
+        # mode, so the file is copied instead
+
+    if destStat is not None and (stat.S_ISLNK(destStat.st_mode) or destStat.st_nlink > 1):
+        # Never write through a link, or into a file that is shared with
+        # other files
+        os.remove(destPath)
+
+    fdIn = os.open(sourcePath, os.O_RDONLY)
+    try:
+        fdOut = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copyData(fdIn, fdOut, sourceStat.st_size)
+            os.fchmod(fdOut, mode)
+            os.utime(fdOut, ns=(sourceStat.st_atime_ns, sourceStat.st_mtime_ns))
+        finally:
+            os.close(fdOut)
+    finally:
+        os.close(fdIn)
+
+    return sourceStat.st_size
+
+
+def copyLink(sourcePath, destPath, update=False):
+    """Copy symbolic link as a link. With update, existing links at the
+    destination are left alone (they may have been fixed by the link
+    resolver).
+    Returns True if a link was created"""
+    if os.path.lexists(destPath):
+        if update and os.path.islink(destPath):
+            return False
+        os.remove(destPath)
+    os.symlink(os.readlink(sourcePath), destPath)
+    return True
+
+
+def makeDir(destPath, mode):
+    """Create directory destPath (if it doesn't exist) and, unless mode is
+    None, set its permission bits through a handle on the directory"""
+    try:
+        os.mkdir(destPath, 0o777 if mode is None else 0o700)
+    except FileExistsError:
+        pass
+    if mode is None:
+        return
+    fd = os.open(destPath, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+
+
+def newStats():
+    """Return dictionary with copy counters"""
+    return {"files": 0, "bytes": 0, "skipped": 0, "links": 0, "dirs": 0, "errors": 0,
+            "removed": 0}
+
+
+def copyTree(sourceDir, destDir, update=True, workers=COPY_WORKERS,
+             fileMode=None, dirMode=None, execDirs=(), execMode=0o755, manifest=None,
+             links=None, store=None, progress=None):
+    """Copy directory tree sourceDir to destDir, and return dictionary with
+    counts of copied files, bytes, skipped files, links, directories and
+    errors. Files and directories get permission bits fileMode and dirMode
+    (by default, files keep the mode of the source and directories are
+    created with the default mode); files below any of the source
+    directories in execDirs get execMode. With a manifest, entries whose
+    source is unchanged are skipped, and the manifest is updated with
+    everything that was copied. If links is a list, the destination paths of
+    all links in the tree are appended to it. With a content store, copied
+    files that duplicate stored content are replaced by links. If progress
+    is given, it is called with (files, bytes) for each file that is copied
+    or skipped. Errors on individual files are reported, but don't abort the
+    copy"""
+
+    stats = newStats()
+    # Directory modification times are set after all files are copied
+    dirTimes = []
+    pending = set()
+    maxPending = 4 * workers
+
+    execDirs = set(os.path.abspath(d) for d in execDirs)
+
+    def copyOne(sourcePath, destPath, sourceStat, mode):
+        try:
+            result = copyFile(sourcePath, destPath, update, mode)
+            digest = ""
+            if manifest is not None and manifest.useHash:
+                digest = fileHash(destPath)
+            if store is not None and result:
+                store.add(destPath, digest or None)
+        except OSError as e:
+            print("ERROR copying " + sourcePath + ": " + str(e), file=sys.stderr)
+            return False, destPath, sourceStat, mode, ""
+        return result, destPath, sourceStat, mode, digest
+
+    def collect(done):
+        for future in done:
+            result, destPath, sourceStat, mode, digest = future.result()
+            if result is None:
+                stats["skipped"] += 1
+            elif result is False:
+                stats["errors"] += 1
+                continue
+            else:
+                stats["files"] += 1
+                stats["bytes"] += result
+            if progress is not None:
+                progress(1, result or 0)
+            if manifest is not None:
+                if mode is None:
+                    mode = stat.S_IMODE(sourceStat.st_mode)
+                manifest.set(destPath, ManifestEntry("f", sourceStat.st_size,
+                                                     sourceStat.st_mtime_ns, mode, digest))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        os.makedirs(os.path.dirname(os.path.abspath(destDir)), exist_ok=True)
+        stack = [(sourceDir, destDir, False)]
+        while stack:
+            sourcePath, destPath, isExec = stack.pop()
+            isExec = isExec or os.path.abspath(sourcePath) in execDirs
+            modeOut = execMode if isExec else fileMode
+            try:
+                dirStat = os.stat(sourcePath)
+                if manifest is None or not manifest.isUnchanged(destPath, "d", dirStat, dirMode):
+                    makeDir(destPath, dirMode)
+                    dirTimes.append((destPath, dirStat))
+                    stats["dirs"] += 1
+                with os.scandir(sourcePath) as it:
+                    entries = list(it)
+            except OSError as e:
+                print("ERROR copying " + sourcePath + ": " + str(e), file=sys.stderr)
+                stats["errors"] += 1
+                continue
+
+            for entry in entries:
+                destEntry = os.path.join(destPath, entry.name)
+                try:
+                    if entry.is_symlink():
+                        if links is not None:
+                            links.append(destEntry)
+                        target = os.readlink(entry.path)
+                        keepLink = update
+                        if manifest is not None:
+                            if manifest.isUnchangedLink(destEntry, target):
+                                continue
+                            if manifest.isKnown(destEntry) and not manifest.rescan:
+                                # Link changed on the source, so a link that was
+                                # fixed by an earlier restore is stale
+                                keepLink = False
+                        if copyLink(entry.path, destEntry, keepLink):
+                            stats["links"] += 1
+                        if manifest is not None:
+                            manifest.set(destEntry, ManifestEntry("l", target=target))
+                    elif entry.is_dir():
+                        stack.append((entry.path, destEntry, isExec))
+                    elif entry.is_file():
+                        sourceStat = entry.stat()
+                        if manifest is not None and manifest.isUnchanged(destEntry, "f", sourceStat, modeOut):
+                            stats["skipped"] += 1
+                            continue
+                        pending.add(pool.submit(copyOne, entry.path, destEntry, sourceStat, modeOut))
+                        if len(pending) >= maxPending:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                    else:
+                        print("WARNING: skipping special file " + entry.path, file=sys.stderr)
+                except OSError as e:
+                    print("ERROR copying " + entry.path + ": " + str(e), file=sys.stderr)
+                    stats["errors"] += 1
+
+        done, _ = wait(pending)
+        collect(done)
+
+    # Creating entries changes a directory's modification time, so this can
+    # only be done once all copies are finished
+    for destPath, dirStat in dirTimes:
+        try:
+            os.utime(destPath, ns=(dirStat.st_atime_ns, dirStat.st_mtime_ns))
+        except OSError:
+            continue
+        if manifest is not None:
+            manifest.set(destPath, ManifestEntry("d", mtime=dirStat.st_mtime_ns,
+                                                 mode=dirMode or 0))
+
+    if manifest is not None:
+        stats["removed"] = manifest.prune(destDir)
+
+    return stats
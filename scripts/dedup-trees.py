@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+"""
+Deduplicate restored xxLINK trees through a content store
+
+All files in the trees with the same content are replaced by hard links to
+(or reflinks of) a single stored copy. The store directory must be on the
+same volume as the trees.
+
+Example command line:
+
+sudo python3 ~/kb/xxLINK-resources/scripts/dedup-trees.py /var/www/.xxLINK-store /var/www/xxLINK-DLT-*
+
+"""
+
+import os
+import sys
+import argparse
+from contentstore import ContentStore, MODES
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('storeDir',
+                        action='store',
+                        type=str,
+                        help='content store directory')
+    parser.add_argument('trees',
+                        action='store',
+                        type=str,
+                        nargs='+',
+                        help='restored trees')
+    parser.add_argument('--mode',
+                        action='store',
+                        choices=MODES,
+                        default='hardlink',
+                        help='how duplicates are linked to the content store (default: hardlink)')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='Deduplicate restored xxLINK trees')
+    args = parseCommandLine(parser)
+
+    try:
+        store = ContentStore(args.storeDir, args.mode)
+    except OSError as e:
+        errorExit("cannot use content store " + args.storeDir + ": " + str(e))
+
+    storeDevice = os.stat(store.storeDir).st_dev
+    for tree in args.trees:
+        if not os.path.isdir(tree):
+            print("WARNING: directory " + tree + " does not exist", file=sys.stderr)
+            continue
+        if os.stat(tree).st_dev != storeDevice:
+            print("WARNING: " + tree + " is not on the same volume as the content store, skipping",
+                  file=sys.stderr)
+            continue
+
+        files = store.files
+        savedBytes = store.savedBytes
+        print("====== PROCESSING TREE " + tree, file=sys.stderr)
+        store.addTree(tree)
+        print("{} files, {} bytes saved".format(store.files - files, store.savedBytes - savedBytes),
+              file=sys.stderr)
+
+    print(store.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
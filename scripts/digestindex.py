@@ -0,0 +1,125 @@
+"""
+Persistent payload digest index for deduplication of WARC captures
+
+The index is an SQLite database that maps SHA-1 payload digests to the first
+capture of that payload (URI, WARC-Date and WARC file). It is shared by all
+sites, tapes and runs that use the same database file, and can safely be used
+by multiple capture processes at the same time. The index also keeps
+deduplication statistics for each site, so savings can be reported per tape.
+
+Claims of payloads are only final once the records of the claiming capture
+are committed to its journal; claims of a capture that was interrupted
+before that are rolled back when the site is captured again. The statistics
+of a site are added at each commit too, so they stay consistent with the
+committed records when a capture is resumed.
+
+Entries are never replaced: revisit records in other WARCs refer to the
+first capture of a payload. If a site is captured again from scratch, its
+payloads are written in full again, and revisits of other sites still
+resolve as long as the same URI with the same payload is in the collection.
+If the content of a site changed, the index must be rebuilt together with
+all WARCs that use it.
+
+"""
+
+import sqlite3
+
+# Payloads smaller than this are always stored in full, as a revisit record
+# isn't much smaller than the response record it replaces
+MIN_LENGTH = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    digest TEXT PRIMARY KEY,
+    uri TEXT NOT NULL,
+    date TEXT NOT NULL,
+    warc TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    site TEXT NOT NULL,
+    run TEXT NOT NULL,
+    committed INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS sites (
+    tape TEXT NOT NULL,
+    site TEXT NOT NULL,
+    responses INTEGER NOT NULL,
+    revisits INTEGER NOT NULL,
+    payloadBytes INTEGER NOT NULL,
+    savedBytes INTEGER NOT NULL,
+    PRIMARY KEY (tape, site)
+);
+"""
+
+
+class DigestIndex:
+    """Index of captured payload digests"""
+
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+        # Autocommit mode, so claims are immediately visible to other
+        # processes, and no process holds a write lock for long
+        self.db = sqlite3.connect(indexFile, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # Indexes created before claims had to be committed
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(payloads)")]
+        if "committed" not in columns:
+            self.db.execute("ALTER TABLE payloads ADD COLUMN committed INTEGER NOT NULL "
+                            "DEFAULT 1")
+
+    def claim(self, digest, uri, date, warc, length, site, run):
+        """Register payload as captured by uri, unless it was captured
+        before. Returns None if the caller owns the payload (and must write
+        it in full, and later commit the claim), or (uri, date, site, run)
+        of the original capture"""
+        cursor = self.db.execute("INSERT OR IGNORE INTO payloads (digest, uri, date, warc, "
+                                 "length, site, run, committed) VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                                 (digest, uri, date, warc, length, site, run))
+        if cursor.rowcount == 1:
+            return None
+
+        return self.db.execute("SELECT uri, date, site, run FROM payloads WHERE digest = ?",
+                               (digest,)).fetchone()
+
+    def commit(self, digests, tape, site, responses, revisits, payloadBytes, savedBytes):
+        """Make claims of digests final, and add deduplication statistics
+        of the records that were committed with them to site"""
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany("UPDATE payloads SET committed = 1 WHERE digest = ?",
+                                [(digest,) for digest in digests])
+            self.db.execute("INSERT INTO sites VALUES (?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (tape, site) DO UPDATE SET "
+                            "responses = responses + excluded.responses, "
+                            "revisits = revisits + excluded.revisits, "
+                            "payloadBytes = payloadBytes + excluded.payloadBytes, "
+                            "savedBytes = savedBytes + excluded.savedBytes",
+                            (tape, site, responses, revisits, payloadBytes, savedBytes))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def rollback(self, site):
+        """Remove claims of site that were never committed (by a capture
+        that was interrupted), and return their number"""
+        cursor = self.db.execute("DELETE FROM payloads WHERE site = ? AND committed = 0",
+                                 (site,))
+        return cursor.rowcount
+
+    def resetSite(self, tape, site):
+        """Remove deduplication statistics of site (before it is captured
+        from scratch)"""
+        self.db.execute("DELETE FROM sites WHERE tape = ? AND site = ?", (tape, site))
+
+    def tapeTotals(self):
+        """Return list of (tape, sites, responses, revisits, payloadBytes,
+        savedBytes) tuples, with totals for each tape in the index"""
+        return self.db.execute("SELECT tape, COUNT(*), SUM(responses), SUM(revisits), "
+                               "SUM(payloadBytes), SUM(savedBytes) FROM sites "
+                               "GROUP BY tape ORDER BY tape").fetchall()
+
+    def close(self):
+        """Close index"""
+        self.db.close()
@@ -0,0 +1,146 @@
+"""
+Direct filesystem capture of static files for restored xxLINK sites
+
+Static files under a site's DocumentRoot are written to the WARC straight
+from disk, without going through the local Apache server. Response headers
+are synthesized to match what the restored Apache server would send for the
+same file (Content-Type from the extension map, Last-Modified from the file's
+modification time, and Apache's default ETag format). Everything that isn't a
+plain static file (directory listings, the RedirectMatch index redirects, CGI
+paths, broken links) is still fetched over HTTP.
+
+"""
+
+import os
+import hashlib
+import mimetypes
+from email.utils import formatdate
+from urllib.parse import urlsplit, unquote_to_bytes
+import requests
+from warcio.statusandheaders import StatusAndHeaders
+from sitecapture import Exchange, warcDate, warcDigest, CHUNK_SIZE
+
+# Apache reads its extension map from /etc/mime.types
+mimeTypes = mimetypes.MimeTypes()
+if os.path.isfile("/etc/mime.types"):
+    mimeTypes.read("/etc/mime.types")
+
+# Path components and extensions that identify CGI scripts
+CGI_DIRS = ["cgi-bin", "htbin"]
+CGI_EXTENSIONS = [".cgi", ".pl", ".sh"]
+
+
+def contentType(path):
+    """Return Content-Type that Apache would report for path, or None if the
+    extension is unknown (Apache then doesn't send a Content-Type at all)"""
+    mimeType, encoding = mimeTypes.guess_type(os.fsdecode(path), strict=False)
+    if mimeType is None and encoding == "gzip":
+        mimeType = "application/x-gzip"
+    return mimeType
+
+
+def httpDate(timestamp):
+    """Return timestamp as HTTP date"""
+    return formatdate(timestamp, usegmt=True)
+
+
+def apacheETag(fileStat):
+    """Return ETag in Apache's default format (FileETag MTime Size)"""
+    mtimeMicro = fileStat.st_mtime_ns // 1000
+    return '"%x-%x"' % (fileStat.st_size, mtimeMicro)
+
+
+def staticHeaders(path, fileStat):
+    """Return list of response headers for static file"""
+    headers = [("Date", httpDate(None)),
+               ("Last-Modified", httpDate(fileStat.st_mtime)),
+               ("ETag", apacheETag(fileStat)),
+               ("Accept-Ranges", "bytes"),
+               ("Content-Length", str(fileStat.st_size))]
+    mimeType = contentType(path)
+    if mimeType is not None:
+        headers.append(("Content-Type", mimeType))
+    return headers
+
+
+def requestHeaders(host):
+    """Return list of request headers for synthesized request. These are the
+    headers of the HTTP engine, except Accept-Encoding, since the stored
+    response is never compressed"""
+    headers = [("Host", host)]
+    for name, value in requests.utils.default_headers().items():
+        if name.lower() != "accept-encoding":
+            headers.append((name, value))
+    return headers
+
+
+class DirectReader:
+    """Reads static files of one site from disk; all other URLs are passed
+    on to fallback fetcher"""
+
+    def __init__(self, rootDir, urlPrefix, fallback):
+        self.rootDir = os.fsencode(os.path.abspath(rootDir))
+        self.urlPrefix = urlPrefix.rstrip("/")
+        self.fallback = fallback
+
+    def filePath(self, url):
+        """Return file system path (as bytes) that corresponds to url, or
+        None if it must be fetched over HTTP"""
+        if not url.startswith(self.urlPrefix + "/"):
+            # Includes domain root, which is redirected by RedirectMatch
+            return None
+
+        relPath = unquote_to_bytes(urlsplit(url).path).lstrip(b"/")
+        parts = relPath.split(b"/")
+        if b".." in parts or parts[-1].startswith(b".ht"):
+            # Apache refuses these
+            return None
+        if any(os.fsencode(d) in parts[:-1] for d in CGI_DIRS):
+            return None
+        if os.path.splitext(parts[-1])[1].lower() in [os.fsencode(e) for e in CGI_EXTENSIONS]:
+            return None
+
+        return os.path.join(self.rootDir, relPath)
+
+    def fetch(self, url):
+        """Return list of Exchange objects for url"""
+        path = self.filePath(url)
+        if path is None:
+            return self.fallback.fetch(url)
+        try:
+            fileIn = open(path, "rb")
+        except OSError:
+            # Directories, broken links, paths below a file (PATH_INFO) and
+            # unreadable files; the server decides what to send for these
+            return self.fallback.fetch(url)
+
+        try:
+            fileStat = os.fstat(fileIn.fileno())
+            exchange = Exchange(url)
+            exchange.date = warcDate()
+            exchange.requestLine = "GET " + urlsplit(url).path + " HTTP/1.1"
+            exchange.requestHeaders = requestHeaders(urlsplit(url).netloc)
+            exchange.statusLine = "200 OK"
+            exchange.headers = staticHeaders(path, fileStat)
+
+            # Compute payload and block digests in a single pass over the
+            # file, so warcio doesn't need to read it again before writing
+            headersBlock = StatusAndHeaders(exchange.statusLine,
+                                            exchange.headers,
+                                            protocol=exchange.protocol).to_bytes()
+            payloadSha1 = hashlib.sha1()
+            blockSha1 = hashlib.sha1(headersBlock)
+            for chunk in iter(lambda: fileIn.read(CHUNK_SIZE), b""):
+                payloadSha1.update(chunk)
+                blockSha1.update(chunk)
+            fileIn.seek(0)
+
+            exchange.payload = fileIn
+            exchange.length = fileStat.st_size
+            exchange.digest = warcDigest(payloadSha1)
+            exchange.blockDigest = warcDigest(blockSha1)
+        except Exception:
+            fileIn.close()
+            raise
+
+        return [exchange]
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+"""
+List or extract files from an xxLINK dump(8) tape image, without restore(8)
+
+The image is indexed in one pass over its headers; only the requested
+subtrees are read and written. By default the www and config directories
+of the xxLINK web server are extracted (those that exist in the image).
+
+Example command lines:
+
+python3 ~/kb/xxLINK-resources/scripts/dump-extract.py list /home/johan/kb/xxLINK/tapes-DDS/12/file000003.dd local/www
+
+python3 ~/kb/xxLINK-resources/scripts/dump-extract.py extract /home/johan/kb/xxLINK/tapes-DDS/12/file000003.dd /home/johan/kb/xxLINK/tapes-DDS/12/file000003
+
+"""
+
+import os
+import sys
+import stat
+import time
+import argparse
+from dumpreader import DumpReader, DumpError
+
+# Subtrees that are extracted if no paths are given
+DEFAULT_PATHS = ["home/local/www",
+                 "home/local/etc",
+                 "local/www",
+                 "local/etc",
+                 "apache.intel/conf",
+                 "www"]
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('command',
+                        action='store',
+                        choices=['info', 'list', 'extract'],
+                        help='show dump label, list files, or extract files')
+    parser.add_argument('imageFile',
+                        action='store',
+                        type=str,
+                        help='dump tape image')
+    parser.add_argument('paths',
+                        action='store',
+                        type=str,
+                        nargs='*',
+                        help='for list: paths in image; for extract: output directory, \
+                        followed by paths in image')
+    parser.add_argument('--long', '-l',
+                        action='store_true',
+                        help='list mode, size and modification time of each file')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+def listFiles(reader, paths, long):
+    """Write paths in image (and everything below them) to stdout"""
+    for path in paths or [""]:
+        if reader.lookup(path) is None:
+            print("WARNING: " + path + " not found in image", file=sys.stderr)
+            continue
+        for entryPath, inode in reader.walk(path):
+            name = entryPath + "/" if inode.isDir() else entryPath
+            if inode.isLink():
+                name += " -> " + reader.readLink(inode)
+            if long:
+                mtime = time.strftime("%Y-%m-%d %H:%M", time.gmtime(inode.mtime))
+                line = "{} {:>10} {} {}".format(stat.filemode(inode.mode), inode.size, mtime,
+                                                name)
+            else:
+                line = name
+            sys.stdout.buffer.write(os.fsencode(line) + b"\n")
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='List or extract files from xxLINK dump image')
+    args = parseCommandLine(parser)
+
+    try:
+        reader = DumpReader(args.imageFile)
+        reader.buildIndex()
+    except (OSError, DumpError) as e:
+        errorExit("cannot read dump image " + args.imageFile + ": " + str(e))
+    if reader.resyncs or reader.badChecksums:
+        print("WARNING: {} unreadable blocks, {} bad header checksums"
+              .format(reader.resyncs, reader.badChecksums), file=sys.stderr)
+
+    if args.command == "info":
+        for key, value in reader.label.items():
+            if key in ["date", "ddate"]:
+                value = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(value))
+            print(key + ": " + str(value))
+        print("inodes: " + str(len(reader.inodes)))
+    elif args.command == "list":
+        listFiles(reader, args.paths, args.long)
+    else:
+        if not args.paths:
+            errorExit("no output directory")
+        dirOut = args.paths[0]
+        paths = args.paths[1:]
+        if not paths:
+            paths = [p for p in DEFAULT_PATHS if reader.lookup(p) is not None]
+        for path in paths:
+            if reader.lookup(path) is None:
+                print("WARNING: " + path + " not found in image", file=sys.stderr)
+                continue
+            print("====== EXTRACTING " + path, file=sys.stderr)
+            stats = reader.extractTree(path, os.path.join(dirOut, path.strip("/")))
+            print("Extracted {files} files ({bytes} bytes), {links} links, {dirs} dirs; "
+                  "skipped {skipped} up-to-date files; {errors} errors".format(**stats),
+                  file=sys.stderr)
+
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,482 @@
+"""
+Reader for BSD/UFS dump images ("new-fs dump file")
+
+Most of the xxLINK tape images are written by dump(8). Instead of restoring
+them with an interactive restore(8) session and a full extraction, the
+image is memory-mapped and indexed in one pass over its headers: for every
+inode the index holds its attributes and the offsets of its data blocks in
+the image. Directories are parsed from the index on demand, so any file or
+subtree can be listed or extracted with random access, without reading the
+rest of the image.
+
+Both byte orders are supported, as well as the 4.3BSD/SunOS and 4.4BSD
+directory formats. Names are kept as the original bytes (decoded to str
+with surrogateescape, like os.fsdecode does).
+
+"""
+
+import os
+import sys
+import mmap
+import stat
+import struct
+from copyengine import makeDir, newStats
+from linkresolver import LinkResolver, Unresolvable
+
+# Tape block size; all headers and data blocks are this size
+TP_BSIZE = 1024
+# Maximum number of data blocks that one header describes
+TP_NINDIR = TP_BSIZE // 2
+
+NFS_MAGIC = 60012
+OFS_MAGIC = 60011
+CHECKSUM = 84446
+
+# Header types
+TS_TAPE = 1
+TS_INODE = 2
+TS_BITS = 3
+TS_ADDR = 4
+TS_END = 5
+TS_CLRI = 6
+
+# Header flag that indicates 4.4BSD inode and directory formats
+DR_NEWINODEFMT = 0x0002
+
+ROOTINO = 2
+
+# Directory block size
+DIRBLKSIZ = 512
+
+# Offsets in header (struct s_spcl)
+OFF_MAGIC = 24
+OFF_DINODE = 32
+OFF_COUNT = 160
+OFF_ADDR = 164
+OFF_LABEL = 676
+OFF_FLAGS = 888
+
+
+class DumpError(Exception):
+    """Raised for images that can't be read"""
+
+
+class DumpInode:
+    """Attributes and data location of one inode in the image"""
+
+    __slots__ = ["ino", "mode", "size", "atime", "mtime", "runs"]
+
+    def __init__(self, ino, mode, size, atime, mtime):
+        self.ino = ino
+        self.mode = mode
+        self.size = size
+        self.atime = atime
+        self.mtime = mtime
+        # List of [offset, blocks] runs of data blocks; offset is -1 for
+        # holes
+        self.runs = []
+
+    def isDir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def isFile(self):
+        return stat.S_ISREG(self.mode)
+
+    def isLink(self):
+        return stat.S_ISLNK(self.mode)
+
+    def addBlocks(self, offset, blocks):
+        """Add run of data blocks (or a hole if offset is -1)"""
+        if self.runs and self.runs[-1][0] != -1 and offset != -1 and \
+                self.runs[-1][0] + self.runs[-1][1] * TP_BSIZE == offset:
+            self.runs[-1][1] += blocks
+        elif self.runs and self.runs[-1][0] == -1 and offset == -1:
+            self.runs[-1][1] += blocks
+        else:
+            self.runs.append([offset, blocks])
+
+
+def cString(data):
+    """Return NUL-terminated string field as str"""
+    return data.split(b"\0", 1)[0].decode("latin-1")
+
+
+def headerByteOrder(header):
+    """Return struct byte order prefix of dump image that starts with
+    header, or None if it is not a dump image"""
+    for byteOrder in [">", "<"]:
+        magic = struct.unpack_from(byteOrder + "i", header, OFF_MAGIC)[0]
+        if magic == NFS_MAGIC:
+            return byteOrder
+        if magic == OFS_MAGIC:
+            raise DumpError("old file system dump format is not supported")
+    return None
+
+
+def headerLabel(header, byteOrder):
+    """Return dictionary with dump label information from tape header"""
+    date, ddate, volume = struct.unpack_from(byteOrder + "3i", header, 4)
+    level, = struct.unpack_from(byteOrder + "i", header, 692)
+    flags, = struct.unpack_from(byteOrder + "i", header, OFF_FLAGS)
+    return {"date": date,
+            "ddate": ddate,
+            "volume": volume,
+            "level": level,
+            "label": cString(header[OFF_LABEL:OFF_LABEL + 16]),
+            "filesys": cString(header[696:760]),
+            "dev": cString(header[760:824]),
+            "host": cString(header[824:888]),
+            "flags": flags}
+
+
+class DumpReader:
+    """Indexed, memory-mapped dump image"""
+
+    def __init__(self, imageFile):
+        self.imageFile = imageFile
+        self.fileIn = open(imageFile, "rb")
+        try:
+            self.data = mmap.mmap(self.fileIn.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.fileIn.close()
+            raise DumpError("empty image")
+        self.byteOrder = self.detectByteOrder()
+        self.inodes = {}
+        self.dirs = {}
+        self.label = {}
+        self.newFormat = True
+        self.resyncs = 0
+        self.badChecksums = 0
+
+    def close(self):
+        """Close image"""
+        self.data.close()
+        self.fileIn.close()
+
+    def detectByteOrder(self):
+        """Return struct byte order prefix of image"""
+        if len(self.data) < TP_BSIZE:
+            raise DumpError("image too small")
+        byteOrder = headerByteOrder(self.data[:TP_BSIZE])
+        if byteOrder is None:
+            raise DumpError("not a dump image")
+        return byteOrder
+
+    def isHeader(self, offset):
+        """Return True if there is a valid header at offset"""
+        magic = struct.unpack_from(self.byteOrder + "i", self.data, offset + OFF_MAGIC)[0]
+        return magic == NFS_MAGIC
+
+    def checksumOk(self, offset):
+        """Return True if header checksum at offset is correct"""
+        words = struct.unpack_from(self.byteOrder + "256i", self.data, offset)
+        return sum(words) & 0xffffffff == CHECKSUM
+
+    def readLabel(self, offset):
+        """Store dump label information from tape header at offset"""
+        self.label = headerLabel(self.data[offset:offset + TP_BSIZE], self.byteOrder)
+
+    def buildIndex(self):
+        """Read all headers, and index inodes and their data blocks"""
+        b = self.byteOrder
+        data = self.data
+        size = len(data)
+        offset = 0
+        current = None
+
+        while offset + TP_BSIZE <= size:
+            if not self.isHeader(offset):
+                # Skip damaged or unexpected blocks until the next header
+                self.resyncs += 1
+                offset += TP_BSIZE
+                continue
+            if not self.checksumOk(offset):
+                self.badChecksums += 1
+
+            cType, = struct.unpack_from(b + "i", data, offset)
+            inumber, = struct.unpack_from(b + "I", data, offset + 20)
+            count, = struct.unpack_from(b + "i", data, offset + OFF_COUNT)
+            flags, = struct.unpack_from(b + "i", data, offset + OFF_FLAGS)
+            count = max(0, count)
+            header = offset
+            offset += TP_BSIZE
+
+            if cType == TS_TAPE:
+                self.readLabel(header)
+                self.newFormat = bool(flags & DR_NEWINODEFMT)
+                continue
+            if cType == TS_END:
+                break
+            if cType in [TS_CLRI, TS_BITS]:
+                # Inode bitmaps, which can be longer than TP_NINDIR blocks
+                # on large volumes
+                offset += count * TP_BSIZE
+                continue
+            if cType not in [TS_INODE, TS_ADDR]:
+                continue
+
+            if cType == TS_INODE:
+                mode, = struct.unpack_from(b + "H", data, header + OFF_DINODE)
+                fileSize, = struct.unpack_from(b + "Q", data, header + OFF_DINODE + 8)
+                atime, = struct.unpack_from(b + "i", data, header + OFF_DINODE + 16)
+                mtime, = struct.unpack_from(b + "i", data, header + OFF_DINODE + 24)
+                current = DumpInode(inumber, mode, fileSize, atime, mtime)
+                self.inodes[inumber] = current
+            elif current is None or current.ino != inumber:
+                # Continuation of an inode whose header was lost
+                current = None
+
+            addr = data[header + OFF_ADDR:header + OFF_ADDR + min(count, TP_NINDIR)]
+            for present in addr:
+                if present:
+                    if current is not None:
+                        current.addBlocks(offset, 1)
+                    offset += TP_BSIZE
+                elif current is not None:
+                    current.addBlocks(-1, 1)
+
+        if ROOTINO not in self.inodes:
+            raise DumpError("root directory not found in image")
+
+    def chunks(self, inode):
+        """Yield data of inode as a sequence of memoryview / bytes chunks"""
+        remaining = inode.size
+        view = memoryview(self.data)
+        for offset, blocks in inode.runs:
+            if remaining <= 0:
+                break
+            length = min(blocks * TP_BSIZE, remaining)
+            if offset == -1:
+                yield bytes(length)
+            else:
+                yield view[offset:offset + length]
+            remaining -= length
+        if remaining > 0:
+            # Truncated image
+            raise DumpError("data of inode " + str(inode.ino) + " is incomplete")
+
+    def readData(self, inode):
+        """Return data of inode as bytes"""
+        return b"".join(bytes(chunk) for chunk in self.chunks(inode))
+
+    def parseDir(self, data):
+        """Return dictionary that maps names to inode numbers for directory
+        data"""
+        b = self.byteOrder
+        entries = {}
+        for block in range(0, len(data), DIRBLKSIZ):
+            offset = block
+            end = min(block + DIRBLKSIZ, len(data))
+            while offset + 8 <= end:
+                ino, reclen = struct.unpack_from(b + "IH", data, offset)
+                if self.newFormat:
+                    namlen = data[offset + 7]
+                else:
+                    namlen, = struct.unpack_from(b + "H", data, offset + 6)
+                if reclen < 8 or offset + reclen > end:
+                    break
+                if ino != 0 and 8 + namlen <= reclen:
+                    name = data[offset + 8:offset + 8 + namlen]
+                    if name not in [b".", b".."]:
+                        entries[os.fsdecode(name)] = ino
+                offset += reclen
+        return entries
+
+    def listDir(self, ino):
+        """Return dictionary that maps names to inode numbers for directory
+        inode ino"""
+        entries = self.dirs.get(ino)
+        if entries is None:
+            inode = self.inodes.get(ino)
+            if inode is None or not inode.isDir():
+                raise DumpError("inode " + str(ino) + " is not a directory in image")
+            entries = self.parseDir(self.readData(inode))
+            self.dirs[ino] = entries
+        return entries
+
+    def lookup(self, path):
+        """Return inode for path (relative to the dumped file system's root),
+        or None if it doesn't exist. Links are not followed"""
+        ino = ROOTINO
+        for part in path.split("/"):
+            if part in ["", "."]:
+                continue
+            inode = self.inodes.get(ino)
+            if inode is None or not inode.isDir():
+                return None
+            ino = self.listDir(ino).get(part)
+            if ino is None:
+                return None
+        return self.inodes.get(ino)
+
+    def readLink(self, inode):
+        """Return target of link inode"""
+        return os.fsdecode(self.readData(inode).rstrip(b"\0"))
+
+    def walk(self, path=""):
+        """Yield (path, inode) for path and everything below it"""
+        inode = self.lookup(path)
+        if inode is None:
+            return
+        stack = [(path.strip("/"), inode)]
+        while stack:
+            current, inode = stack.pop()
+            yield current, inode
+            if inode.isDir():
+                for name, ino in sorted(self.listDir(inode.ino).items(), reverse=True):
+                    child = self.inodes.get(ino)
+                    if child is not None:
+                        stack.append((current + "/" + name if current else name, child))
+
+    def extractFile(self, inode, destPath, mode=None, update=True):
+        """Write file inode to destPath, and return number of bytes written,
+        or None if destPath is up to date"""
+        if mode is None:
+            mode = stat.S_IMODE(inode.mode)
+        try:
+            destStat = os.lstat(destPath)
+            if update and stat.S_ISREG(destStat.st_mode) and \
+                    destStat.st_size == inode.size and int(destStat.st_mtime) == inode.mtime:
+                if stat.S_IMODE(destStat.st_mode) != mode and destStat.st_nlink == 1:
+                    os.chmod(destPath, mode)
+                return None
+            os.remove(destPath)
+        except FileNotFoundError:
+            pass
+
+        fdOut = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            for chunk in self.chunks(inode):
+                while chunk:
+                    chunk = chunk[os.write(fdOut, chunk):]
+            os.fchmod(fdOut, mode)
+            os.utime(fdOut, (inode.atime, inode.mtime))
+        finally:
+            os.close(fdOut)
+        return inode.size
+
+    def extractTree(self, path, destDir, fileMode=None, dirMode=None, execDirs=(),
+                    execMode=0o755, links=None, store=None):
+        """Extract path (a directory or file in the image) to destDir, and
+        return dictionary with counts like copyengine.copyTree. Files and
+        directories get permission bits fileMode and dirMode (or their
+        original mode if None); files below any of execDirs (paths in the
+        image) get execMode. If links is a list, the destination paths of
+        all links are appended to it"""
+        stats = newStats()
+        path = path.strip("/")
+        os.makedirs(os.path.dirname(os.path.abspath(destDir)), exist_ok=True)
+        execDirs = [d.strip("/") for d in execDirs]
+        dirTimes = []
+        # Destination of each inode with multiple links, so hard links are
+        # restored as hard links
+        hardLinks = {}
+
+        for entryPath, inode in self.walk(path):
+            destPath = os.path.join(destDir, os.path.relpath(entryPath, path)) \
+                if entryPath != path else destDir
+            try:
+                if inode.isDir():
+                    makeDir(destPath, dirMode if dirMode is not None else stat.S_IMODE(inode.mode))
+                    dirTimes.append((destPath, inode))
+                    stats["dirs"] += 1
+                elif inode.isLink():
+                    if os.path.lexists(destPath):
+                        if os.path.islink(destPath) and os.readlink(destPath) == self.readLink(inode):
+                            if links is not None:
+                                links.append(destPath)
+                            continue
+                        os.remove(destPath)
+                    os.symlink(self.readLink(inode), destPath)
+                    stats["links"] += 1
+                    if links is not None:
+                        links.append(destPath)
+                elif inode.isFile():
+                    if inode.ino in hardLinks:
+                        if os.path.lexists(destPath):
+                            os.remove(destPath)
+                        os.link(hardLinks[inode.ino], destPath)
+                        stats["files"] += 1
+                        continue
+                    isExec = any(entryPath == d or entryPath.startswith(d + "/") for d in execDirs)
+                    mode = execMode if isExec else fileMode
+                    result = self.extractFile(inode, destPath, mode)
+                    hardLinks[inode.ino] = destPath
+                    if result is None:
+                        stats["skipped"] += 1
+                    else:
+                        stats["files"] += 1
+                        stats["bytes"] += result
+                        if store is not None:
+                            store.add(destPath)
+                else:
+                    print("WARNING: skipping special file " + entryPath, file=sys.stderr)
+            except (OSError, DumpError) as e:
+                print("ERROR extracting " + entryPath + ": " + str(e), file=sys.stderr)
+                stats["errors"] += 1
+
+        for destPath, inode in dirTimes:
+            try:
+                os.utime(destPath, (inode.atime, inode.mtime))
+            except OSError:
+                pass
+
+        return stats
+
+
+class DumpLinkResolver(LinkResolver):
+    """Link resolver that follows links inside a dump image instead of a
+    directory. Input paths are paths below the image file name (as if the
+    image were the root of the original file system). If the image is a
+    dump of a file system that was mounted below the root (e.g. home),
+    mountPoint is its path"""
+
+    def __init__(self, reader, dirOut, mountPoint="", store=None):
+        LinkResolver.__init__(self, reader.imageFile, dirOut, store=store)
+        self.reader = reader
+        self.mountPoint = mountPoint.strip("/")
+
+    def imagePath(self, pathIn):
+        """Return path inside image for input path, or None if the path is
+        on another file system"""
+        relPath = os.path.relpath(pathIn, self.dirIn)
+        if not self.mountPoint:
+            return relPath
+        if relPath == self.mountPoint:
+            return ""
+        if relPath.startswith(self.mountPoint + "/"):
+            return relPath[len(self.mountPoint) + 1:]
+        return None
+
+    def readLink(self, path):
+        """Return target of path in image if it is a link, or None. Raises
+        Unresolvable if path doesn't exist"""
+        imagePath = self.imagePath(path)
+        inode = None if imagePath is None else self.reader.lookup(imagePath)
+        if inode is None:
+            raise Unresolvable("broken")
+        if not inode.isLink():
+            return None
+        return self.reader.readLink(inode)
+
+    def copyTarget(self, pathIn, pathOut):
+        """Extract resolved link target from image, and return number of
+        bytes written. Links inside an extracted directory are fixed as
+        well. Raises Unresolvable if the target is not in the image"""
+        imagePath = self.imagePath(pathIn)
+        inode = None if imagePath is None else self.reader.lookup(imagePath)
+        if inode is None:
+            raise Unresolvable("broken")
+        self.copied.add(pathIn)
+        if not inode.isDir():
+            os.makedirs(os.path.dirname(pathOut), exist_ok=True)
+            copiedBytes = self.reader.extractFile(inode, pathOut, mode=0o644) or 0
+            if self.store is not None and copiedBytes:
+                self.store.add(pathOut)
+            return copiedBytes
+
+        links = []
+        stats = self.reader.extractTree(imagePath, pathOut, fileMode=0o644,
+                                        dirMode=0o755, links=links, store=self.store)
+        self.fixLinks(links, pathIn, pathOut)
+        return stats["bytes"]
@@ -0,0 +1,360 @@
+"""
+Link-extraction crawl for locally rendered xxLINK sites
+
+The filesystem seed list (see sitecapture.discoverUrls) only contains paths
+that exist under a site's DocumentRoot. The crawl adds URLs that are only
+reachable through links: imagemap (htimage) endpoints, CGI URLs, and links
+to paths that don't exist on disk, on this site or on any other host in the
+same sites.conf. Links are extracted from every fetched HTML page and
+imagemap (.map) file with a streaming tokenizer, and followed breadth
+first, one level (round) at a time.
+
+A link is in scope if its host is a ServerName or ServerAlias of any site in
+the config. Links are canonicalized to the site's main host name; if the
+path exists under that site's DocumentRoot, it is already part of the seed
+list (of this or the other site), so it is not crawled. All other links
+are checked against a seen-set: a scalable Bloom filter, so memory stays
+small and bounded even for very large sites (at the cost of skipping a
+link in a million). The frontier of each round is spooled to a temporary
+file, so it doesn't need to fit in memory either.
+
+"""
+
+import os
+import re
+import math
+import hashlib
+import tempfile
+from html import unescape
+from urllib.parse import urlsplit, urlunsplit, urljoin, unquote_to_bytes, quote
+from warcio.archiveiterator import ArchiveIterator
+from sitecapture import CHUNK_SIZE, URL_SAFE
+
+# Default maximum number of rounds (link depth beyond the seeds), and of
+# crawled URLs per site
+CRAWL_DEPTH = 5
+CRAWL_LIMIT = 100000
+
+# Initial capacity and false positive rate of the seen-set
+SEEN_CAPACITY = 65536
+SEEN_ERROR_RATE = 0.001
+
+# Longest tag that is carried over between chunks
+MAX_TAG = 65536
+
+# Tags and attributes that hold links
+LINK_ATTRIBUTES = {b"a": [b"href"],
+                   b"area": [b"href"],
+                   b"img": [b"src", b"lowsrc"],
+                   b"frame": [b"src"],
+                   b"iframe": [b"src"],
+                   b"body": [b"background"],
+                   b"table": [b"background"],
+                   b"td": [b"background"],
+                   b"th": [b"background"],
+                   b"link": [b"href"],
+                   b"script": [b"src"],
+                   b"embed": [b"src"],
+                   b"bgsound": [b"src"],
+                   b"input": [b"src"],
+                   b"applet": [b"code", b"archive"],
+                   b"form": [b"action"]}
+
+TAG = re.compile(rb"<([a-zA-Z][a-zA-Z0-9]*)([^<>]*)>")
+ATTRIBUTE = re.compile(rb"""([a-zA-Z][-a-zA-Z0-9]*)\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+)""")
+
+# Coordinates in imagemap files: "10,20" (NCSA) or "(10,20)" (CERN)
+COORDINATES = re.compile(r"^\(?-?\d+(,-?\d+)?\)?$")
+MAP_METHODS = ["default", "rect", "circle", "circ", "poly", "point", "base"]
+
+HTML_EXTENSIONS = (".htm", ".html", ".shtml")
+
+# Characters that are kept in links, in addition to those in URL paths
+LINK_SAFE = URL_SAFE + "%?#[]"
+
+
+class TagTokenizer:
+    """Streaming tokenizer that yields (tag, {attribute: value}) for the
+    start tags in chunks of HTML that are fed to it"""
+
+    def __init__(self):
+        self.carry = b""
+
+    def feed(self, chunk):
+        """Yield tags that are complete after adding chunk"""
+        data = self.carry + chunk
+        end = 0
+        for match in TAG.finditer(data):
+            end = match.end()
+            name = match.group(1).lower()
+            if name not in LINK_ATTRIBUTES and name != b"base":
+                continue
+            attributes = {}
+            for attribute in ATTRIBUTE.finditer(match.group(2)):
+                attributes[attribute.group(1).lower()] = attribute.group(2).strip(b"\"'")
+            yield name, attributes
+        # Keep unfinished tag for the next chunk
+        start = data.rfind(b"<", end)
+        self.carry = data[start:] if start != -1 and len(data) - start < MAX_TAG else b""
+
+
+def linkUrl(baseUrl, value):
+    """Return absolute URL of link value (bytes) relative to baseUrl. The
+    link is percent-encoded byte by byte, like the URLs of the files on disk
+    (see sitecapture.pathToUrl); characters from entities that are not
+    Latin-1 are encoded as UTF-8"""
+    text = unescape(value.decode("latin-1")).strip()
+    try:
+        raw = text.encode("latin-1")
+    except UnicodeEncodeError:
+        raw = b"".join(c.encode("latin-1") if ord(c) < 256 else c.encode("utf-8")
+                       for c in text)
+    return urljoin(baseUrl, quote(raw, safe=LINK_SAFE))
+
+
+def htmlLinks(chunks, baseUrl):
+    """Yield absolute URLs of all links in HTML document (iterable of
+    chunks of bytes) at baseUrl"""
+    tokenizer = TagTokenizer()
+    for chunk in chunks:
+        for name, attributes in tokenizer.feed(chunk):
+            if name == b"base":
+                if b"href" in attributes:
+                    baseUrl = linkUrl(baseUrl, attributes[b"href"])
+                continue
+            for attribute in LINK_ATTRIBUTES[name]:
+                value = attributes.get(attribute)
+                if value:
+                    yield linkUrl(baseUrl, value)
+
+
+def mapLinks(chunks, baseUrl):
+    """Yield absolute URLs of all targets in CERN or NCSA imagemap file
+    (iterable of chunks of bytes) at baseUrl"""
+    for line in b"".join(chunks).splitlines():
+        words = line.split(b"#")[0].split()
+        if len(words) < 2 or words[0].decode("latin-1").lower() not in MAP_METHODS:
+            continue
+        for word in words[1:]:
+            if not COORDINATES.match(word.decode("latin-1")):
+                yield linkUrl(baseUrl, word)
+
+
+class BloomFilter:
+    """Bloom filter for capacity items with given false positive rate"""
+
+    def __init__(self, capacity, errorRate):
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, h1, h2):
+        """Return bit positions for hash values h1 and h2 (double hashing)"""
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, h1, h2):
+        """Add item with hash values h1, h2; returns False if it was (probably)
+        there already"""
+        new = False
+        for position in self.positions(h1, h2):
+            mask = 1 << (position & 7)
+            if not self.array[position >> 3] & mask:
+                self.array[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, hashes):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self.positions(*hashes))
+
+
+class SeenSet:
+    """Scalable Bloom filter of URLs: when a filter is full, a new one with
+    twice the capacity (and a tighter error rate) is added, so the overall
+    false positive rate stays below errorRate"""
+
+    def __init__(self, capacity=SEEN_CAPACITY, errorRate=SEEN_ERROR_RATE):
+        self.capacity = capacity
+        self.errorRate = errorRate / 2
+        self.filters = [BloomFilter(capacity, self.errorRate)]
+
+    @staticmethod
+    def hashes(url):
+        """Return two 64 bit hash values of url"""
+        digest = hashlib.blake2b(url.encode("utf-8", "surrogateescape"), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def add(self, url):
+        """Add url; returns True if it was not seen before"""
+        hashes = self.hashes(url)
+        if any(hashes in f for f in self.filters):
+            return False
+        current = self.filters[-1]
+        if current.count >= current.capacity:
+            self.errorRate /= 2
+            current = BloomFilter(current.capacity * 2, self.errorRate)
+            self.filters.append(current)
+        current.add(*hashes)
+        return True
+
+    def __contains__(self, url):
+        hashes = self.hashes(url)
+        return any(hashes in f for f in self.filters)
+
+    def memory(self):
+        """Return number of bytes used by the filters"""
+        return sum(len(f.array) for f in self.filters)
+
+
+class Frontier:
+    """URLs of the next crawl round, spooled to a temporary file"""
+
+    def __init__(self):
+        self.fileOut = tempfile.TemporaryFile("w+", encoding="utf-8", errors="surrogateescape")
+        self.count = 0
+
+    def add(self, url):
+        """Add url to frontier"""
+        self.fileOut.write(url + "\n")
+        self.count += 1
+
+    def urls(self):
+        """Yield all URLs in frontier, and close it"""
+        self.fileOut.seek(0)
+        try:
+            for line in self.fileOut:
+                yield line.rstrip("\n")
+        finally:
+            self.fileOut.close()
+
+
+class Scope:
+    """Host names of all sites in a config, with their main host name and
+    DocumentRoot"""
+
+    def __init__(self, sites):
+        self.hosts = {}
+        for site in sites:
+            if site.documentRoot is None:
+                continue
+            for host in [site.url, site.serverName] + list(site.aliases):
+                self.hosts.setdefault(host.lower(), (site.url.lower(), site.documentRoot))
+
+    def canonical(self, url):
+        """Return canonical form of url (main host name, no fragment or
+        default port) and DocumentRoot of its site, or (None, None) if url is
+        out of scope"""
+        try:
+            parts = urlsplit(url)
+            host = (parts.hostname or "").lower()
+            port = parts.port
+        except ValueError:
+            return None, None
+        if parts.scheme != "http" or host not in self.hosts or port not in [None, 80]:
+            return None, None
+        mainHost, documentRoot = self.hosts[host]
+        return urlunsplit(("http", mainHost, parts.path or "/", parts.query, "")), documentRoot
+
+
+def linkExtractor(url, headers):
+    """Return link extraction function for response with headers (list of
+    (name, value)) for url, or None if it is not an HTML page or imagemap"""
+    contentType = ""
+    for name, value in headers:
+        if name.lower() == "content-type":
+            contentType = value.lower()
+    path = urlsplit(url).path.lower()
+    if contentType.startswith("text/html") or \
+            (not contentType and path.endswith(HTML_EXTENSIONS)):
+        return htmlLinks
+    if path.endswith(".map") and (not contentType or contentType.startswith("text/")):
+        return mapLinks
+    return None
+
+
+def onDisk(url, documentRoot):
+    """Return True if the path of url exists under documentRoot (so it is in
+    the filesystem seed list)"""
+    relPath = unquote_to_bytes(urlsplit(url).path).lstrip(b"/")
+    if b".." in relPath.split(b"/"):
+        return False
+    return os.path.lexists(os.path.join(os.fsencode(documentRoot), relPath))
+
+
+class LinkCrawler:
+    """Extracts links from captured exchanges of one site, and collects the
+    in-scope links that still need to be crawled"""
+
+    def __init__(self, scope, depth=CRAWL_DEPTH, limit=CRAWL_LIMIT):
+        self.scope = scope
+        self.depth = depth
+        self.limit = limit
+        self.seen = SeenSet()
+        self.frontier = Frontier()
+        self.round = 0
+        self.crawled = 0
+        self.links = 0
+
+    def extract(self, exchange):
+        """Add in-scope links of captured exchange (HTML page or imagemap)
+        to the frontier"""
+        self.seen.add(self.scope.canonical(exchange.url)[0] or exchange.url)
+        if exchange.payload is None or not exchange.statusLine.startswith("200"):
+            return
+        extractor = linkExtractor(exchange.url, exchange.headers)
+        if extractor is None:
+            return
+        exchange.payload.seek(0)
+        chunks = iter(lambda: exchange.payload.read(CHUNK_SIZE), b"")
+        self.addLinks(extractor(chunks, exchange.url))
+
+    def extractWarc(self, warcFile):
+        """Add in-scope links of the pages in existing WARC file (a segment
+        of a capture that is resumed) to the frontier. Pages that were
+        written as revisit records are not parsed"""
+        with open(warcFile, "rb") as fIn:
+            for record in ArchiveIterator(fIn):
+                if record.rec_type not in ["response", "revisit"]:
+                    continue
+                url = record.rec_headers.get_header("WARC-Target-URI")
+                self.seen.add(self.scope.canonical(url)[0] or url)
+                if (record.rec_type != "response" or record.http_headers is None or
+                        record.http_headers.get_statuscode() != "200"):
+                    continue
+                extractor = linkExtractor(url, record.http_headers.headers)
+                if extractor is None:
+                    continue
+                stream = record.content_stream()
+                self.addLinks(extractor(iter(lambda: stream.read(CHUNK_SIZE), b""), url))
+
+    def addLinks(self, links):
+        """Add in-scope links that are not on disk and weren't seen before
+        to the frontier"""
+        for link in links:
+            self.links += 1
+            url, documentRoot = self.scope.canonical(link)
+            if url is None or onDisk(url, documentRoot):
+                continue
+            if self.seen.add(url):
+                self.frontier.add(url)
+
+    def rounds(self):
+        """Yield iterable of URLs for each crawl round, until the frontier is
+        empty, or the depth or URL limit is reached"""
+        while self.frontier.count and self.round < self.depth and self.crawled < self.limit:
+            self.round += 1
+            current = self.frontier
+            self.frontier = Frontier()
+            yield self.limited(current.urls())
+        self.frontier.fileOut.close()
+
+    def limited(self, urls):
+        """Yield urls up to the URL limit"""
+        for url in urls:
+            if self.crawled >= self.limit:
+                return
+            self.crawled += 1
+            yield url
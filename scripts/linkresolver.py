@@ -0,0 +1,228 @@
+"""
+Symbolic link resolution for restored xxLINK sites
+
+Sites on the tapes contain many absolute links into the original file
+system (e.g. /home/local/www/shared/...), which are broken once the site
+is copied to its output location. The resolver follows each such link
+inside the input tree (treating the input directory as the file system
+root), copies the data it finally points to into the output tree, and
+updates the link. Resolution results are cached for the whole run, so a
+target that many links (in many sites) point to is resolved and copied
+only once. Chains of links are followed, and link cycles are detected.
+Targets that are part of a restored site are not copied at all; links to
+them are pointed at the site's output directory instead.
+
+"""
+
+import os
+import sys
+import csv
+import stat
+import threading
+from copyengine import copyTree, copyFile
+
+# Maximum number of links followed while resolving one path (same as Linux)
+MAX_HOPS = 40
+
+REPORT_FIELDS = ["link", "target", "resolved", "status", "copiedBytes"]
+
+
+class Unresolvable(Exception):
+    """Raised when a link can't be resolved; args[0] is the reason"""
+
+
+class LinkResolver:
+    """Resolves and fixes links in the output tree of one tape"""
+
+    def __init__(self, dirIn, dirOut, manifest=None, store=None):
+        self.dirIn = os.path.abspath(dirIn)
+        self.dirOut = os.path.abspath(dirOut)
+        self.manifest = manifest
+        self.store = store
+        # Resolved real path (or Unresolvable) of each link in the input tree
+        self.cache = {}
+        # Input directories and files that were copied in this run
+        self.copied = set()
+        # (sourceDir, destDir) pairs of restored sites
+        self.trees = []
+        self.report = []
+        # Sites may be restored in parallel; links are fixed one site at a
+        # time, so each target is still copied only once
+        self.lock = threading.RLock()
+
+    def addTree(self, sourceDir, destDir):
+        """Register restored site tree; links into it are pointed at its
+        output directory, and its data is not copied again"""
+        self.trees.append((os.path.abspath(sourceDir), os.path.abspath(destDir)))
+
+    def walk(self, current, target, hops):
+        """Return real path inside input tree of target, relative to real
+        directory current (or to the input root if target is absolute)"""
+        if os.path.isabs(target):
+            current = self.dirIn
+        for part in target.split("/"):
+            if part in ["", "."]:
+                continue
+            if part == "..":
+                if current != self.dirIn:
+                    current = os.path.dirname(current)
+                continue
+            current = self.resolveEntry(os.path.join(current, part), hops)
+        return current
+
+    def resolveEntry(self, path, hops=0):
+        """Return real path of path, whose parent directory is a real path
+        inside the input tree"""
+        cached = self.cache.get(path)
+        if isinstance(cached, Unresolvable):
+            raise cached
+        if cached is not None:
+            return cached
+
+        linkTarget = self.readLink(path)
+        if linkTarget is None:
+            return path
+
+        if hops >= MAX_HOPS:
+            # Cycle, or a chain that is too long to be meaningful
+            error = Unresolvable("cycle")
+            self.cache[path] = error
+            raise error
+
+        try:
+            resolved = self.walk(os.path.dirname(path), linkTarget, hops + 1)
+        except Unresolvable as e:
+            self.cache[path] = e
+            raise
+        self.cache[path] = resolved
+        return resolved
+
+    def readLink(self, path):
+        """Return target of path in input tree if it is a link, or None.
+        Raises Unresolvable if path doesn't exist"""
+        try:
+            pathStat = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            raise Unresolvable("broken")
+        if not stat.S_ISLNK(pathStat.st_mode):
+            return None
+        return os.readlink(path)
+
+    def outPath(self, pathIn):
+        """Return output path for real input path, and True if it is part of
+        a restored site"""
+        for sourceDir, destDir in self.trees:
+            if pathIn == sourceDir or pathIn.startswith(sourceDir + os.sep):
+                return destDir + pathIn[len(sourceDir):], True
+        relPath = os.path.relpath(pathIn, self.dirIn)
+        if relPath.startswith("home" + os.sep):
+            relPath = relPath[len("home" + os.sep):]
+        return os.path.join(self.dirOut, relPath), False
+
+    def isCopied(self, pathIn):
+        """Return True if pathIn or one of its parents was copied before"""
+        while pathIn != self.dirIn and len(pathIn) > len(self.dirIn):
+            if pathIn in self.copied:
+                return True
+            pathIn = os.path.dirname(pathIn)
+        return False
+
+    def copyTarget(self, pathIn, pathOut):
+        """Copy data of resolved link target, and return number of bytes
+        copied. Links inside a copied directory are fixed as well"""
+        self.copied.add(pathIn)
+        if not os.path.isdir(pathIn):
+            os.makedirs(os.path.dirname(pathOut), exist_ok=True)
+            copiedBytes = copyFile(pathIn, pathOut, update=True, mode=0o644) or 0
+            if self.store is not None and copiedBytes:
+                self.store.add(pathOut)
+            return copiedBytes
+
+        links = []
+        stats = copyTree(pathIn, pathOut, update=True, fileMode=0o644, dirMode=0o755,
+                         manifest=self.manifest, links=links, store=self.store)
+        self.fixLinks(links, pathIn, pathOut)
+        return stats["bytes"]
+
+    def needsFix(self, link):
+        """Return True if link is absolute (so it points into the original
+        file system, or was fixed by an earlier restore and its target may
+        need updating), or broken"""
+        return os.path.isabs(os.readlink(link)) or not os.path.exists(link)
+
+    def fixLink(self, link, sourceLink):
+        """Resolve link (in output tree) through its original sourceLink (in
+        input tree), copy its target if needed, and update link"""
+        try:
+            target = self.readLink(sourceLink)
+        except Unresolvable:
+            target = None
+        if target is None:
+            target = os.readlink(link)
+        if not self.needsFix(link):
+            self.report.append([link, target, os.path.realpath(link), "ok", 0])
+            return
+
+        try:
+            if not sourceLink.startswith(self.dirIn + os.sep):
+                raise Unresolvable("outside")
+            pathIn = self.walk(os.path.dirname(sourceLink), os.path.basename(sourceLink), 0)
+            if pathIn == self.dirIn:
+                # Link to the root of the original file system
+                raise Unresolvable("outside")
+        except Unresolvable as e:
+            self.report.append([link, target, "", e.args[0], 0])
+            return
+
+        pathOut, inSite = self.outPath(pathIn)
+        copiedBytes = 0
+        if inSite:
+            status = "site"
+        elif self.isCopied(pathIn):
+            status = "cached"
+        else:
+            status = "copied"
+            try:
+                copiedBytes = self.copyTarget(pathIn, pathOut)
+            except Unresolvable as e:
+                self.report.append([link, target, "", e.args[0], 0])
+                return
+            except OSError as e:
+                print("ERROR copying " + pathIn + ": " + str(e), file=sys.stderr)
+                self.report.append([link, target, pathOut, "error", 0])
+                return
+
+        linkTmp = os.path.join(os.path.dirname(link), ".templink")
+        try:
+            os.symlink(pathOut, linkTmp)
+            os.replace(linkTmp, link)
+        except OSError as e:
+            print("ERROR updating symlink " + link + ": " + str(e), file=sys.stderr)
+            status = "error"
+        self.report.append([link, target, pathOut, status, copiedBytes])
+
+    def fixLinks(self, links, sourceDir, destDir):
+        """Fix links (in destDir, which is a copy of sourceDir)"""
+        sourceDir = os.path.abspath(sourceDir)
+        destDir = os.path.abspath(destDir)
+        with self.lock:
+            for link in links:
+                if not os.path.islink(link):
+                    continue
+                sourceLink = sourceDir + os.path.abspath(link)[len(destDir):]
+                self.fixLink(link, sourceLink)
+
+    def writeReport(self, reportFile):
+        """Write link report as CSV"""
+        with open(reportFile, "w", encoding="utf-8", errors="surrogateescape",
+                  newline="") as fOut:
+            writer = csv.writer(fOut)
+            writer.writerow(REPORT_FIELDS)
+            writer.writerows(self.report)
+
+    def summary(self):
+        """Return dictionary with number of links for each status"""
+        counts = {}
+        for row in self.report:
+            counts[row[3]] = counts.get(row[3], 0) + 1
+        return counts
@@ -0,0 +1,165 @@
+"""
+Restore manifest for incremental restores of xxLINK sites
+
+The manifest records every directory, file and symbolic link that was
+written to an output tree, together with the size and modification time of
+its source, the permission bits it was given, and (optionally) the SHA-1 of
+its contents. When a tape is restored again into the same output tree, the
+copy engine compares the source against the manifest instead of the
+destination, so unchanged files, links and directories aren't touched at
+all. Paths are stored relative to the output tree.
+
+"""
+
+import os
+import csv
+import time
+import hashlib
+import threading
+
+# Manifest file name, relative to the output tree
+MANIFEST_NAME = "etc/restore-manifest.csv"
+
+FIELDS = ["path", "type", "size", "mtime", "mode", "hash", "target"]
+
+# Read size for hashing
+HASH_CHUNK_SIZE = 1048576
+
+# Minimum number of seconds between intermediate saves of the manifest
+SAVE_INTERVAL = 60
+
+
+def fileHash(path):
+    """Return SHA-1 of file contents as hex string"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fIn:
+        for chunk in iter(lambda: fIn.read(HASH_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ManifestEntry:
+    """Manifest record of one directory ("d"), file ("f") or link ("l")"""
+
+    __slots__ = ["kind", "size", "mtime", "mode", "digest", "target"]
+
+    def __init__(self, kind, size=0, mtime=0, mode=0, digest="", target=""):
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.digest = digest
+        self.target = target
+
+
+class Manifest:
+    """Manifest of an output tree"""
+
+    def __init__(self, rootDir, useHash=False, rescan=False, manifestFile=None):
+        self.rootDir = os.path.abspath(rootDir)
+        self.useHash = useHash
+        # With rescan, nothing is considered unchanged, so all destination
+        # entries are checked again (the manifest is still updated)
+        self.rescan = rescan
+        if manifestFile is None:
+            manifestFile = os.path.join(self.rootDir, MANIFEST_NAME)
+        self.manifestFile = manifestFile
+        self.entries = {}
+        # Paths that were checked against their source in this run
+        self.seen = set()
+        # Sites may be restored in parallel
+        self.lock = threading.Lock()
+        self.lastSave = time.time()
+
+    def load(self):
+        """Read manifest file, if it exists"""
+        if not os.path.isfile(self.manifestFile):
+            return
+        with open(self.manifestFile, "r", encoding="utf-8", errors="surrogateescape",
+                  newline="") as fIn:
+            for row in csv.DictReader(fIn):
+                self.entries[row["path"]] = ManifestEntry(row["type"],
+                                                          int(row["size"]),
+                                                          int(row["mtime"]),
+                                                          int(row["mode"], 8),
+                                                          row["hash"],
+                                                          row["target"])
+
+    def save(self):
+        """Write manifest file (atomically, so an interrupted restore leaves
+        the previous manifest intact)"""
+        os.makedirs(os.path.dirname(self.manifestFile), exist_ok=True)
+        tmpOut = self.manifestFile + ".tmp"
+        with open(tmpOut, "w", encoding="utf-8", errors="surrogateescape",
+                  newline="") as fOut:
+            writer = csv.writer(fOut)
+            writer.writerow(FIELDS)
+            with self.lock:
+                entries = sorted(self.entries.items())
+            for path, e in entries:
+                writer.writerow([path, e.kind, e.size, e.mtime, "%o" % e.mode,
+                                 e.digest, e.target])
+        os.replace(tmpOut, self.manifestFile)
+        self.lastSave = time.time()
+
+    def checkpoint(self):
+        """Save manifest if the last save was more than SAVE_INTERVAL seconds
+        ago, so an interrupted restore keeps most of its progress without
+        rewriting the whole manifest after every site"""
+        if time.time() - self.lastSave >= SAVE_INTERVAL:
+            self.save()
+
+    def relPath(self, destPath):
+        """Return manifest key for destPath"""
+        return os.path.relpath(os.path.abspath(destPath), self.rootDir)
+
+    def get(self, destPath):
+        """Return entry for destPath, or None if it is not in the manifest;
+        marks destPath as seen"""
+        key = self.relPath(destPath)
+        self.seen.add(key)
+        return self.entries.get(key)
+
+    def set(self, destPath, entry):
+        """Store entry for destPath"""
+        key = self.relPath(destPath)
+        with self.lock:
+            self.seen.add(key)
+            self.entries[key] = entry
+
+    def isUnchanged(self, destPath, kind, sourceStat, mode):
+        """Return True if destPath was restored from a source with the same
+        size and modification time, and was given permission bits mode
+        (None matches any mode)"""
+        entry = self.get(destPath)
+        if self.rescan or entry is None or entry.kind != kind:
+            return False
+        if entry.mtime != sourceStat.st_mtime_ns:
+            return False
+        if kind == "f" and entry.size != sourceStat.st_size:
+            return False
+        if kind == "f" and self.useHash and not entry.digest:
+            return False
+        return mode is None or entry.mode == mode
+
+    def isUnchangedLink(self, destPath, target):
+        """Return True if destPath was restored from a link to target"""
+        entry = self.get(destPath)
+        if self.rescan or entry is None:
+            return False
+        return entry.kind == "l" and entry.target == target
+
+    def isKnown(self, destPath):
+        """Return True if destPath is in the manifest"""
+        return self.relPath(destPath) in self.entries
+
+    def prune(self, destDir):
+        """Remove entries below destDir that weren't seen in this run (their
+        source no longer exists), and return number of removed entries"""
+        prefix = self.relPath(destDir) + os.sep
+        with self.lock:
+            removed = [path for path in self.entries
+                       if path.startswith(prefix) and path not in self.seen]
+            for path in removed:
+                del self.entries[path]
+        return len(removed)
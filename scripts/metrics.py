@@ -0,0 +1,279 @@
+"""
+Per-stage timing and throughput metrics
+
+The restore and capture scripts time the stages of each site (e.g. parse,
+walk, copy, fixSymLinks for restores; walk, fetch, write for captures),
+with counters of files, bytes, errors and retries. When a site is done, one
+record per stage (and a "total" record) is appended to a metrics file as a
+JSON line, with the throughput of the stage. The file is opened in append
+mode, so several scripts and processes (e.g. a batch run) can share it.
+
+While a script is running on a terminal, a one-line progress display shows
+the number of sites done, the current stages, and the files and bytes
+processed so far. Other messages to stderr are printed above it.
+
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from siteinventory import formatDuration
+
+# Minimum number of seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+# Counters that are reported as throughput (per second)
+RATE_COUNTERS = ["files", "bytes"]
+
+
+class Progress:
+    """One-line live progress display on a terminal. While it is active, it
+    replaces sys.stderr, so other messages are printed above the progress
+    line. Messages from child processes are passed through unchanged"""
+
+    def __init__(self, stream=None, interval=PROGRESS_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.line = ""
+        self.shown = False
+        self.lastUpdate = 0.0
+        self.pid = os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def start(self):
+        """Replace sys.stderr"""
+        sys.stderr = self
+
+    def clear(self):
+        """Remove progress line from terminal"""
+        if self.shown:
+            self.stream.write("\r\x1b[K")
+            self.shown = False
+
+    def draw(self):
+        """Show progress line"""
+        if self.line:
+            self.stream.write("\r" + self.line + "\x1b[K")
+            self.stream.flush()
+            self.shown = True
+
+    def write(self, text):
+        if os.getpid() != self.pid:
+            return self.stream.write(text)
+        with self.lock:
+            self.clear()
+            result = self.stream.write(text)
+            if text.endswith("\n"):
+                self.draw()
+            return result
+
+    def flush(self):
+        self.stream.flush()
+
+    def update(self, line, force=False):
+        """Replace progress line (at most once per interval, unless forced)"""
+        now = time.monotonic()
+        if not force and now - self.lastUpdate < self.interval:
+            return
+        with self.lock:
+            self.lastUpdate = now
+            self.line = line[:self.width()]
+            self.clear()
+            self.draw()
+
+    def width(self):
+        """Return usable width of terminal"""
+        try:
+            columns = os.get_terminal_size(self.stream.fileno()).columns
+        except (OSError, ValueError):
+            columns = 0
+        return columns - 1 if columns > 1 else 79
+
+    def close(self):
+        """Remove progress line, and restore sys.stderr"""
+        with self.lock:
+            self.clear()
+            self.line = ""
+        if sys.stderr is self:
+            sys.stderr = self.stream
+
+
+class SiteMetrics:
+    """Timings and counters of the stages of one site"""
+
+    def __init__(self, metrics, site):
+        self.metrics = metrics
+        self.site = site
+        # Stage name: {"seconds": ..., counter: value}, in order of first use
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that times stage name"""
+        self.metrics.enter(self.site, name)
+        timeStart = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - timeStart)
+            self.metrics.leave(self.site, name)
+
+    def add(self, name, seconds=0.0, **counters):
+        """Add seconds and counters to stage name"""
+        with self.metrics.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0})
+            stage["seconds"] += seconds
+            for counter, value in counters.items():
+                stage[counter] = stage.get(counter, 0) + value
+
+    def tick(self, files=0, bytes=0):
+        """Add files and bytes that were just processed to the live totals"""
+        self.metrics.tick(files, bytes)
+
+    def finish(self, seconds=None):
+        """Write records of all stages, and a total record for the site
+        (which took seconds, or the sum of its stages)"""
+        total = {"seconds": 0.0}
+        for name, stage in self.stages.items():
+            self.metrics.write(self.site, name, stage)
+            total["seconds"] += stage["seconds"]
+            for counter in ["errors", "retries"]:
+                if counter in stage:
+                    total[counter] = total.get(counter, 0) + stage[counter]
+        if seconds is not None:
+            total["seconds"] = seconds
+        self.metrics.write(self.site, "total", total)
+        if self.site is not None:
+            self.metrics.siteDone()
+
+
+def timed(items, metrics, name):
+    """Yield items from iterable, and add the time spent producing them and
+    their number (as files) to stage name of metrics (SiteMetrics)"""
+    seconds = 0.0
+    count = 0
+    itemsIter = iter(items)
+    try:
+        while True:
+            timeStart = time.perf_counter()
+            try:
+                item = next(itemsIter)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - timeStart
+            count += 1
+            yield item
+    finally:
+        metrics.add(name, seconds, files=count)
+
+
+class Metrics:
+    """Writes stage records of all sites of a run to a JSON-lines file (if
+    metricsFile is given), and keeps a live progress line (if progress is
+    True, or None and stderr is a terminal)"""
+
+    def __init__(self, metricsFile=None, script=None, tape=None, sites=0, progress=None):
+        self.metricsFile = metricsFile
+        self.script = script or os.path.basename(sys.argv[0])
+        self.tape = tape
+        self.sitesTotal = sites
+        self.sitesDone = 0
+        self.files = 0
+        self.bytes = 0
+        self.active = []
+        self.timeStart = time.time()
+        self.lock = threading.RLock()
+        self.fileOut = None
+        if metricsFile is not None:
+            self.fileOut = open(metricsFile, "a", encoding="utf-8")
+        if progress is None:
+            progress = sys.stderr.isatty()
+        self.progress = None
+        if progress:
+            self.progress = Progress()
+            self.progress.start()
+
+    def site(self, name):
+        """Return SiteMetrics for site name (None for the tape as a whole)"""
+        return SiteMetrics(self, name)
+
+    def write(self, site, stage, values):
+        """Append record of stage of site to metrics file"""
+        if self.fileOut is None:
+            return
+        record = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                  "script": self.script, "tape": self.tape, "site": site, "stage": stage}
+        record.update(values)
+        seconds = record["seconds"]
+        record["seconds"] = round(seconds, 3)
+        for counter in RATE_COUNTERS:
+            if counter in values and seconds > 0:
+                record[counter + "PerSecond"] = round(values[counter] / seconds, 1)
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.fileOut.write(line)
+            self.fileOut.flush()
+
+    def enter(self, site, stage):
+        """Register start of stage of site"""
+        with self.lock:
+            self.active.append((site, stage))
+        self.refresh(force=True)
+
+    def leave(self, site, stage):
+        """Register end of stage of site"""
+        with self.lock:
+            self.active.remove((site, stage))
+        self.refresh()
+
+    def tick(self, files=0, bytes=0):
+        """Add files and bytes to live totals"""
+        with self.lock:
+            self.files += files
+            self.bytes += bytes
+        self.refresh()
+
+    def siteDone(self):
+        """Register completed site"""
+        with self.lock:
+            self.sitesDone += 1
+        self.refresh(force=True)
+
+    def line(self):
+        """Return progress line"""
+        elapsed = time.time() - self.timeStart
+        with self.lock:
+            parts = ["{}/{} sites".format(self.sitesDone, self.sitesTotal)]
+            if self.active:
+                site, stage = self.active[-1]
+                current = stage if site is None else stage + " " + site
+                if len(self.active) > 1:
+                    current += " (+{})".format(len(self.active) - 1)
+                parts.append(current)
+            rate = self.bytes / elapsed if elapsed > 0 else 0
+            parts.append("{} files, {:.1f} MB ({:.1f} MB/s)".format(self.files, self.bytes / 1e6,
+                                                                     rate / 1e6))
+        parts.append(formatDuration(elapsed))
+        return " | ".join(parts)
+
+    def refresh(self, force=False):
+        """Update progress line"""
+        if self.progress is not None:
+            self.progress.update(self.line(), force)
+
+    def close(self):
+        """Close metrics file and progress line"""
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+        if self.fileOut is not None:
+            self.fileOut.close()
+            self.fileOut = None
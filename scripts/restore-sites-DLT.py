@@ -15,12 +15,16 @@ NOTE: running as sudo is needed bc of permissions set in source data.
 
 import os
 import sys
-import csv
+import time
 import argparse
-import subprocess as sub
-from shutil import which
-from shutil import copyfile
-from distutils.dir_util import copy_tree
+from copyengine import copyTree
+from manifest import Manifest
+from linkresolver import LinkResolver
+from contentstore import ContentStore, MODES
+from siteinventory import Eta
+from metrics import Metrics
+from scheduler import siteJobs, printPlan, runLargestFirst, loadTimings, saveTimings
+from siteconfig import readConfig, mapSites, WWW_APACHE
 
 
 def parseCommandLine(parser):
@@ -34,6 +38,46 @@ def parseCommandLine(parser):
                         action='store',
                         type=str,
                         help='output directory')
+    parser.add_argument('--rescan',
+                        action='store_true',
+                        help='ignore restore manifest of previous run, and check all \
+                        destination files')
+    parser.add_argument('--hash',
+                        action='store_true',
+                        help='store SHA-1 of each restored file in restore manifest')
+    parser.add_argument('--store',
+                        action='store',
+                        type=str,
+                        help='content store directory (on the same volume as dirOut); \
+                        restored files with the same content as a stored file are \
+                        replaced by links to it')
+    parser.add_argument('--store-mode',
+                        action='store',
+                        choices=MODES,
+                        default='hardlink',
+                        help='how duplicates are linked to the content store (default: hardlink)')
+    parser.add_argument('--inventory',
+                        action='store',
+                        type=str,
+                        help='site inventory index file; sites that are not in it are \
+                        walked first, and sites are restored largest first, with an \
+                        estimate of the remaining time')
+    parser.add_argument('--jobs', '-j',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of sites that are restored in parallel; sites are \
+                        dispatched longest first, by their time in the previous run or \
+                        their size in the inventory (default: 1)')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only print the planned schedule and predicted run time \
+                        (sites are walked first if there is no inventory)')
+    parser.add_argument('--metrics',
+                        action='store',
+                        type=str,
+                        help='append timings and counters of each stage of each site to \
+                        this JSON-lines file')
 
     # Parse arguments
     arguments = parser.parse_args()
@@ -47,122 +91,53 @@ def errorExit(msg):
     sys.exit(1)
 
 
-def readConfigDir(dirIn, dirOut):
+def readConfigDir(dirIn, wwwOut):
     """
-    Read config dir, filter site config files and return
-    list with dictionary for each site
+    Read config dir (resolving Include directives), and return
+    list of sites that can be restored
     """
 
     configDirIn = os.path.join(dirIn, "apache.intel/conf/configdb")
 
-    # List that holds individual site dictionaries
-    sites = []
-
-    if os.path.exists(configDirIn):
-        for path in os.listdir(configDirIn):
-            thisPath = os.path.join(configDirIn, path)
-            if os.path.isfile(thisPath):
-                siteInfo = readApacheConfig(thisPath, dirIn, dirOut)
-                if siteInfo["isApacheConfig"]:
-                    sites.append(siteInfo)
-    return sites
-
-
-def readApacheConfig(configFile, dirIn, dirOut):
-    """
-    Read Apache config file, extract interesting bits and return
-    them in dictionary
-    """
-
-    siteInfo = {}
-    isApacheConfig = False
+    if not os.path.isdir(configDirIn):
+        print("WARNING: directory " + configDirIn + " does not exist", file=sys.stderr)
+        return []
 
-    with open(configFile) as configIn:
-        # TODO: Include RewriteRule entries?
-        for line in configIn:
-            if line.startswith("<VirtualHost"):
-                isApacheConfig = True
-            if line.startswith("DocumentRoot"):
-                DocumentRoot = line.split()[1].strip()
-                siteInfo["DocumentRoot"] = DocumentRoot
-            if line.startswith("ServerName"):
-                ServerName = line.split()[1].strip()
-                siteInfo["ServerName"] = ServerName
-
-    siteInfo["isApacheConfig"] = isApacheConfig
-
-    return siteInfo
+    sites = readConfig(configDirIn, "apache", root=dirIn)
+    return mapSites(sites, WWW_APACHE, os.path.join(dirIn, "www"), wwwOut)
 
 def writeConfig(site, configOut, hostsOut):
     """Write output Apache config records for site"""
 
     with open(configOut, "a", encoding="utf-8") as cOut:
         cOut.write("<VirtualHost *:80>\n")
-        cOut.write("ServerName " + site["ServerName"] + "\n")
-        cOut.write("DocumentRoot " + site["pathOut"] + "\n")
+        cOut.write("ServerName " + site.serverName + "\n")
+        cOut.write("DocumentRoot " + site.pathOut + "\n")
         cOut.write("</VirtualHost>" + "\n\n")
 
     with open(hostsOut, "a", encoding="utf-8") as hOut:
-        hOut.write("127.0.0.1 " + site["ServerName"] + "\n")
-        hOut.write("127.0.0.1 " + "http://" + site["ServerName"] + "\n")
+        hOut.write("127.0.0.1 " + site.serverName + "\n")
+        hOut.write("127.0.0.1 " + "http://" + site.serverName + "\n")
         #hOut.write("\n\n")
 
-def fixSymLinks(folder, dirIn, dirOut):
-    for root, _, files in os.walk(folder):
-        for f in files:
-            thisFile = os.path.join(root, f)
-            try:
-                os.stat(thisFile)
-            except OSError:
-                # Read link target
-                linkTarget = os.readlink(thisFile)
-                #print(thisFile, linkTarget, file=sys.stderr)
-                
-                # Leave relative links unchanged, update absolute links to input 
-                # and output paths
-                if os.path.isabs(linkTarget):
-                    linkTargetIn = os.path.join(dirIn, linkTarget[1:])                    
-                else:
-                    linkTargetIn = os.path.join(root, linkTarget)
-                    #print("linkTarget: " + linkTarget + "linkTargetIn: " + linkTargetIn, file=sys.stderr)
-
-                linkTargetOut = os.path.join(dirOut, linkTarget.replace("/home/", ""))
-                #print("linkTargetOut: " + linkTargetOut, file=sys.stderr)
-
-                if os.path.isdir(linkTargetIn):
-                    # Copy directory to outDir
-                    try:
-                        copy_tree(linkTargetIn, linkTargetOut, verbose=1, update=1, preserve_symlinks=1)
-                    except:
-                        print("ERROR copying " + linkTargetIn, file=sys.stderr)
-                        #raise
-                elif os.path.isfile(linkTargetIn):
-                    try:
-                        copyfile(linkTargetIn, linkTargetOut)
-                    except:
-                        print("ERROR copying " + linkTargetIn, file=sys.stderr)
-                        #raise
-
-                # Update symlink
-                try:
-                    linkTmp = os.path.join(root, "templink")
-                    os.symlink(linkTargetOut, os.path.join(root, linkTmp))
-                    os.replace(linkTmp, thisFile)
-                except UnboundLocalError:
-                    print("ERROR updating symlink %s" % linkTargetIn, file=sys.stderr)
-
-
-def copyFiles(site, dirIn, dirOut):
+def copyFiles(site, resolver, manifest=None, store=None, metrics=None):
     """Copy site's folder structure and apply correct permissions:
     - Dirs to 755
     - Files in source dir to 644
     - Files in exec (cgi-bin) dirs to 755
+    Permissions are set while copying, so the copy isn't walked again.
+    With a restore manifest, only entries that changed since the previous
+    restore are copied. Links are fixed by resolver. With a content store,
+    duplicate files are replaced by links to the stored copy. Stages are
+    timed with metrics (SiteMetrics)
     """
-    sourceDir = os.path.abspath(site["pathIn"])
-    destDir = os.path.abspath(site["pathOut"])
-    #execDirs = site["execPaths"]
+    if metrics is None:
+        metrics = Metrics(progress=False).site(site.serverName)
+    sourceDir = os.path.abspath(site.pathIn)
+    destDir = os.path.abspath(site.pathOut)
+    #execDirs = site.execPaths
 
-    print("====== PROCESSING SITE " + site["ServerName"], file=sys.stderr)
+    print("====== PROCESSING SITE " + site.serverName, file=sys.stderr)
     print("====== PROCESSING SOURCE DIR " + sourceDir, file=sys.stderr)
     ## TEST
     #print("sourceDir : " + sourceDir + "\n destDir: " + destDir)
@@ -170,33 +145,28 @@ def copyFiles(site, dirIn, dirOut):
 
     # Source dir tree
     if os.path.exists(sourceDir):
+        links = []
 
         try:
-            # Note copy_tree by default aborts on broken symlinks, hence preserve_symlinks=1
-            # However this means that these broken  
-            copy_tree(sourceDir, destDir, verbose=1, update=1, preserve_symlinks=1)
+            # Symlinks are copied as links; broken ones are fixed below.
+            # Permissions are set while copying, so there is no chmod stage
+            with metrics.stage("copy"):
+                copyStats = copyTree(sourceDir, destDir, update=True,
+                                     fileMode=0o644, dirMode=0o755, manifest=manifest,
+                                     links=links, store=store, progress=metrics.tick)
+            metrics.add("copy", **copyStats)
+            print("Copied {files} files ({bytes} bytes), {links} links, {dirs} dirs; "
+                  "skipped {skipped} up-to-date files; {removed} entries gone from source; "
+                  "{errors} errors".format(**copyStats),
+                  file=sys.stderr)
         except:
             print("ERROR copying " + sourceDir, file=sys.stderr)
+            metrics.add("copy", errors=1)
 
-        # Search destination dir for broken symbolic links, fix them and copy
-        # underlying data
-        fixSymLinks(destDir, dirIn, dirOut)
-
-        # Update permissions
-        for root, dirs, files in os.walk(destDir):
-            for d in dirs:
-                thisDir = os.path.join(root, d)
-                try:
-                    os.chmod(thisDir, 0o755)
-                except OSError:
-                    print("ERROR updating permissions for directory " + thisDir, file=sys.stderr)
-
-            for f in files:
-                thisFile = os.path.join(root, f)
-                try:
-                    os.chmod(thisFile, 0o644)
-                except OSError:
-                    print("ERROR updating permissions for file " + thisFile, file=sys.stderr)
+        # Fix broken and absolute symbolic links, and copy underlying data
+        with metrics.stage("fixSymLinks"):
+            resolver.fixLinks(links, sourceDir, destDir)
+        metrics.add("fixSymLinks", links=len(links))
     else:
         print("WARNING: directory " + sourceDir + " does not exist", file=sys.stderr)
 
@@ -210,64 +180,101 @@ def main():
     dirIn = os.path.abspath(args.dirIn)
     dirOut = os.path.abspath(args.dirOut)
 
-    # String constants
-    DocumentRootPrefix = "/export/home/local/www"
-    wwwIn = os.path.join(dirIn, "www")
-    wwwOut = os.path.join(dirOut, "www")
-
     # Dir, files for output config
     dirOutEtc = os.path.join(dirOut, "etc")
     httpdConfOut = os.path.join(dirOutEtc, "sites.conf")
     hostsOut = os.path.join(dirOutEtc, "hosts")
-
-    # Read info on sites from config file
-    #sites = readApacheConfig(dirIn, dirOut)
-    sites = readConfigDir(dirIn, dirOut)
-
+    timingsOut = os.path.join(dirOutEtc, "restore-times.csv")
+
+    # Read info on sites from config dir. Sites without ServerName or
+    # DocumentRoot (mostly .xxLINK domains) are skipped; DocumentRoot entries
+    # that are imported with Include (www.hospitalitynet.org) are resolved
+    timeStart = time.perf_counter()
+    sites = readConfigDir(dirIn, os.path.join(dirOut, "www"))
+    parseSeconds = time.perf_counter() - timeStart
+
+    # Only print the schedule
+    if args.dry_run:
+        jobs, _ = siteJobs(sites, lambda site: site.pathIn, timingsOut, args.inventory,
+                           args.rescan, prescan=True)
+        printPlan(jobs, args.jobs)
+        return
 
     # Create output etc directory
     if not os.path.exists(dirOutEtc):
         os.makedirs(dirOutEtc)
 
+    # Timings of each stage
+    metrics = Metrics(args.metrics, tape=os.path.basename(dirOut), sites=len(sites))
+    tapeMetrics = metrics.site(None)
+    tapeMetrics.add("parse", parseSeconds)
+
+    # Restore manifest of output tree
+    manifest = Manifest(dirOut, useHash=args.hash, rescan=args.rescan)
+    manifest.load()
+
+    # Content store for deduplication
+    store = None
+    if args.store is not None:
+        try:
+            store = ContentStore(args.store, args.store_mode)
+        except OSError as e:
+            errorExit("cannot use content store " + args.store + ": " + str(e))
+
+    # Link resolver, shared by all sites
+    resolver = LinkResolver(dirIn, dirOut, manifest, store)
+
     # Remove output config files they already exist
     if os.path.isfile(httpdConfOut):
         os.remove(httpdConfOut)
     if os.path.isfile(hostsOut):
         os.remove(hostsOut)
 
-    ## TODO: in some case either ServerName or DocumentRoot are missing from config
-    # file. Mostly happens for .xxLINK domains, but also for www.hospitalitynet.org
-    # which imports a value using INCLUDE file. For now ignore these.
-
     for site in sites:
-        hasServerName = True
-        hasDocumentRoot = True
-        try:
-            ServerName = site["ServerName"]
-        except KeyError:
-            hasServerName = False
-        try:
-            DocumentRoot = site["DocumentRoot"]
-        except KeyError:
-            if ServerName == "www.hospitalitynet.org":
-                # Fix for missing DocumentRoot hospitalitynet
-                DocumentRoot = "/export/home/local/www/hospitorg/root"
-            else:
-                hasDocumentRoot = False
-        
-        if hasServerName and hasDocumentRoot:
-            # Construct source and destination paths
-            pathIn = DocumentRoot.replace(DocumentRootPrefix, wwwIn)
-            pathOut = DocumentRoot.replace(DocumentRootPrefix, wwwOut)
-            site["pathIn"] = pathIn
-            site["pathOut"] = pathOut
-            ## TEST
-            #print(ServerName, pathIn, pathOut)
-            ## TEST
-            # Write config entry
-            writeConfig(site, httpdConfOut, hostsOut)
-            # Copy files
-            copyFiles(site, dirIn, dirOut)
+        # Write config entry
+        writeConfig(site, httpdConfOut, hostsOut)
+        # Links into any of the restored sites point to the site's copy
+        resolver.addTree(site.pathIn, site.pathOut)
+
+    # Longest sites first (sites that are not in the inventory are walked)
+    with tapeMetrics.stage("walk"):
+        jobs, inventory = siteJobs(sites, lambda site: site.pathIn, timingsOut,
+                                   args.inventory, args.rescan)
+    eta = None
+    if inventory is not None:
+        eta = Eta(sum(inventory.cost(site.pathIn)[0] for site in sites), len(sites))
+    timings = loadTimings(timingsOut)
+
+    def restoreSite(site):
+        timeStart = time.time()
+        siteMetrics = metrics.site(site.serverName)
+        copyFiles(site, resolver, manifest, store, siteMetrics)
+        seconds = time.time() - timeStart
+        siteMetrics.finish(seconds)
+        return seconds
+
+    # The manifest is saved at intervals, and always at the end (also if the
+    # restore fails)
+    try:
+        for job, seconds in runLargestFirst(jobs, restoreSite, args.jobs):
+            timings[job.name] = seconds
+            manifest.checkpoint()
+            saveTimings(timings, timingsOut)
+            if eta is not None:
+                eta.add(inventory.cost(job.rootDir)[0])
+                print(eta.line(), file=sys.stderr)
+    finally:
+        manifest.save()
+
+    # Link report
+    resolver.writeReport(os.path.join(dirOutEtc, "links.csv"))
+    print("Links: " + ", ".join("{} {}".format(n, status)
+                                for status, n in sorted(resolver.summary().items())),
+          file=sys.stderr)
+    if store is not None:
+        print(store.summary(), file=sys.stderr)
+    tapeMetrics.finish()
+    metrics.close()
 
 if __name__ == "__main__":
     main()
@@ -15,12 +15,21 @@ NOTE: running as sudo is needed bc of permissions set in source data.
 
 import os
 import sys
-import csv
+import io
+import time
 import argparse
-import subprocess as sub
-from shutil import which
-from shutil import copyfile
-from distutils.dir_util import copy_tree
+import tarfile
+from copyengine import copyTree
+from manifest import Manifest
+from linkresolver import LinkResolver
+from contentstore import ContentStore, MODES
+from siteinventory import Eta
+from metrics import Metrics
+from scheduler import siteJobs, printPlan, runLargestFirst, loadTimings, saveTimings
+from tarrestore import TarRestore
+from dumpreader import DumpReader, DumpLinkResolver, DumpError
+from tapecatalog import TapeCatalog
+from siteconfig import readConfig, parseCernConfig, mapSites, WWW_CERN
 
 
 def parseCommandLine(parser):
@@ -29,11 +38,69 @@ def parseCommandLine(parser):
     parser.add_argument('dirIn',
                         action='store',
                         type=str,
-                        help='input directory')
+                        help='input directory (or tape image with --tar or --dump)')
     parser.add_argument('dirOut',
                         action='store',
                         type=str,
                         help='output directory')
+    parser.add_argument('--rescan',
+                        action='store_true',
+                        help='ignore restore manifest of previous run, and check all \
+                        destination files')
+    parser.add_argument('--hash',
+                        action='store_true',
+                        help='store SHA-1 of each restored file in restore manifest')
+    parser.add_argument('--store',
+                        action='store',
+                        type=str,
+                        help='content store directory (on the same volume as dirOut); \
+                        restored files with the same content as a stored file are \
+                        replaced by links to it')
+    parser.add_argument('--store-mode',
+                        action='store',
+                        choices=MODES,
+                        default='hardlink',
+                        help='how duplicates are linked to the content store (default: hardlink)')
+    parser.add_argument('--inventory',
+                        action='store',
+                        type=str,
+                        help='site inventory index file; sites that are not in it are \
+                        walked first, and sites are restored largest first, with an \
+                        estimate of the remaining time')
+    parser.add_argument('--jobs', '-j',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of sites that are restored in parallel; sites are \
+                        dispatched longest first, by their time in the previous run or \
+                        their size in the inventory (default: 1)')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only print the planned schedule and predicted run time \
+                        (sites are walked first if there is no inventory)')
+    parser.add_argument('--metrics',
+                        action='store',
+                        type=str,
+                        help='append timings and counters of each stage of each site to \
+                        this JSON-lines file')
+    parser.add_argument('--tar',
+                        action='store_true',
+                        help='dirIn is a TAR tape image (e.g. file000001.dd); sites are \
+                        extracted from it directly')
+    parser.add_argument('--dump',
+                        action='store_true',
+                        help='dirIn is a dump(8) tape image (e.g. file000003.dd); sites are \
+                        extracted from it directly')
+    parser.add_argument('--catalog',
+                        action='store',
+                        type=str,
+                        help='tape catalog (see catalog-tapes.py); if dirIn is a tape image, \
+                        its format (--tar or --dump) is taken from the catalog')
+    parser.add_argument('--encoding',
+                        action='store',
+                        type=str,
+                        default='latin-1',
+                        help='encoding of file names in TAR tape image (default: latin-1)')
 
     # Parse arguments
     arguments = parser.parse_args()
@@ -47,116 +114,36 @@ def errorExit(msg):
     sys.exit(1)
 
 
-def launchSubProcess(args):
-    """Launch subprocess and return exit code, stdout and stderr"""
-    try:
-        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
-        output, errors = p.communicate()
-
-        # Decode to UTF8
-        outputAsString = output.decode('utf-8')
-        errorsAsString = errors.decode('utf-8')
-
-        exitStatus = p.returncode
+def readApacheConfig(dirIn, dirOut):
+    """
+    Read (CERN httpd) config file, and return list of sites
+    that can be restored
+    """
 
-    except Exception:
-        # I don't even want to to start thinking how one might end up here ...
+    # Tape 12 is a dump of the file system that was mounted at /home, so
+    # its config is at local/etc instead of home/local/etc
+    for homeDir in ["home", ""]:
+        configFile = os.path.join(dirIn, homeDir, "local/etc/httpd.conf")
+        if os.path.isfile(configFile):
+            break
+    else:
+        errorExit("no httpd.conf found in " + dirIn)
 
-        exitStatus = -99
-        outputAsString = ""
-        errorsAsString = ""
+    # Construct paths
+    wwwIn = os.path.join(dirIn, homeDir, "local/www")
+    wwwOut = os.path.join(dirOut, "www")
 
-    return exitStatus, outputAsString, errorsAsString
+    sites = readConfig(configFile, "cern")
+    return mapSites(sites, WWW_CERN, wwwIn, wwwOut)
 
 
-def readApacheConfig(dirIn, dirOut):
+def parseApacheConfig(configIn, wwwIn, wwwOut):
     """
-    Read Apache config file, extract interesting bits and return
-    list with dictionary for each site
+    Parse lines of (CERN httpd) config, and return list of sites
+    that can be restored. Source and destination paths of each site are
+    constructed from www directories wwwIn and wwwOut
     """
-
-    # Construct paths
-    wwwIn = os.path.join(dirIn, "home/local/www")
-    #wwwIn = os.path.join(dirIn, "local/www") # Only for tape 12!
-    wwwOut = os.path.join(dirOut, "www")
-    configFile = os.path.join(dirIn, "home/local/etc/httpd.conf")
-    #configFile = os.path.join(dirIn, "local/etc/httpd.conf") # Only for tape 12!
-
-    # Prefix / suffix used in Map entries (need to be stripped)
-    mapPrefix="/htbin/htimage/home/local/www"
-    mapSuffix="/*.map"
-    execSuffix="/*"
-
-    # List that holds individual site dictionaries
-    sites = []
-
-    with open(configFile) as configIn:
-        for line in configIn:
-            if line.startswith("MultiHost"):
-                # TODO make sure that last entry of httpd.conf gets added to sites as well!
-                # Reset record counters
-                noMaps = 0
-                noExecs = 0
-                noWelcomes = 0
-
-                # Append previous siteInfo dictionary to list
-                try:
-                    # Ignore test entries
-                    if not siteInfo['serverName'].startswith("test"):
-                        siteInfo['execPaths'] = execPaths
-                        sites.append(siteInfo)
-                except UnboundLocalError:
-                    # siteInfo, execPathsIn and execPathsOut don't
-                    # exist at start of first processed site
-                    pass
-
-                # Intialise empty siteInfo dictionary and execPath list
-                siteInfo = {}
-                execPaths = []
-
-                url = line.split()[1].strip()
-                siteInfo['url'] = url
-                siteInfo['serverName'] = url.replace("www.", "")
-
-            if line.startswith("Map") and noMaps == 0:
-                # Only read 1st map entry for a site
-                mapPath = line.split()[2].strip()
-
-                if mapPath != "/noproxy.htm":
-                    # Remove suffix
-                    mapPath = mapPath.replace(mapSuffix, "")
-
-                    # Construct source and destination paths
-                    pathIn = mapPath.replace(mapPrefix, wwwIn)
-                    pathOut = mapPath.replace(mapPrefix, wwwOut)
-
-                    siteInfo['pathIn'] = pathIn
-                    siteInfo['pathOut'] = pathOut
-                    noMaps += 1
-
-            if line.startswith("Exec"):
-                # Only read 1st map entry for a site
-                execPath = line.split()[2].strip()
-
-                if execPath not in ["/home/local/www/cgi-bin/*",
-                                    "/home/local/www//cgi-bin/*"]:
-                    # Remove suffix
-                    execPath = execPath.replace(execSuffix, "")
-                    
-                    # Construct source and destination paths
-                    execPathIn = execPath.replace("/home/local/www", wwwIn)
-                    execPathOut = execPath.replace("/home/local/www", wwwOut)
-
-                    # Store execPathIn and execPathout pair as dictionary and
-                    # add to list
-                    execPaths.append({execPathIn:execPathOut})
-
-            if line.startswith("Welcome") and noWelcomes == 0:
-                indexPage = line.split()[1].strip()
-                noWelcomes += 1
-                siteInfo['indexPage'] = indexPage
-
-    return sites
+    return mapSites(parseCernConfig(configIn), WWW_CERN, wwwIn, wwwOut)
 
 
 def writeConfig(site, configOut, hostsOut):
@@ -164,137 +151,195 @@ def writeConfig(site, configOut, hostsOut):
 
     with open(configOut, "a", encoding="utf-8") as cOut:
         cOut.write("<VirtualHost *:80>\n")
-        cOut.write("ServerName " + site["serverName"] + "\n")
-        cOut.write("ServerAlias " + site["url"] + "\n")
-        cOut.write("DocumentRoot " + site["pathOut"] + "\n")
-        cOut.write('RedirectMatch ^/$ "/' + site["indexPage"] + '"\n')
+        cOut.write("ServerName " + site.serverName + "\n")
+        cOut.write("ServerAlias " + site.url + "\n")
+        cOut.write("DocumentRoot " + site.pathOut + "\n")
+        if site.indexPage is not None:
+            cOut.write('RedirectMatch ^/$ "/' + site.indexPage + '"\n')
         cOut.write("</VirtualHost>" + "\n\n")
 
     with open(hostsOut, "a", encoding="utf-8") as hOut:
-        hOut.write("127.0.0.1 " + site["serverName"] + "\n")
-        hOut.write("127.0.0.1 " + site["url"] + "\n")
+        hOut.write("127.0.0.1 " + site.serverName + "\n")
+        hOut.write("127.0.0.1 " + site.url + "\n")
         #hOut.write("\n\n")
 
-def fixSymLinks(folder, dirIn, dirOut):
-    for root, _, files in os.walk(folder):
-        for f in files:
-            thisFile = os.path.join(root, f)
-            try:
-                os.stat(thisFile)
-            except OSError:
-                # Read link target
-                linkTarget = os.readlink(thisFile)
-                #print(thisFile, linkTarget, file=sys.stderr)
-                
-                # Leave relative links unchanged, update absolute links to input 
-                # and output paths
-                if os.path.isabs(linkTarget):
-                    linkTargetIn = os.path.join(dirIn, linkTarget[1:])                    
-                else:
-                    linkTargetIn = os.path.join(root, linkTarget)
-                    #print("linkTarget: " + linkTarget + "linkTargetIn: " + linkTargetIn, file=sys.stderr)
-
-                linkTargetOut = os.path.join(dirOut, linkTarget.replace("/home/", ""))
-                #print("linkTargetOut: " + linkTargetOut, file=sys.stderr)
-
-                if os.path.isdir(linkTargetIn):
-                    # Copy directory to outDir
-                    try:
-                        copy_tree(linkTargetIn, linkTargetOut, verbose=1, update=1, preserve_symlinks=1)
-                    except:
-                        print("ERROR copying " + linkTargetIn, file=sys.stderr)
-                        #raise
-                elif os.path.isfile(linkTargetIn):
-                    try:
-                        copyfile(linkTargetIn, linkTargetOut)
-                    except:
-                        print("ERROR copying " + linkTargetIn, file=sys.stderr)
-                        #raise
-
-                # Update symlink
-                try:
-                    linkTmp = os.path.join(root, "templink")
-                    os.symlink(linkTargetOut, os.path.join(root, linkTmp))
-                    os.replace(linkTmp, thisFile)
-                except UnboundLocalError:
-                    print("ERROR updating symlink %s" % linkTargetIn, file=sys.stderr)
-
-
-def copyFiles(site, dirIn, dirOut):
+def copyFiles(site, resolver, manifest=None, store=None, metrics=None):
     """Copy site's folder structure and apply correct permissions:
     - Dirs to 755
     - Files in source dir to 644
     - Files in exec (cgi-bin) dirs to 755
+    Permissions are set while copying, so the copy isn't walked again.
+    With a restore manifest, only entries that changed since the previous
+    restore are copied. Links are fixed by resolver. With a content store,
+    duplicate files are replaced by links to the stored copy. Stages are
+    timed with metrics (SiteMetrics)
     """
-    sourceDir = os.path.abspath(site["pathIn"])
-    destDir = os.path.abspath(site["pathOut"])
-    execDirs = site["execPaths"]
+    if metrics is None:
+        metrics = Metrics(progress=False).site(site.serverName)
+    sourceDir = os.path.abspath(site.pathIn)
+    destDir = os.path.abspath(site.pathOut)
+    execDirs = site.execPaths
+    execSourceDirs = [os.path.abspath(i) for i, _ in execDirs]
 
     print("====== PROCESSING SOURCE DIR " + sourceDir, file=sys.stderr)
 
     # Source dir tree
     if os.path.exists(sourceDir):
+        links = []
 
         try:
-            # Note copy_tree by default aborts on broken symlinks, hence preserve_symlinks=1
-            # However this means that these broken  
-            copy_tree(sourceDir, destDir, verbose=1, update=1, preserve_symlinks=1)
+            # Symlinks are copied as links; broken ones are fixed below.
+            # Permissions are set while copying, so there is no chmod stage
+            with metrics.stage("copy"):
+                copyStats = copyTree(sourceDir, destDir, update=True,
+                                     fileMode=0o644, dirMode=0o755, manifest=manifest,
+                                     links=links, store=store,
+                                     execDirs=execSourceDirs, progress=metrics.tick)
+            metrics.add("copy", **copyStats)
+            print("Copied {files} files ({bytes} bytes), {links} links, {dirs} dirs; "
+                  "skipped {skipped} up-to-date files; {removed} entries gone from source; "
+                  "{errors} errors".format(**copyStats),
+                  file=sys.stderr)
         except:
             print("ERROR copying " + sourceDir, file=sys.stderr)
+            metrics.add("copy", errors=1)
 
-        # Search destination dir for broken symbolic links, fix them and copy
-        # underlying data
-        fixSymLinks(destDir, dirIn, dirOut)
-
-        # Update permissions
-        for root, dirs, files in os.walk(destDir): 
-            for d in dirs:
-                thisDir = os.path.join(root, d)
-                try:
-                    os.chmod(thisDir, 0o755)
-                except OSError:
-                    print("ERROR updating permissions for directory " + thisDir, file=sys.stderr)
-
-            for f in files:
-                thisFile = os.path.join(root, f)
-                try:
-                    os.chmod(thisFile, 0o644)
-                except OSError:
-                    print("ERROR updating permissions for file " + thisFile, file=sys.stderr)
+        # Fix broken and absolute symbolic links, and copy underlying data
+        with metrics.stage("fixSymLinks"):
+            resolver.fixLinks(links, sourceDir, destDir)
+        metrics.add("fixSymLinks", links=len(links))
     else:
         print("WARNING: directory " + sourceDir + " does not exist", file=sys.stderr)
 
     # Executable (cgi-bin) dirs (can be multiple or none at all)
     """
-    for d in execDirs:
-        for i, o in d.items():
-            execSourceDir = os.path.abspath(i)
-            execDestDir = os.path.abspath(o)
-            print("====== PROCESSING EXEC DIR " + execSourceDir, file=sys.stderr)
-
-            if os.path.exists(execSourceDir):
-                try:
-                    copy_tree(execSourceDir, execDestDir, verbose=1, update=1, preserve_symlinks=1)
-                except:
-                    print("ERROR copying " + execSourceDir, file=sys.stderr)
-
-                # Search destination dir for broken symbolic links, fix them and copy
-                # underlying data
-                fixSymLinks(execDestDir, dirIn, dirOut)
-
-                # Update permissions
-                for root, dirs, files in os.walk(execDestDir):  
-                    for f in files:
-                        thisFile = os.path.join(root, f)
-                        try:
-                            os.chmod(thisFile, 0o755)
-                        except OSError:
-                            print("ERROR updating permissions for file " + thisFile, file=sys.stderr)
-            else:
-                print("WARNING: directory " + execSourceDir + " does not exist", file=sys.stderr)
+    for i, o in execDirs:
+        execSourceDir = os.path.abspath(i)
+        execDestDir = os.path.abspath(o)
+        print("====== PROCESSING EXEC DIR " + execSourceDir, file=sys.stderr)
+
+        if os.path.exists(execSourceDir):
+            try:
+                execLinks = []
+                copyTree(execSourceDir, execDestDir, update=True,
+                         fileMode=0o755, dirMode=0o755, manifest=manifest,
+                         links=execLinks, store=store)
+            except:
+                print("ERROR copying " + execSourceDir, file=sys.stderr)
+
+            # Fix broken and absolute symbolic links, and copy underlying data
+            resolver.fixLinks(execLinks, execSourceDir, execDestDir)
+        else:
+            print("WARNING: directory " + execSourceDir + " does not exist", file=sys.stderr)
     """
 
 
+def restoreTar(imageFile, dirOut, encoding, store=None, metrics=None):
+    """Restore sites from TAR tape image in a single pass, and write
+    output config. The pass is timed with metrics (SiteMetrics of the tape)"""
+    dirOutEtc = os.path.join(dirOut, "etc")
+    print("====== PROCESSING TAPE IMAGE " + imageFile, file=sys.stderr)
+    if metrics is None:
+        metrics = Metrics(progress=False).site(None)
+
+    restorer = TarRestore(imageFile, dirOut, encoding, store)
+    try:
+        with metrics.stage("extract"):
+            sites = restorer.restore(parseApacheConfig)
+    except (OSError, tarfile.TarError) as e:
+        errorExit("cannot read tape image " + imageFile + ": " + str(e))
+    metrics.add("extract", **restorer.stats)
+    print("Extracted {files} files ({bytes} bytes), {links} links, {dirs} dirs; "
+          "skipped {skipped} up-to-date files; removed {removed} files outside sites; "
+          "{errors} errors".format(**restorer.stats), file=sys.stderr)
+
+    for site in sites or []:
+        writeConfig(site, os.path.join(dirOutEtc, "sites.conf"),
+                    os.path.join(dirOutEtc, "hosts"))
+
+    restorer.writeReport(os.path.join(dirOutEtc, "links.csv"))
+    if store is not None:
+        print(store.summary(), file=sys.stderr)
+
+
+def restoreDump(imageFile, dirOut, store=None, metrics=None):
+    """Restore sites from dump tape image through its index, and write
+    output config. Stages are timed with metrics (Metrics)"""
+    dirOutEtc = os.path.join(dirOut, "etc")
+    print("====== PROCESSING TAPE IMAGE " + imageFile, file=sys.stderr)
+    if metrics is None:
+        metrics = Metrics(progress=False)
+    tapeMetrics = metrics.site(None)
+
+    try:
+        reader = DumpReader(imageFile)
+        with tapeMetrics.stage("index"):
+            reader.buildIndex()
+    except (OSError, DumpError) as e:
+        errorExit("cannot read dump image " + imageFile + ": " + str(e))
+    if reader.resyncs or reader.badChecksums:
+        print("WARNING: {} unreadable blocks, {} bad header checksums in {}"
+              .format(reader.resyncs, reader.badChecksums, imageFile), file=sys.stderr)
+
+    # The image is either a dump of the root file system, or of the file
+    # system that was mounted at /home (e.g. tape 12)
+    for mountPoint, configPath in [("", "home/local/etc/httpd.conf"),
+                                   ("home", "local/etc/httpd.conf")]:
+        configInode = reader.lookup(configPath)
+        if configInode is not None:
+            break
+    else:
+        errorExit("no httpd.conf found in " + imageFile)
+
+    root = os.path.abspath(imageFile)
+    wwwIn = os.path.join(root, "home/local/www")
+    wwwOut = os.path.join(dirOut, "www")
+    with tapeMetrics.stage("parse"):
+        configText = reader.readData(configInode).decode("latin-1")
+        sites = parseApacheConfig(io.StringIO(configText), wwwIn, wwwOut)
+    metrics.sitesTotal = len(sites)
+    tapeMetrics.finish()
+
+    resolver = DumpLinkResolver(reader, dirOut, mountPoint, store)
+    for site in sites:
+        resolver.addTree(site.pathIn, site.pathOut)
+
+    for site in sites:
+        writeConfig(site, os.path.join(dirOutEtc, "sites.conf"),
+                    os.path.join(dirOutEtc, "hosts"))
+        sourceDir = resolver.imagePath(site.pathIn)
+        print("====== PROCESSING SOURCE DIR " + site.pathIn, file=sys.stderr)
+        inode = None if sourceDir is None else reader.lookup(sourceDir)
+        if inode is None or not inode.isDir():
+            print("WARNING: directory " + site.pathIn + " does not exist in image",
+                  file=sys.stderr)
+            continue
+        execDirs = [resolver.imagePath(i) for i, _ in site.execPaths]
+        links = []
+        siteMetrics = metrics.site(site.serverName)
+        with siteMetrics.stage("extract"):
+            stats = reader.extractTree(sourceDir, site.pathOut, fileMode=0o644, dirMode=0o755,
+                                       execDirs=[d for d in execDirs if d is not None],
+                                       links=links, store=store)
+        siteMetrics.add("extract", **stats)
+        siteMetrics.tick(stats["files"], stats["bytes"])
+        print("Extracted {files} files ({bytes} bytes), {links} links, {dirs} dirs; "
+              "skipped {skipped} up-to-date files; {errors} errors".format(**stats),
+              file=sys.stderr)
+        with siteMetrics.stage("fixSymLinks"):
+            resolver.fixLinks(links, site.pathIn, site.pathOut)
+        siteMetrics.add("fixSymLinks", links=len(links))
+        siteMetrics.finish()
+
+    resolver.writeReport(os.path.join(dirOutEtc, "links.csv"))
+    print("Links: " + ", ".join("{} {}".format(n, status)
+                                for status, n in sorted(resolver.summary().items())),
+          file=sys.stderr)
+    if store is not None:
+        print(store.summary(), file=sys.stderr)
+    reader.close()
+
+
 def main():
     """Main function"""
 
@@ -304,30 +349,124 @@ def main():
     dirIn = os.path.abspath(args.dirIn)
     dirOut = os.path.abspath(args.dirOut)
 
+    # Image format from catalog
+    if args.catalog is not None and os.path.isfile(dirIn):
+        catalog = TapeCatalog(args.catalog)
+        image = catalog.lookup(dirIn)
+        catalog.close()
+        if image is None:
+            errorExit(dirIn + " is not in catalog " + args.catalog)
+        if image["format"] not in ["tar", "dump"]:
+            errorExit("cannot restore " + image["format"] + " image " + dirIn)
+        args.tar = image["format"] == "tar"
+        args.dump = image["format"] == "dump"
+
     # Dir, files for output config
     dirOutEtc = os.path.join(dirOut, "etc")
     httpdConfOut = os.path.join(dirOutEtc, "sites.conf")
     hostsOut = os.path.join(dirOutEtc, "hosts")
+    timingsOut = os.path.join(dirOutEtc, "restore-times.csv")
 
-    # Read info on sites from config file
-    sites = readApacheConfig(dirIn, dirOut)
+    # Only print the schedule
+    if args.dry_run:
+        if args.tar or args.dump:
+            errorExit("--dry-run needs a restored directory tree as input")
+        jobs, _ = siteJobs(readApacheConfig(dirIn, dirOut), lambda site: site.pathIn,
+                           timingsOut, args.inventory, args.rescan, prescan=True)
+        printPlan(jobs, args.jobs)
+        return
 
     # Create output etc directory
     if not os.path.exists(dirOutEtc):
         os.makedirs(dirOutEtc)
 
+    # Restore manifest of output tree
+    manifest = Manifest(dirOut, useHash=args.hash, rescan=args.rescan)
+    manifest.load()
+
+    # Content store for deduplication
+    store = None
+    if args.store is not None:
+        try:
+            store = ContentStore(args.store, args.store_mode)
+        except OSError as e:
+            errorExit("cannot use content store " + args.store + ": " + str(e))
+
     # Remove output config files they already exist
     if os.path.isfile(httpdConfOut):
         os.remove(httpdConfOut)
     if os.path.isfile(hostsOut):
         os.remove(hostsOut)
 
+    # Timings of each stage
+    metrics = Metrics(args.metrics, tape=os.path.basename(dirOut))
+    tapeMetrics = metrics.site(None)
+
+    if args.tar:
+        restoreTar(dirIn, dirOut, args.encoding, store, tapeMetrics)
+        tapeMetrics.finish()
+        metrics.close()
+        return
+    if args.dump:
+        restoreDump(dirIn, dirOut, store, metrics)
+        metrics.close()
+        return
+
+    # Read info on sites from config file
+    with tapeMetrics.stage("parse"):
+        sites = readApacheConfig(dirIn, dirOut)
+    metrics.sitesTotal = len(sites)
+
+    # Link resolver, shared by all sites
+    resolver = LinkResolver(dirIn, dirOut, manifest, store)
+
+    # Links into any of the restored sites point to the site's copy
+    for site in sites:
+        resolver.addTree(site.pathIn, site.pathOut)
+
     # For each site, write output config, hosts entries
-    # and copy data over to destination
     for site in sites:
         writeConfig(site, httpdConfOut, hostsOut)
-        # TODO: write entries for hosts file!
-        copyFiles(site, dirIn, dirOut)
+
+    # Longest sites first (sites that are not in the inventory are walked)
+    with tapeMetrics.stage("walk"):
+        jobs, inventory = siteJobs(sites, lambda site: site.pathIn, timingsOut,
+                                   args.inventory, args.rescan)
+    eta = None
+    if inventory is not None:
+        eta = Eta(sum(inventory.cost(site.pathIn)[0] for site in sites), len(sites))
+    timings = loadTimings(timingsOut)
+
+    def restoreSite(site):
+        timeStart = time.time()
+        siteMetrics = metrics.site(site.serverName)
+        copyFiles(site, resolver, manifest, store, siteMetrics)
+        seconds = time.time() - timeStart
+        siteMetrics.finish(seconds)
+        return seconds
+
+    # Copy data over to destination. The manifest is saved at intervals, and
+    # always at the end (also if the restore fails)
+    try:
+        for job, seconds in runLargestFirst(jobs, restoreSite, args.jobs):
+            timings[job.name] = seconds
+            manifest.checkpoint()
+            saveTimings(timings, timingsOut)
+            if eta is not None:
+                eta.add(inventory.cost(job.rootDir)[0])
+                print(eta.line(), file=sys.stderr)
+    finally:
+        manifest.save()
+
+    # Link report
+    resolver.writeReport(os.path.join(dirOutEtc, "links.csv"))
+    print("Links: " + ", ".join("{} {}".format(n, status)
+                                for status, n in sorted(resolver.summary().items())),
+          file=sys.stderr)
+    if store is not None:
+        print(store.summary(), file=sys.stderr)
+    tapeMetrics.finish()
+    metrics.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,187 @@
+"""
+Longest-job-first scheduling of sites
+
+A tape holds a few very large sites and many small ones. If sites are
+processed in parallel in config order, a large site that happens to come
+last keeps one worker busy long after the others are idle. The scheduler
+estimates the cost (in seconds) of each site, and dispatches sites to a
+worker pool in order of decreasing cost (LPT scheduling), so the large sites
+start first and the small ones fill up the gaps.
+
+The cost of a site is taken from the previous run (the seconds column of
+the run's summary CSV) if it is there; otherwise it is estimated from the
+bytes and files in the site inventory (see siteinventory.py), with a cost
+model that is calibrated against the sites that do have a measured time.
+Sites without either estimate get the average cost of the others.
+
+"""
+
+import os
+import csv
+import sys
+import heapq
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from siteinventory import formatDuration, loadInventory
+
+
+class CostModel:
+    """Estimate of seconds needed for a site of a given size"""
+
+    def __init__(self, bytesPerSecond, filesPerSecond):
+        self.bytesPerSecond = bytesPerSecond
+        self.filesPerSecond = filesPerSecond
+
+    def estimate(self, siteBytes, files):
+        """Return estimated seconds for siteBytes bytes in files files"""
+        return siteBytes / self.bytesPerSecond + files / self.filesPerSecond
+
+
+# Restores are limited by disk throughput, captures by requests per file
+RESTORE_MODEL = CostModel(50e6, 2000)
+CAPTURE_MODEL = CostModel(10e6, 50)
+
+
+class Job:
+    """Site (or any other item) with its estimated cost"""
+    __slots__ = ("name", "rootDir", "item", "cost", "source")
+
+    def __init__(self, name, rootDir, item):
+        self.name = name
+        self.rootDir = rootDir
+        self.item = item
+        self.cost = 0.0
+        self.source = "unknown"
+
+
+def loadTimings(timingsFile, keyField="ServerName", secondsField="seconds"):
+    """Return dictionary with seconds of each site in the summary CSV of a
+    previous run (empty if there is none). Zero times (sites that were
+    skipped) are left out"""
+    timings = {}
+    try:
+        with open(timingsFile, encoding="utf-8", newline="") as fIn:
+            for row in csv.DictReader(fIn):
+                try:
+                    seconds = float(row[secondsField])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if seconds > 0:
+                    timings[row[keyField]] = seconds
+    except FileNotFoundError:
+        pass
+    return timings
+
+
+def saveTimings(timings, timingsFile, keyField="ServerName", secondsField="seconds"):
+    """Write seconds of each site to CSV file (atomically)"""
+    timingsTmp = timingsFile + ".tmp"
+    with open(timingsTmp, "w", encoding="utf-8", newline="") as fOut:
+        writer = csv.writer(fOut)
+        writer.writerow([keyField, secondsField])
+        for key in sorted(timings):
+            writer.writerow([key, round(timings[key], 2)])
+    os.replace(timingsTmp, timingsFile)
+
+
+def estimateCosts(jobs, timings=None, inventory=None, model=RESTORE_MODEL):
+    """Set cost and source of all jobs, from the timings of a previous run,
+    or else from the inventory"""
+    timings = timings or {}
+    modelled = {}
+    if inventory is not None:
+        for job in jobs:
+            if inventory.get(job.rootDir) is not None:
+                modelled[job.name] = model.estimate(*inventory.cost(job.rootDir))
+
+    # Calibrate the model against sites that were timed in the previous run
+    timed = [job.name for job in jobs if job.name in timings and job.name in modelled]
+    modelSum = sum(modelled[name] for name in timed)
+    scale = sum(timings[name] for name in timed) / modelSum if modelSum > 0 else 1.0
+
+    known = []
+    for job in jobs:
+        if job.name in timings:
+            job.cost = timings[job.name]
+            job.source = "previous"
+        elif job.name in modelled:
+            job.cost = modelled[job.name] * scale
+            job.source = "inventory"
+        else:
+            continue
+        known.append(job.cost)
+
+    average = sum(known) / len(known) if known else 0.0
+    for job in jobs:
+        if job.source == "unknown":
+            job.cost = average
+
+
+def siteJobs(sites, rootDir, timingsFile, inventoryFile=None, rescan=False, prescan=False,
+             model=RESTORE_MODEL):
+    """Return list of jobs for sites (rootDir is a function that returns the
+    directory of a site) with estimated costs, and the inventory (None if
+    there is no inventoryFile, and no prescan was requested)"""
+    inventory = None
+    if inventoryFile is not None or prescan:
+        inventory = loadInventory(inventoryFile, [rootDir(site) for site in sites], rescan)
+    jobs = [Job(site.serverName, rootDir(site), site) for site in sites]
+    estimateCosts(jobs, loadTimings(timingsFile), inventory, model)
+    return jobs, inventory
+
+
+def largestFirst(jobs):
+    """Return jobs in order of decreasing cost (stable for equal costs, so
+    without any estimates the original order is kept)"""
+    return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+
+def plan(jobs, workers):
+    """Simulate dispatching jobs largest first to workers, each job going to
+    the first worker that is free. Returns list of (job, worker, start, end)
+    and the predicted makespan"""
+    workers = max(1, workers)
+    # Min-heap of (time worker becomes free, worker number)
+    free = [(0.0, w) for w in range(1, workers + 1)]
+    schedule = []
+    for job in largestFirst(jobs):
+        start, worker = heapq.heappop(free)
+        end = start + job.cost
+        schedule.append((job, worker, start, end))
+        heapq.heappush(free, (end, worker))
+    makespan = max((end for _, _, _, end in schedule), default=0.0)
+    return schedule, makespan
+
+
+def printPlan(jobs, workers, fOut=sys.stdout):
+    """Write planned schedule and predicted makespan"""
+    schedule, makespan = plan(jobs, workers)
+    total = sum(job.cost for job in jobs)
+    # No schedule can beat the largest job, or the work spread evenly
+    lowerBound = max(total / max(1, workers), max((job.cost for job in jobs), default=0.0))
+    print("Schedule of {} sites on {} workers (longest job first)".format(len(jobs), workers),
+          file=fOut)
+    print("{:>6} {:>9} {:>9} {:>9}  {:<9}  {}".format("worker", "start", "end", "estimate",
+                                                     "source", "site"), file=fOut)
+    for job, worker, start, end in schedule:
+        print("{:>6} {:>9} {:>9} {:>9}  {:<9}  {}".format(
+              worker, formatDuration(start), formatDuration(end), formatDuration(job.cost),
+              job.source, job.name), file=fOut)
+    print("Predicted makespan: {} (total work {}, lower bound {})".format(
+          formatDuration(makespan), formatDuration(total), formatDuration(lowerBound)),
+          file=fOut)
+
+
+def runLargestFirst(jobs, func, workers, executor=ThreadPoolExecutor):
+    """Call func(job.item) for all jobs, largest first, and yield (job,
+    result) in order of completion. With more than one worker, jobs are
+    dispatched to a pool (executor class) that takes them in that order;
+    with one worker they run in the calling thread"""
+    ordered = largestFirst(jobs)
+    if workers <= 1:
+        for job in ordered:
+            yield job, func(job.item)
+        return
+    with executor(max_workers=workers) as pool:
+        futures = {pool.submit(func, job.item): job for job in ordered}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
@@ -2,9 +2,25 @@
 import os
 import sys
 import csv
+import time
 import argparse
-from warcio.capture_http import capture_http
-import requests
+from functools import partial
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+from sitecapture import Fetcher, SiteWriter, Journal, SegmentManifest, captureUrls
+from sitecapture import existingSegments, removeSegment
+from sitecapture import discoverUrls, prefetch
+from cdxj import indexName, mergeIndexes
+from directcapture import DirectReader
+from digestindex import DigestIndex
+from siteconfig import readConfig
+from siteinventory import Eta
+from standinserver import StandInServer
+from asynccapture import AsyncFetcher, CONNECTIONS_PER_HOST, PIPELINE_DEPTH, \
+    REQUESTS_PER_CONNECTION
+from scheduler import siteJobs, printPlan, runLargestFirst, CAPTURE_MODEL
+from linkcrawl import LinkCrawler, Scope, CRAWL_DEPTH, CRAWL_LIMIT
+from metrics import Metrics, timed
 
 def parseCommandLine(parser):
     """Command line parser"""
@@ -13,6 +29,142 @@ def parseCommandLine(parser):
                         action='store',
                         type=str,
                         help='Apache config file with VirtualHost entries for each site')
+    parser.add_argument('--workers', '-w',
+                        action='store',
+                        type=int,
+                        default=4,
+                        dest='workers',
+                        help='number of concurrent fetch workers per site (default: 4)')
+    parser.add_argument('--max-per-host',
+                        action='store',
+                        type=int,
+                        default=4,
+                        dest='maxPerHost',
+                        help='maximum number of simultaneous requests to one host (default: 4)')
+    parser.add_argument('--engine',
+                        action='store',
+                        type=str,
+                        choices=['http', 'direct', 'async'],
+                        default='http',
+                        dest='engine',
+                        help='capture engine: "http" fetches everything from the local \
+                              server; "direct" reads static files straight from \
+                              DocumentRoot, and only uses HTTP for anything else; \
+                              "async" fetches everything over pipelined persistent \
+                              connections, and writes the raw requests and responses \
+                              (default: http)')
+    parser.add_argument('--connections',
+                        action='store',
+                        type=int,
+                        default=CONNECTIONS_PER_HOST,
+                        dest='connections',
+                        help='async engine: number of persistent connections per host \
+                              (default: ' + str(CONNECTIONS_PER_HOST) + ')')
+    parser.add_argument('--pipeline',
+                        action='store',
+                        type=int,
+                        default=PIPELINE_DEPTH,
+                        dest='pipeline',
+                        help='async engine: maximum number of requests that are sent ahead \
+                              on one connection; 1 disables pipelining (default: ' +
+                        str(PIPELINE_DEPTH) + ')')
+    parser.add_argument('--requests-per-connection',
+                        action='store',
+                        type=int,
+                        default=REQUESTS_PER_CONNECTION,
+                        dest='requestsPerConnection',
+                        help='async engine: number of requests after which a connection is \
+                              replaced (default: ' + str(REQUESTS_PER_CONNECTION) + ')')
+    parser.add_argument('--crawl',
+                        action='store_true',
+                        dest='crawl',
+                        help='after the files on disk, follow links in the captured HTML \
+                              pages and imagemaps to URLs that are not on disk (CGI and \
+                              imagemap endpoints, missing pages), breadth first. With \
+                              --resume, the links of pages captured before are read from \
+                              the existing WARC segments')
+    parser.add_argument('--crawl-depth',
+                        action='store',
+                        type=int,
+                        default=CRAWL_DEPTH,
+                        dest='crawlDepth',
+                        help='maximum number of crawl rounds (link depth) per site \
+                              (default: ' + str(CRAWL_DEPTH) + ')')
+    parser.add_argument('--crawl-limit',
+                        action='store',
+                        type=int,
+                        default=CRAWL_LIMIT,
+                        dest='crawlLimit',
+                        help='maximum number of crawled URLs per site (default: ' +
+                        str(CRAWL_LIMIT) + ')')
+    parser.add_argument('--warc-max-size',
+                        action='store',
+                        type=float,
+                        default=None,
+                        dest='warcMaxSize',
+                        help='start a new WARC segment once a site\'s current segment \
+                              has this many MB (default: no limit)')
+    parser.add_argument('--warc-max-records',
+                        action='store',
+                        type=int,
+                        default=None,
+                        dest='warcMaxRecords',
+                        help='start a new WARC segment once a site\'s current segment \
+                              has this many records (default: no limit)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        dest='resume',
+                        help='resume interrupted captures from their journal instead of \
+                              starting over; sites that were completed are skipped')
+    parser.add_argument('--dedup-index',
+                        action='store',
+                        type=str,
+                        default=None,
+                        dest='dedupIndex',
+                        help='SQLite file with payload digests of earlier captures; \
+                              payloads that are already in it are written as revisit \
+                              records (created if it doesn\'t exist)')
+    parser.add_argument('--tape',
+                        action='store',
+                        type=str,
+                        default=None,
+                        dest='tape',
+                        help='tape label used in deduplication statistics (default: \
+                              base name of config file)')
+    parser.add_argument('--jobs', '-j',
+                        action='store',
+                        type=int,
+                        default=1,
+                        dest='jobs',
+                        help='number of sites that are captured in parallel, each in its \
+                              own process (default: 1)')
+    parser.add_argument('--inventory',
+                        action='store',
+                        type=str,
+                        default=None,
+                        dest='inventory',
+                        help='site inventory index file; DocumentRoots that are not in it \
+                              are walked first, and sites are captured largest first, \
+                              with an estimate of the remaining time')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        dest='serve',
+                        help='serve the sites from their DocumentRoots with a built-in \
+                              stand-in server on 127.0.0.1 instead of Apache (no hosts \
+                              entries or active Apache config needed)')
+    parser.add_argument('--metrics',
+                        action='store',
+                        type=str,
+                        default=None,
+                        dest='metrics',
+                        help='append timings and counters of each stage (walk, fetch, \
+                              write) of each site to this JSON-lines file')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        dest='dryRun',
+                        help='only print the planned schedule (longest site first, by \
+                              its time in sites-summary.csv of the previous run or its \
+                              size in the inventory) and the predicted run time')
 
     # Parse arguments
     arguments = parser.parse_args()
@@ -25,123 +177,277 @@ def errorExit(msg):
     sys.exit(1)
 
 
-def readConfig(configFile):
-    """Read Apache config file, parse contents and
-    return result as list"""
-
-    # Text strings that identify start, end of virtual host entry
-    vHostStart = "<VirtualHost *:80>"
-    vHostEnd = "</VirtualHost>"
-
-    # List that holds individual site dictionaries
-    sites = []
-
-    # Intialise empty siteInfo dictionary
-    siteInfo = {}
-
-    with open(configFile) as configIn:
-        for line in configIn:
-            if line.startswith(vHostEnd):
-                # Append previous siteInfo dictionary to list
-                try:
-                    siteInfo['ServerName'] = ServerName
-                    siteInfo['ServerAlias'] = ServerAlias
-                    siteInfo['DocumentRoot'] = DocumentRoot
-                    sites.append(siteInfo)
-                except UnboundLocalError:
-                    pass
+def scrapeSite(site, workers=4, maxPerHost=4, engine='http', resume=False,
+               dedupIndex=None, tape=None, proxy=None, connections=CONNECTIONS_PER_HOST,
+               pipeline=PIPELINE_DEPTH, requestsPerConnection=REQUESTS_PER_CONNECTION,
+               crawlScope=None, crawlDepth=CRAWL_DEPTH, crawlLimit=CRAWL_LIMIT,
+               metrics=None, metricsFile=None, warcMaxSize=None, warcMaxRecords=None):
+    """Scrape one site, and return dictionary with capture statistics. If
+    crawlScope is set, links in the captured pages to other URLs in that
+    scope are crawled after the files on disk. Stages are timed with metrics
+    (Metrics), or, in a capture process, written to metricsFile. The WARC
+    output is split into segments of at most warcMaxSize MB or warcMaxRecords
+    records (approximately, as all records of a URL go to one segment)"""
 
-                # Intialise empty siteInfo dictionary
-                siteInfo = {}
+    timeStart = time.time()
 
-            if line.startswith("ServerName"):
-                ServerName = line.split()[1].strip()
+    ServerName = site.serverName
+    ServerAlias = site.url
+    DocumentRoot = site.documentRoot
 
-            if line.startswith("ServerAlias"):
-                ServerAlias = line.split()[1].strip()
-
-            if line.startswith("DocumentRoot"):
-                DocumentRoot = line.split()[1].strip()
+    rootDir = os.path.abspath(DocumentRoot)
 
-            if line.startswith("ServerAlias"):
-                ServerAlias = line.split()[1].strip()
+    stats = {}
+    stats['ServerName'] = ServerName
+
+    ownMetrics = metrics is None
+    if ownMetrics:
+        metrics = Metrics(metricsFile, tape=tape, progress=False)
+    siteMetrics = metrics.site(ServerName)
+
+    # Journal that records which URLs are safely written to the WARC. Use
+    # ServerName as basis for journal and WARC names
+    journal = Journal(ServerName + ".journal.csv")
+    resuming = resume and os.path.isfile(journal.journalFile)
+    manifest = SegmentManifest(ServerName + ".segments.csv")
+
+    if resuming:
+        journal.load()
+        if journal.complete:
+            print("Skipping " + ServerName + " (capture already complete)", file=sys.stderr)
+            stats['seconds'] = 0
+            stats['urls'] = len(journal.urls)
+            stats['records'] = 0
+            stats['payloadBytes'] = 0
+            stats['warcBytes'] = 0
+            stats['revisits'] = 0
+            stats['savedBytes'] = 0
+            if ownMetrics:
+                metrics.close()
+            return stats
+        # Cut off records of URLs that were not committed, and write missing
+        # records to a new segment
+        journal.repairSegments(ServerName)
+        manifest.load()
+        manifest.repair(ServerName)
+        firstSegment = len(existingSegments(ServerName))
+    else:
+        # Remove WARCs of any previous runs (otherwise multiple runs will add
+        # data to pre-existing version of the file)
+        firstSegment = 0
+        for segment in existingSegments(ServerName):
+            try:
+                removeSegment(segment)
+            except:
+                msg = "cannot remove " + segment
+                errorExit(msg)
+        manifest.save()
 
-    return sites
+    try:
+        journal.open(append=resuming)
+    except IOError:
+        msg = 'could not open file ' + journal.journalFile
+        errorExit(msg)
 
+    # Open URLs output file
+    urlsOut = ServerName + ".urls.csv"
 
-def scrapeSite(site):
-    """Scrape one site"""
+    try:
+        fUrls = open(urlsOut, "w", encoding="utf-8")
+        # URLs from previous runs
+        for url in journal.urls:
+            fUrls.write(url + '\n')
+    except IOError:
+        msg = 'could not open file ' + urlsOut
+        errorExit(msg)
 
-    ServerName = site["ServerName"]
-    ServerAlias = site["ServerAlias"]
-    DocumentRoot = site["DocumentRoot"]
+    # URLs to scrape: domain root, and then all files and directories under
+    # DocumentRoot. These are discovered in a background thread while the
+    # capture is running
+    # TODO: or use www- address (ServerAlias), or both?
+    urls = prefetch(timed(discoverUrls(rootDir, "http://" + ServerAlias), siteMetrics, "walk"))
+    urlCount = 0
 
-    rootDir = os.path.abspath(DocumentRoot)
+    def pendingUrls(urls):
+        """Yield discovered or crawled URLs, skipping URLs from previous runs"""
+        nonlocal urlCount
+        for url in urls:
+            urlCount += 1
+            if url not in journal.committed:
+                yield url
 
-    # Use ServerName as basis for output WARC name
-    warcOut = ServerName + ".warc.gz"
+    payloadBytes = 0
 
-    # Remove warcOut if it already exists (otherwise multiple runs will add data
-    # to pre-existing version of the file)
-    if os.path.isfile(warcOut):
+    def writeUrl(url):
+        """Add captured URL to URLs output file"""
+        nonlocal payloadBytes
         try:
-            os.remove(warcOut)
-        except:
-            msg = "cannot remove " + warcOut
+            fUrls.write(url + '\n')
+        except IOError:
+            msg = 'could not write file ' + urlsOut
             errorExit(msg)
-
-    # Open URLs output file
-    urlsOut = ServerName + ".urls.csv"
+        siteMetrics.tick(1, writer.payloadBytes - payloadBytes)
+        payloadBytes = writer.payloadBytes
+
+    if engine == 'async':
+        address = None
+        if proxy is not None:
+            address = (urlsplit(proxy).hostname, urlsplit(proxy).port)
+        fetcher = AsyncFetcher(connections, pipeline, requestsPerConnection, address)
+    else:
+        fetcher = Fetcher(maxPerHost, proxy)
+    httpFetcher = fetcher
+    if engine == 'direct':
+        fetcher = DirectReader(rootDir, "http://" + ServerAlias, fetcher)
+
+    # Each process needs its own connection to the digest index
+    digestIndex = None
+    if dedupIndex is not None:
+        digestIndex = DigestIndex(dedupIndex)
+        # Claims of an interrupted earlier run point at records that were
+        # never committed
+        digestIndex.rollback(ServerName)
+        if not resuming:
+            digestIndex.resetSite(tape, ServerName)
+
+    # Start capturing stuff (skipping any URLs from previous runs)
+    maxBytes = None
+    if warcMaxSize is not None:
+        maxBytes = int(warcMaxSize * 1000000)
+    writer = SiteWriter(ServerName, journal, digestIndex, ServerName, segment=firstSegment,
+                        maxBytes=maxBytes, maxRecords=warcMaxRecords,
+                        info={"tape": tape, "engine": engine}, manifest=manifest, tape=tape)
+    crawler = None
+    if crawlScope is not None:
+        crawler = LinkCrawler(crawlScope, crawlDepth, crawlLimit)
+        if resuming:
+            # Pages committed before the interruption are not captured again,
+            # so take their links from the existing segments
+            for segment in existingSegments(ServerName)[:firstSegment]:
+                crawler.extractWarc(segment)
+    onExchange = crawler.extract if crawler is not None else None
+    metrics.enter(ServerName, "capture")
+    try:
+        captureUrls(pendingUrls(urls), writer, fetcher, workers=workers, onCommit=writeUrl,
+                    onExchange=onExchange, metrics=siteMetrics)
+        # Crawl links to URLs that are not on disk, one link level at a time
+        if crawler is not None:
+            for roundUrls in crawler.rounds():
+                captureUrls(pendingUrls(roundUrls), writer, fetcher, workers=workers,
+                            onCommit=writeUrl, onExchange=onExchange, metrics=siteMetrics)
+            print("{}: crawled {} URLs in {} rounds ({} links, {} bytes seen-set)".format(
+                  ServerName, crawler.crawled, crawler.round, crawler.links,
+                  crawler.seen.memory()), file=sys.stderr)
+        warcBytes = writer.bytesWritten()
+        writer.close()
+        journal.finalize()
+    finally:
+        writer.close()
+        journal.close()
+        fUrls.close()
+        if engine == 'async':
+            fetcher.close()
+        metrics.leave(ServerName, "capture")
+
+    # Claims and statistics were committed to the digest index with the
+    # journal checkpoints
+    if digestIndex is not None:
+        digestIndex.close()
+
+    stats['seconds'] = round(time.time() - timeStart, 2)
+    stats['urls'] = urlCount
+    stats['records'] = writer.records
+    stats['payloadBytes'] = writer.payloadBytes
+    stats['warcBytes'] = warcBytes
+    stats['revisits'] = writer.revisits
+    stats['savedBytes'] = writer.savedBytes
+
+    siteMetrics.add("fetch", retries=getattr(httpFetcher, "retries", 0))
+    siteMetrics.finish(stats['seconds'])
+    if ownMetrics:
+        metrics.close()
+
+    return stats
+
+
+def writeSummary(results, summaryOut):
+    """Write capture statistics of all sites to CSV file, and print
+    totals to stderr"""
+
+    fieldNames = ['ServerName', 'seconds', 'urls', 'records', 'payloadBytes', 'warcBytes',
+                  'revisits', 'savedBytes']
 
     try:
-        fUrls = open(urlsOut, "w", encoding="utf-8")
+        with open(summaryOut, "w", encoding="utf-8", newline='') as fSummary:
+            writer = csv.DictWriter(fSummary, fieldnames=fieldNames)
+            writer.writeheader()
+            for stats in results:
+                writer.writerow(stats)
     except IOError:
-        msg = 'could not open file ' + urlsOut
+        msg = 'could not write file ' + summaryOut
         errorExit(msg)
 
-    # List of URLs to scrape
-    urls = []
+    for stats in results:
+        print("{ServerName}: {seconds} s, {records} records, {payloadBytes} payload bytes, "
+              "{warcBytes} WARC bytes, {revisits} revisits, {savedBytes} bytes saved "
+              "(dedup ratio {ratio})".format(ratio=dedupRatio(stats['savedBytes'],
+                                                              stats['payloadBytes']),
+                                             **stats), file=sys.stderr)
+
+    payloadBytes = sum(stats['payloadBytes'] for stats in results)
+    savedBytes = sum(stats['savedBytes'] for stats in results)
+    print("TOTAL: {} sites, {} records, {} payload bytes, {} WARC bytes, {} revisits, "
+          "{} bytes saved (dedup ratio {})".format(
+          len(results),
+          sum(stats['records'] for stats in results),
+          payloadBytes,
+          sum(stats['warcBytes'] for stats in results),
+          sum(stats['revisits'] for stats in results),
+          savedBytes,
+          dedupRatio(savedBytes, payloadBytes)), file=sys.stderr)
+
+
+def dedupRatio(savedBytes, payloadBytes):
+    """Return fraction of payload bytes saved by deduplication"""
+    if payloadBytes == 0:
+        return 0.0
+    return round(savedBytes / payloadBytes, 3)
+
+
+def writeTapeTotals(dedupIndex):
+    """Print deduplication totals of all tapes in digest index to stderr"""
+    digestIndex = DigestIndex(dedupIndex)
+    for tape, sites, responses, revisits, payloadBytes, savedBytes in digestIndex.tapeTotals():
+        print("TAPE {}: {} sites, {} responses, {} revisits, {} payload bytes, "
+              "{} bytes saved (dedup ratio {})".format(tape, sites, responses, revisits,
+                                                       payloadBytes, savedBytes,
+                                                       dedupRatio(savedBytes, payloadBytes)),
+              file=sys.stderr)
+    digestIndex.close()
+
+
+def writeTapeIndex(sites, indexOut):
+    """Merge CDXJ indexes of all WARC segments of all sites into one
+    sorted index"""
+    indexFiles = []
+    for site in sites:
+        for segment in existingSegments(site.serverName):
+            if os.path.isfile(indexName(segment)):
+                indexFiles.append(indexName(segment))
+    try:
+        mergeIndexes(indexFiles, indexOut)
+    except IOError:
+        msg = 'could not write file ' + indexOut
+        errorExit(msg)
 
-    # First add domain root
-    # TODO: or use www- address (ServerAlias), or both?
-    #urls.append("http://" + ServerName)
-    urls.append("http://" + ServerAlias)
-
-    # Add remaining files (and rewrite file paths as URLs)
-    for root, dirs, files in os.walk(rootDir):
-        for filename in files:
-            # Full path
-            file_path = os.path.join(root, filename)
-
-            # Construct url and add to list
-            #url = file_path.replace(rootDir, "http://" + ServerName)
-            url = file_path.replace(rootDir, "http://" + ServerAlias)
-            urls.append(url)
-
-        for dirname in dirs:
-            # Full path
-            file_path = os.path.join(root, dirname)
-
-            # Construct url and add to list
-            url = file_path.replace(rootDir, "http://" + ServerAlias)
-            urls.append(url)
-
-    # Start capturing stuff
-    with capture_http(warcOut):
-        # Iterate over URL list
-        for url in urls:
-            try:
-                requests.get(url)
-            except:
-                print(url)
-                raise
-            try:
-                fUrls.write(url + '\n')
-            except IOError:
-                msg = 'could not write file ' + fUrls
-                errorExit(msg)
 
-    fUrls.close()
+def writeSite(fSites, site):
+    """Add site to output list of all sites"""
+    try:
+        fSites.write(site.serverName + '\n')
+    except IOError:
+        msg = 'could not write file ' + fSites.name
+        errorExit(msg)
 
 
 def main():
@@ -154,8 +460,25 @@ def main():
     args = parseCommandLine(parser)
     configFile = os.path.abspath(args.configFile)
 
-    # Read config file
-    sites = readConfig(configFile)
+    tape = args.tape
+    if tape is None:
+        tape = os.path.splitext(os.path.basename(configFile))[0]
+
+    dedupIndex = args.dedupIndex
+    if dedupIndex is not None:
+        dedupIndex = os.path.abspath(dedupIndex)
+
+    # Read config file (as written by the restore scripts)
+    sites = readConfig(configFile, "apache")
+
+    # Estimated capture time of each site, from the previous run's summary
+    # or the inventory
+    summaryOut = "sites-summary.csv"
+    jobs, inventory = siteJobs(sites, lambda site: site.documentRoot, summaryOut,
+                               args.inventory, prescan=args.dryRun, model=CAPTURE_MODEL)
+    if args.dryRun:
+        printPlan(jobs, args.jobs)
+        return
 
     # Open output list of all sites
     sitesOut = "sites.csv"
@@ -166,16 +489,69 @@ def main():
         msg = 'could not open file ' + sitesOut
         errorExit(msg)
 
-    # Process sites
-    for site in sites:
-        #print(site["ServerName"])
-        scrapeSite(site)
+    eta = None
+    if inventory is not None:
+        eta = Eta(sum(inventory.cost(site.documentRoot)[0] for site in sites), len(sites))
+
+    # Process sites, longest first. With multiple jobs each site is captured
+    # in a separate process; results are stored in config order, so
+    # sites.csv doesn't depend on which site finishes first
+    timeStart = time.time()
+    results = {}
+
+    # Stand-in server, shared by all sites (and capture processes)
+    server = None
+    proxy = None
+    if args.serve:
+        server = StandInServer(sites)
         try:
-            fSites.write(site["ServerName"] + '\n')
-        except IOError:
-            msg = 'could not write file ' + fSites
-            errorExit(msg)
+            server.start()
+        except OSError as e:
+            errorExit("cannot start stand-in server: " + str(e))
+        proxy = server.proxyUrl()
+        print("Serving sites at " + proxy, file=sys.stderr)
+
+    # Timings of each stage. Capture processes append to the metrics file
+    # themselves
+    metrics = Metrics(args.metrics, tape=tape, sites=len(sites))
+    metricsArgs = {'metrics': metrics}
+    if args.jobs > 1:
+        metricsArgs = {'metricsFile': args.metrics and os.path.abspath(args.metrics)}
+
+    capture = partial(scrapeSite, workers=args.workers, maxPerHost=args.maxPerHost,
+                      engine=args.engine, resume=args.resume, dedupIndex=dedupIndex, tape=tape,
+                      proxy=proxy, connections=args.connections, pipeline=args.pipeline,
+                      requestsPerConnection=args.requestsPerConnection,
+                      crawlScope=Scope(sites) if args.crawl else None,
+                      crawlDepth=args.crawlDepth, crawlLimit=args.crawlLimit,
+                      warcMaxSize=args.warcMaxSize, warcMaxRecords=args.warcMaxRecords,
+                      **metricsArgs)
 
+    try:
+        for job, result in runLargestFirst(jobs, capture, args.jobs, ProcessPoolExecutor):
+            results[job] = result
+            if args.jobs > 1:
+                metrics.tick(result['urls'], result['payloadBytes'])
+                metrics.siteDone()
+            if eta is not None:
+                eta.add(inventory.cost(job.rootDir)[0])
+                print(eta.line(), file=sys.stderr)
+    finally:
+        metrics.close()
+        if server is not None:
+            server.stop()
+    results = [results[job] for job in jobs]
+
+    for site in sites:
+        writeSite(fSites, site)
     fSites.close()
 
-main()
\ No newline at end of file
+    writeSummary(results, summaryOut)
+    writeTapeIndex(sites, "index.cdxj")
+    if dedupIndex is not None:
+        writeTapeTotals(dedupIndex)
+    print("Elapsed time: {} s".format(round(time.time() - timeStart, 2)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+"""
+Print the sites defined in an xxLINK web server config
+
+Reads a CERN httpd config (httpd.conf) or Apache config (file, or a configdb
+directory) through the shared (cached) config parser, and writes either
+Apache VirtualHost entries or a CSV of domains and root directories to
+stdout.
+
+Example command line:
+
+python3 ~/kb/xxLINK-resources/scripts/site-config.py /home/johan/ownCloud/xxLINK/httpd-cleaned.conf > sites.conf
+
+"""
+
+import sys
+import csv
+import argparse
+from siteconfig import readConfig, mapSites, FORMATS, WWW_CERN, WWW_APACHE
+
+
+def parseCommandLine(parser):
+    """Command line parser"""
+
+    parser.add_argument('configPath',
+                        action='store',
+                        type=str,
+                        help='config file or directory')
+    parser.add_argument('--format',
+                        action='store',
+                        choices=FORMATS,
+                        default='cern',
+                        help='config format (default: cern)')
+    parser.add_argument('--root',
+                        action='store',
+                        type=str,
+                        help='directory that corresponds to the root of the original \
+                        file system, for resolving Include directives (default: \
+                        parent directory of configPath)')
+    parser.add_argument('--output',
+                        action='store',
+                        choices=['vhosts', 'csv'],
+                        default='vhosts',
+                        help='write Apache VirtualHost entries, or CSV with domain and \
+                        root directory of each site (default: vhosts)')
+    parser.add_argument('--www-out',
+                        action='store',
+                        type=str,
+                        default='/var/www',
+                        help='directory that replaces the www directory of the original \
+                        server in VirtualHost entries (default: /var/www)')
+
+    # Parse arguments
+    arguments = parser.parse_args()
+    return arguments
+
+
+def errorExit(msg):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(1)
+
+
+def main():
+    """Main function"""
+
+    # Parse arguments from command line
+    parser = argparse.ArgumentParser(description='Print sites defined in xxLINK config')
+    args = parseCommandLine(parser)
+
+    try:
+        sites = readConfig(args.configPath, args.format, root=args.root)
+    except OSError as e:
+        errorExit("cannot read config " + args.configPath + ": " + str(e))
+
+    wwwPrefix = WWW_CERN if args.format == "cern" else WWW_APACHE
+
+    if args.output == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["domain", "rootDir"])
+        for site in sites:
+            writer.writerow([site.url, site.documentRoot or ""])
+        return
+
+    for site in mapSites(sites, wwwPrefix, wwwPrefix, args.www_out):
+        print("<VirtualHost *:80>")
+        print("ServerName " + site.serverName)
+        print("ServerAlias " + site.url)
+        print("DocumentRoot " + site.pathOut)
+        if site.indexPage is not None:
+            print('RedirectMatch ^/$ "/' + site.indexPage + '"')
+        print("</VirtualHost>")
+        print()
+
+
+if __name__ == "__main__":
+    main()
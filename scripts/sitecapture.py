@@ -0,0 +1,850 @@
+"""
+Capture engine for locally rendered xxLINK sites
+
+URLs are fetched by a bounded pool of worker threads that use pooled
+keep-alive connections (one requests Session per thread). The number of
+simultaneous requests to any single host is capped, so a restored Apache
+server doesn't get swamped. Fetched responses are handed back to one
+coordinating thread, which writes them to the site's WARC file in the order
+of the input URL list. This keeps both the WARC and the list of captured
+URLs deterministic, irrespective of the number of workers.
+
+The WARC output of a site can be split into segments of bounded size and
+number of records. Each segment starts with its own warcinfo record, and is
+listed with its size and SHA-1 in the site's segment manifest.
+
+"""
+
+import os
+import sys
+import csv
+import time
+import uuid
+import queue
+import base64
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urljoin, quote
+import requests
+from requests.adapters import HTTPAdapter
+from warcio.warcwriter import WARCWriter
+from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.timeutils import datetime_to_iso_date
+from digestindex import MIN_LENGTH
+from cdxj import cdxjLine, indexName, spillName, finalizeIndex
+
+# Size of chunks used for reading response bodies
+CHUNK_SIZE = 65536
+
+# Response bodies larger than this are spooled to disk instead of memory
+SPOOL_SIZE = 1048576
+
+# Maximum number of redirects that is followed for one URL
+MAX_REDIRECTS = 10
+
+# Timeout (connect, read) for requests to local server, in seconds
+TIMEOUT = (10, 120)
+
+# Maximum number of discovered URLs that are queued ahead of the fetch stage
+DISCOVERY_QUEUE_SIZE = 10000
+
+# Characters that are not percent-encoded in URL paths (RFC 3986 pchar)
+URL_SAFE = "/~!$&'()*+,;=:@"
+
+# Journal checkpoints are written after this many URLs or seconds
+CHECKPOINT_URLS = 200
+CHECKPOINT_SECONDS = 5
+
+# Software named in warcinfo records
+WARC_SOFTWARE = "xxLINK-resources scrape-local.py (warcio)"
+
+# Columns of the segment manifest of a site
+MANIFEST_FIELDS = ["segment", "warcinfoId", "records", "bytes", "sha1", "firstUrl", "lastUrl"]
+
+
+class Exchange:
+    """One captured request/response pair"""
+
+    __slots__ = ("url", "requestLine", "requestHeaders", "protocol",
+                 "statusLine", "headers", "payload", "length", "digest",
+                 "blockDigest", "remoteIP", "date", "rawRequest", "rawHead")
+
+    def __init__(self, url):
+        self.url = url
+        self.requestLine = None
+        self.requestHeaders = []
+        self.protocol = "HTTP/1.1"
+        self.statusLine = None
+        self.headers = []
+        self.payload = None
+        self.length = 0
+        self.digest = None
+        self.blockDigest = None
+        self.remoteIP = None
+        self.date = None
+        # Request and response head exactly as sent and received, if known
+        self.rawRequest = None
+        self.rawHead = None
+
+    def close(self):
+        """Release spooled payload"""
+        if self.payload is not None:
+            self.payload.close()
+            self.payload = None
+
+
+def warcDate():
+    """Return current time as WARC-Date value"""
+    return datetime_to_iso_date(datetime.now(timezone.utc).replace(tzinfo=None))
+
+
+def warcDigest(sha1):
+    """Return WARC-style (base32) representation of SHA-1 hash object"""
+    return "sha1:" + base64.b32encode(sha1.digest()).decode("ascii")
+
+
+def spoolPayload(chunks):
+    """Spool iterable of byte chunks to temporary file, and return file
+    object, length and WARC-style SHA-1 payload digest"""
+    payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    sha1 = hashlib.sha1()
+    length = 0
+    for chunk in chunks:
+        payload.write(chunk)
+        sha1.update(chunk)
+        length += len(chunk)
+    payload.seek(0)
+    return payload, length, warcDigest(sha1)
+
+
+class RawHeaders(StatusAndHeaders):
+    """HTTP headers that are written to the WARC exactly as they went over
+    the wire, instead of being serialized again"""
+
+    def __init__(self, statusline, headers, raw, protocol="", is_http_request=False):
+        super().__init__(statusline, headers, protocol=protocol,
+                         is_http_request=is_http_request)
+        self.raw = raw
+
+    def compute_headers_buffer(self, header_filter=None):
+        self.headers_buff = self.raw
+
+
+def httpHeaders(statusLine, headers, raw=None, protocol="", isRequest=False):
+    """Return StatusAndHeaders for WARC record; raw (bytes) is written
+    as-is if it is given"""
+    if raw is None:
+        return StatusAndHeaders(statusLine, headers, protocol=protocol,
+                                is_http_request=isRequest)
+    return RawHeaders(statusLine, headers, raw, protocol=protocol, is_http_request=isRequest)
+
+
+class HostLimiter:
+    """Caps the number of simultaneous requests per host"""
+
+    def __init__(self, maxPerHost):
+        self.maxPerHost = maxPerHost
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def slot(self, host):
+        """Return semaphore for host"""
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.maxPerHost)
+            return self.slots[host]
+
+
+class Fetcher:
+    """Fetches URLs using thread-local sessions with keep-alive connections.
+    If proxy (a URL) is given, all requests go to it instead (e.g. the
+    stand-in server), so host names don't need to resolve"""
+
+    def __init__(self, maxPerHost, proxy=None):
+        self.limiter = HostLimiter(maxPerHost)
+        self.maxPerHost = maxPerHost
+        self.proxy = proxy
+        self.local = threading.local()
+
+    def session(self):
+        """Return session for current thread"""
+        if not hasattr(self.local, "session"):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=self.maxPerHost)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if self.proxy is not None:
+                session.proxies = {"http": self.proxy}
+                session.trust_env = False
+            self.local.session = session
+        return self.local.session
+
+    def fetchOne(self, url):
+        """Fetch one URL without following redirects, and return
+        Exchange and response"""
+        host = urlsplit(url).netloc.lower()
+
+        with self.limiter.slot(host):
+            response = self.session().get(url, stream=True,
+                                          allow_redirects=False,
+                                          timeout=TIMEOUT)
+            try:
+                exchange = Exchange(url)
+                exchange.date = warcDate()
+
+                request = response.request
+                exchange.requestLine = request.method + " " + request.path_url + " HTTP/1.1"
+                exchange.requestHeaders = [("Host", urlsplit(request.url).netloc)]
+                exchange.requestHeaders += list(request.headers.items())
+
+                raw = response.raw
+                if raw.version == 10:
+                    exchange.protocol = "HTTP/1.0"
+                exchange.statusLine = str(raw.status) + " " + raw.reason
+
+                try:
+                    exchange.remoteIP = raw.connection.sock.getpeername()[0]
+                except Exception:
+                    pass
+
+                # Store body as sent by the server (i.e. without decoding any
+                # Content-Encoding). Chunked bodies are stored de-chunked, so
+                # Transfer-Encoding is replaced by the actual Content-Length.
+                exchange.payload, exchange.length, exchange.digest = \
+                    spoolPayload(raw.stream(CHUNK_SIZE, decode_content=False))
+
+                headers = list(raw.headers.items())
+                if any(name.lower() == "transfer-encoding" for name, _ in headers):
+                    headers = [(name, value) for name, value in headers
+                               if name.lower() not in ["transfer-encoding", "content-length"]]
+                    headers.append(("Content-Length", str(exchange.length)))
+                exchange.headers = headers
+            finally:
+                response.close()
+
+        return exchange, response
+
+    def fetch(self, url):
+        """Fetch URL and any redirects that follow from it; return list of
+        Exchange objects"""
+        exchanges = []
+        chain = set()
+
+        while True:
+            chain.add(url)
+            exchange, response = self.fetchOne(url)
+            exchanges.append(exchange)
+
+            # Follow redirects (Apache's RedirectMatch, directory slashes)
+            if not response.is_redirect or len(exchanges) > MAX_REDIRECTS:
+                break
+            url = urljoin(url, response.headers["location"])
+            if url in chain:
+                break
+
+        return exchanges
+
+
+def pathToUrl(relPath, urlPrefix):
+    """Return URL for path (bytes) relative to DocumentRoot. The path is
+    percent-encoded byte by byte, so file names in legacy encodings map
+    to the same URL that Apache serves them under"""
+    return urlPrefix + "/" + quote(relPath, safe=URL_SAFE)
+
+
+def discoverUrls(rootDir, urlPrefix):
+    """Generate URLs for everything under rootDir: the domain root first,
+    then for each directory its files followed by its subdirectories (same
+    order as os.walk, but with entries sorted by name). Symbolic links to
+    directories are listed but not followed"""
+
+    yield urlPrefix
+
+    rootDir = os.fsencode(os.path.abspath(rootDir))
+    # Stack of relative directory paths that still need to be listed
+    stack = [b""]
+
+    while stack:
+        relDir = stack.pop()
+        try:
+            with os.scandir(os.path.join(rootDir, relDir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print("WARNING: cannot list " + os.fsdecode(e.filename), file=sys.stderr)
+            continue
+
+        files = []
+        dirs = []
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+            if isDir:
+                dirs.append(entry)
+            else:
+                files.append(entry)
+
+        for entry in files + dirs:
+            yield pathToUrl(os.path.join(relDir, entry.name), urlPrefix)
+
+        # Reversed, so subdirectories are visited in sorted order
+        for entry in reversed(dirs):
+            if not entry.is_symlink():
+                stack.append(os.path.join(relDir, entry.name))
+
+
+def prefetch(items, maxSize=DISCOVERY_QUEUE_SIZE):
+    """Consume iterable items in a background thread, and yield its values
+    through a bounded queue"""
+
+    itemsQueue = queue.Queue(maxsize=maxSize)
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        itemsQueue.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+        itemsQueue.put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = itemsQueue.get()
+            if item is done:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+def segmentName(baseName, index):
+    """Return name of WARC segment with index for site with baseName. The
+    first segment has no index in its name"""
+    if index == 0:
+        return baseName + ".warc.gz"
+    return baseName + "-" + str(index).zfill(5) + ".warc.gz"
+
+
+def removeSegment(segment):
+    """Remove WARC segment and its index files"""
+    for fileName in [segment, indexName(segment), spillName(segment)]:
+        if os.path.isfile(fileName):
+            os.remove(fileName)
+
+
+def existingSegments(baseName):
+    """Return names of all existing WARC segments for site with baseName"""
+    segments = []
+    index = 0
+    while os.path.isfile(segmentName(baseName, index)):
+        segments.append(segmentName(baseName, index))
+        index += 1
+    return segments
+
+
+class Journal:
+    """Checkpoint journal of a site capture. Each row records a URL of which
+    all records are safely written, together with the WARC segment and the
+    offset just after its records. A final row marks a completed capture"""
+
+    def __init__(self, journalFile):
+        self.journalFile = journalFile
+        self.urls = []
+        self.committed = set()
+        self.segments = {}
+        self.complete = False
+        self.fileOut = None
+
+    def load(self):
+        """Read existing journal"""
+        with open(self.journalFile, "r", encoding="utf-8", newline="") as fIn:
+            for row in csv.reader(fIn):
+                if not row:
+                    continue
+                if row[0] == "complete":
+                    self.complete = True
+                elif row[0] == "ok" and len(row) == 4:
+                    url, segment, offset = row[1], row[2], int(row[3])
+                    if url not in self.committed:
+                        self.urls.append(url)
+                        self.committed.add(url)
+                    self.segments[segment] = offset
+
+    def open(self, append):
+        """Open journal for writing"""
+        self.fileOut = open(self.journalFile, "a" if append else "w",
+                            encoding="utf-8", newline="")
+        self.writer = csv.writer(self.fileOut)
+
+    def commit(self, entries):
+        """Add list of (url, segment, offset) entries and sync to disk"""
+        for url, segment, offset in entries:
+            self.writer.writerow(["ok", url, segment, offset])
+            self.committed.add(url)
+            self.segments[segment] = offset
+        self.fileOut.flush()
+        os.fsync(self.fileOut.fileno())
+
+    def finalize(self):
+        """Mark capture as complete"""
+        self.writer.writerow(["complete", "", "", len(self.segments)])
+        self.fileOut.flush()
+        os.fsync(self.fileOut.fileno())
+
+    def close(self):
+        """Close journal"""
+        if self.fileOut is not None:
+            self.fileOut.close()
+
+    def repairSegments(self, baseName):
+        """Truncate segments to their last committed offset, and remove
+        segments without any committed records. Gzip members are written per
+        record, so this leaves only complete records. The segments' CDXJ
+        indexes are updated accordingly"""
+        for segment in existingSegments(baseName):
+            if segment in self.segments:
+                with open(segment, "r+b") as fSegment:
+                    fSegment.truncate(self.segments[segment])
+                finalizeIndex(segment, self.segments[segment])
+            else:
+                removeSegment(segment)
+
+
+class DigestFile:
+    """Binary output file that keeps the SHA-1 of everything written to it"""
+
+    def __init__(self, fileName):
+        self.fileOut = open(fileName, "wb")
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        return self.fileOut.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileOut, name)
+
+
+def scanSegment(segment):
+    """Return manifest row of existing WARC segment (used for segments that
+    were repaired after an interrupted capture)"""
+    row = {"segment": os.path.basename(segment), "warcinfoId": "", "records": 0,
+           "bytes": os.path.getsize(segment), "sha1": "", "firstUrl": "", "lastUrl": ""}
+    with open(segment, "rb") as fIn:
+        for record in ArchiveIterator(fIn):
+            row["records"] += 1
+            if record.rec_type == "warcinfo":
+                if not row["warcinfoId"]:
+                    row["warcinfoId"] = record.rec_headers.get_header("WARC-Record-ID")
+                continue
+            url = record.rec_headers.get_header("WARC-Target-URI")
+            if not row["firstUrl"]:
+                row["firstUrl"] = url
+            row["lastUrl"] = url
+
+    sha1 = hashlib.sha1()
+    with open(segment, "rb") as fIn:
+        for chunk in iter(partial(fIn.read, CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    row["sha1"] = sha1.hexdigest()
+    return row
+
+
+class SegmentManifest:
+    """Manifest of the WARC segments of a site, with the number of records,
+    size, SHA-1 and first and last URL of each segment. It is rewritten
+    whenever a segment is completed, so it lists all completed segments"""
+
+    def __init__(self, manifestFile):
+        self.manifestFile = manifestFile
+        # Segment name: row, in segment order
+        self.rows = {}
+
+    def load(self):
+        """Read manifest file, if it exists"""
+        if not os.path.isfile(self.manifestFile):
+            return
+        with open(self.manifestFile, "r", encoding="utf-8", newline="") as fIn:
+            for row in csv.DictReader(fIn):
+                self.rows[row["segment"]] = row
+
+    def add(self, row):
+        """Add row of completed segment, and save manifest"""
+        self.rows[row["segment"]] = row
+        self.save()
+
+    def repair(self, baseName):
+        """Update manifest to existing segments of site with baseName. Rows of
+        segments that were removed are dropped, and segments that are missing
+        or of which the size changed are scanned"""
+        rows = {}
+        for segment in existingSegments(baseName):
+            row = self.rows.get(os.path.basename(segment))
+            if row is None or int(row["bytes"]) != os.path.getsize(segment):
+                row = scanSegment(segment)
+            rows[row["segment"]] = row
+        self.rows = rows
+        self.save()
+
+    def save(self):
+        """Write manifest file (atomically)"""
+        tmpOut = self.manifestFile + ".tmp"
+        with open(tmpOut, "w", encoding="utf-8", newline="") as fOut:
+            writer = csv.DictWriter(fOut, fieldnames=MANIFEST_FIELDS)
+            writer.writeheader()
+            for row in self.rows.values():
+                writer.writerow(row)
+        os.replace(tmpOut, self.manifestFile)
+
+
+class SiteWriter:
+    """Serialized writer for the WARC segments of one site (baseName), starting
+    at segment index segment. A new segment is started once the current one
+    has maxBytes (compressed) bytes or maxRecords records; the records of one
+    URL always go to the same segment. Each segment starts with a warcinfo
+    record (with the fields in info), and is added to manifest
+    (SegmentManifest) when it is complete. If a journal is given, committed
+    URLs are checkpointed to it. If a digest index is given, payloads that
+    were captured before are written as revisit records; claims of new
+    payloads and the deduplication statistics of the site (for tape) are
+    committed to the index at each checkpoint"""
+
+    def __init__(self, baseName, journal=None, digestIndex=None, siteName=None, segment=0,
+                 maxBytes=None, maxRecords=None, info=None, manifest=None, tape=None):
+        self.baseName = baseName
+        self.segment = segment
+        self.maxBytes = maxBytes
+        self.maxRecords = maxRecords
+        self.info = info or {}
+        self.manifest = manifest
+        # Current segment, opened when its first record is written
+        self.warcOut = segmentName(baseName, segment)
+        self.fileOut = None
+        self.full = False
+        self.segmentBytes = 0
+        self.journal = journal
+        self.pending = []
+        self.lastCheckpoint = time.time()
+        self.digestIndex = digestIndex
+        self.siteName = siteName
+        self.tape = tape
+        # Digests claimed since the last checkpoint, and statistics at the
+        # last checkpoint
+        self.claims = []
+        self.committedStats = (0, 0, 0, 0)
+        self.run = uuid.uuid4().hex
+        self.records = 0
+        self.payloadBytes = 0
+        self.revisits = 0
+        self.savedBytes = 0
+        # (uri, date) of payloads that are written in full again because
+        # their original capture was in a replaced WARC of this site
+        self.recaptured = {}
+
+    def openSegment(self):
+        """Start the current segment with a warcinfo record"""
+        self.fileOut = DigestFile(self.warcOut)
+        self.writer = WARCWriter(self.fileOut, gzip=True)
+        # Unsorted CDXJ lines of all records written so far
+        self.indexOut = open(spillName(self.warcOut), "w", encoding="utf-8")
+        self.segmentRecords = 0
+        self.firstUrl = None
+        self.lastUrl = None
+
+        info = {"software": WARC_SOFTWARE,
+                "format": "WARC File Format 1.0",
+                "isPartOf": self.siteName,
+                "segment": self.segment,
+                "run": self.run}
+        info.update(self.info)
+        if self.maxBytes:
+            info["maxSegmentBytes"] = self.maxBytes
+        if self.maxRecords:
+            info["maxSegmentRecords"] = self.maxRecords
+        warcinfo = self.writer.create_warcinfo_record(os.path.basename(self.warcOut), info)
+        self.warcinfoId = warcinfo.rec_headers.get_header("WARC-Record-ID")
+        self.writeRecord(warcinfo)
+
+    def closeSegment(self):
+        """Checkpoint and close current segment, write its sorted CDXJ index,
+        and add it to the manifest"""
+        try:
+            self.checkpoint()
+        finally:
+            size = self.fileOut.tell()
+            self.fileOut.close()
+            self.indexOut.close()
+        finalizeIndex(self.warcOut)
+        self.segmentBytes += size
+        if self.manifest is not None:
+            self.manifest.add({"segment": os.path.basename(self.warcOut),
+                               "warcinfoId": self.warcinfoId,
+                               "records": self.segmentRecords,
+                               "bytes": size,
+                               "sha1": self.fileOut.sha1.hexdigest(),
+                               "firstUrl": self.firstUrl or "",
+                               "lastUrl": self.lastUrl or ""})
+
+    def ready(self):
+        """Make sure a segment with room for the next URL is open"""
+        if self.fileOut is not None and self.full:
+            self.closeSegment()
+            self.fileOut = None
+            self.full = False
+            self.segment += 1
+            self.warcOut = segmentName(self.baseName, self.segment)
+        if self.fileOut is None:
+            self.openSegment()
+
+    def original(self, exchange):
+        """Return (uri, date) of earlier capture of exchange's payload, or
+        None if the payload must be written in full"""
+        if (self.digestIndex is None or exchange.digest is None or
+                exchange.length < MIN_LENGTH or not exchange.statusLine.startswith("200")):
+            return None
+
+        original = self.digestIndex.claim(exchange.digest, exchange.url, exchange.date,
+                                          os.path.basename(self.warcOut), exchange.length,
+                                          self.siteName, self.run)
+        if original is None:
+            self.claims.append(exchange.digest)
+            return None
+
+        origUri, origDate, origSite, origRun = original
+        if origSite == self.siteName and origRun != self.run:
+            # Original is from an earlier run for this site. Its WARC was
+            # replaced, unless it belongs to a resumed capture and the URL
+            # was committed. The payload is then written in full again, but
+            # the index keeps the first capture, as revisit records of other
+            # sites and tapes refer to it
+            if self.journal is None or origUri not in self.journal.committed:
+                if exchange.digest in self.recaptured:
+                    return self.recaptured[exchange.digest]
+                self.recaptured[exchange.digest] = (exchange.url, exchange.date)
+                return None
+
+        return origUri, origDate
+
+    def write(self, exchange):
+        """Write request and response records for exchange"""
+        self.ready()
+        warcHeaders = {"WARC-Date": exchange.date, "WARC-Warcinfo-ID": self.warcinfoId}
+
+        requestHeaders = httpHeaders(exchange.requestLine, exchange.requestHeaders,
+                                     exchange.rawRequest, isRequest=True)
+        request = self.writer.create_warc_record(exchange.url, "request",
+                                                 http_headers=requestHeaders,
+                                                 warc_headers_dict=warcHeaders)
+
+        responseHeaders = httpHeaders(exchange.statusLine, exchange.headers,
+                                      exchange.rawHead, protocol=exchange.protocol)
+        warcHeaders = dict(warcHeaders)
+        if exchange.remoteIP:
+            warcHeaders["WARC-IP-Address"] = exchange.remoteIP
+
+        original = self.original(exchange)
+        if original is not None:
+            origUri, origDate = original
+            response = self.writer.create_revisit_record(exchange.url, exchange.digest,
+                                                         origUri, origDate,
+                                                         http_headers=responseHeaders,
+                                                         warc_headers_dict=warcHeaders)
+            self.revisits += 1
+            self.savedBytes += exchange.length
+        else:
+            if exchange.digest:
+                warcHeaders["WARC-Payload-Digest"] = exchange.digest
+            if exchange.blockDigest:
+                warcHeaders["WARC-Block-Digest"] = exchange.blockDigest
+            response = self.writer.create_warc_record(exchange.url, "response",
+                                                      payload=exchange.payload,
+                                                      length=exchange.length,
+                                                      http_headers=responseHeaders,
+                                                      warc_headers_dict=warcHeaders)
+
+        # Same as warcio's write_request_response_pair, but writing each
+        # record separately to get its offset and length
+        request.rec_headers.replace_header("WARC-Target-URI", exchange.url)
+        request.rec_headers.replace_header("WARC-Date",
+                                           response.rec_headers.get_header("WARC-Date"))
+        request.rec_headers.add_header("WARC-Concurrent-To",
+                                       response.rec_headers.get_header("WARC-Record-ID"))
+        self.writeRecord(response)
+        self.writeRecord(request)
+        self.payloadBytes += exchange.length
+
+    def writeRecord(self, record):
+        """Write record, and add its index line to the spill file"""
+        offset = self.fileOut.tell()
+        self.writer.write_record(record)
+        length = self.fileOut.tell() - offset
+        self.segmentRecords += 1
+        if record.rec_type == "warcinfo":
+            return
+        self.records += 1
+        if self.firstUrl is None:
+            self.firstUrl = record.rec_headers.get_header("WARC-Target-URI")
+        self.lastUrl = record.rec_headers.get_header("WARC-Target-URI")
+
+        line = cdxjLine(record, os.path.basename(self.warcOut), offset, length)
+        if line is not None:
+            self.indexOut.write(line + "\n")
+
+    def commit(self, url):
+        """Mark all records of url as written. The segment is full if it
+        reached its maximum size or number of records"""
+        self.ready()
+        if ((self.maxBytes and self.fileOut.tell() >= self.maxBytes) or
+                (self.maxRecords and self.segmentRecords >= self.maxRecords)):
+            self.full = True
+        if self.journal is None:
+            return
+        self.pending.append((url, os.path.basename(self.warcOut), self.fileOut.tell()))
+        if (len(self.pending) >= CHECKPOINT_URLS or
+                time.time() - self.lastCheckpoint >= CHECKPOINT_SECONDS):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Sync WARC file to disk, and then record pending URLs in journal"""
+        if self.journal is None or not self.pending:
+            return
+        for fileOut in [self.fileOut, self.indexOut]:
+            fileOut.flush()
+            os.fsync(fileOut.fileno())
+        self.journal.commit(self.pending)
+        self.commitDigests()
+        self.pending = []
+        self.lastCheckpoint = time.time()
+
+    def commitDigests(self):
+        """Commit claimed digests and statistics since the last checkpoint
+        to the digest index"""
+        if self.digestIndex is None:
+            return
+        stats = (self.records // 2, self.revisits, self.payloadBytes, self.savedBytes)
+        deltas = [new - old for new, old in zip(stats, self.committedStats)]
+        if not self.claims and not any(deltas):
+            return
+        self.digestIndex.commit(self.claims, self.tape, self.siteName, *deltas)
+        self.claims = []
+        self.committedStats = stats
+
+    def bytesWritten(self):
+        """Return number of (compressed) bytes written to all segments"""
+        if self.fileOut is None or self.fileOut.closed:
+            return self.segmentBytes
+        return self.segmentBytes + self.fileOut.tell()
+
+    def close(self):
+        """Close current segment (if any records were written). Without a
+        journal, claims and statistics are committed here"""
+        if self.fileOut is None or self.fileOut.closed:
+            return
+        self.closeSegment()
+        self.commitDigests()
+
+
+def captureUrls(urls, writer, fetcher, workers=4, onCommit=None, onExchange=None,
+                metrics=None):
+    """Fetch all URLs from iterable urls with fetcher, using a pool of worker
+    threads, and write results with writer in input order. Fetchers with a
+    submit method (asynchronous engines) are given up to 2 * workers URLs at
+    a time instead. Optional callback onCommit is called with each URL after
+    its records are written, and onExchange with each exchange (before its
+    payload is released). With metrics (SiteMetrics), the time spent waiting
+    for fetches, writing records and in onExchange is added to its fetch,
+    write and extract stages"""
+
+    # Fetches that are in progress, in input order. The window is bounded,
+    # so memory use doesn't depend on the number of URLs
+    window = deque()
+    maxWindow = 2 * workers
+    urlsIter = iter(urls)
+    exhausted = False
+    submit = getattr(fetcher, "submit", None)
+
+    # Stage timings (in seconds) and counters
+    seconds = {"fetch": 0.0, "write": 0.0, "extract": 0.0}
+    fetched = {"files": 0, "responses": 0, "bytes": 0, "errors": 0}
+    recordsStart = writer.records
+    bytesStart = writer.bytesWritten()
+
+    try:
+        with ThreadPoolExecutor(max_workers=1 if submit else workers) as pool:
+            if submit is None:
+                submit = partial(pool.submit, fetcher.fetch)
+
+            while True:
+                while not exhausted and len(window) < maxWindow:
+                    try:
+                        url = next(urlsIter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    window.append((url, submit(url)))
+
+                if not window:
+                    break
+
+                url, future = window.popleft()
+                timeStart = time.perf_counter()
+                try:
+                    exchanges = future.result()
+                except Exception:
+                    print("ERROR fetching " + url, file=sys.stderr)
+                    for _, pending in window:
+                        pending.cancel()
+                    raise
+                timeWritten = time.perf_counter()
+                seconds["fetch"] += timeWritten - timeStart
+                fetched["files"] += 1
+
+                for exchange in exchanges:
+                    fetched["responses"] += 1
+                    fetched["bytes"] += exchange.length
+                    if exchange.statusLine[:1] in ["4", "5"]:
+                        fetched["errors"] += 1
+                    try:
+                        writer.write(exchange)
+                        if onExchange is not None:
+                            timeExtract = time.perf_counter()
+                            onExchange(exchange)
+                            seconds["extract"] += time.perf_counter() - timeExtract
+                    finally:
+                        exchange.close()
+                writer.commit(url)
+                seconds["write"] += time.perf_counter() - timeWritten
+
+                if onCommit is not None:
+                    onCommit(url)
+    finally:
+        if metrics is not None:
+            metrics.add("fetch", seconds["fetch"], **fetched)
+            metrics.add("write", seconds["write"] - seconds["extract"],
+                        records=writer.records - recordsStart,
+                        bytes=writer.bytesWritten() - bytesStart)
+            if onExchange is not None:
+                metrics.add("extract", seconds["extract"])
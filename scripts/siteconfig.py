@@ -0,0 +1,403 @@
+"""
+Site configuration of xxLINK web servers
+
+Sites are defined in one of two formats:
+
+- CERN httpd config (httpd.conf on the DDS tapes), where each site starts
+  with a MultiHost directive, followed by Map, Exec and Welcome directives
+- Apache config (the configdb directory and httpd.conf.* files on the DLT
+  tapes, and the sites.conf files written by the restore scripts), with a
+  VirtualHost section for each site. Include directives are resolved
+  against the tape's copy of the original file system
+
+Both are parsed into a list of Site objects. Parse results are cached as
+JSON in CACHE_DIR, so the restore, config and capture scripts don't parse
+the same config again. A cache entry is valid as long as the modification
+times and sizes of all files that were read (including included files) are
+unchanged, or, if they did change, as long as their SHA-1 is.
+
+"""
+
+import os
+import sys
+import json
+import glob
+import hashlib
+
+# www directories of the original servers
+WWW_CERN = "/home/local/www"
+WWW_APACHE = "/export/home/local/www"
+
+# Prefix / suffix used in CERN Map entries (need to be stripped)
+MAP_PREFIX = "/htbin/htimage"
+MAP_SUFFIX = "/*.map"
+EXEC_SUFFIX = "/*"
+
+# Exec entries for the server-wide cgi-bin, which is not part of any site
+SHARED_EXEC_DIRS = ["/home/local/www/cgi-bin/*",
+                    "/home/local/www//cgi-bin/*"]
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "xxlink-siteconfig")
+CACHE_VERSION = 3
+
+# Encoding of config files
+ENCODING = "latin-1"
+
+# Maximum nesting of Include directives
+MAX_INCLUDE_DEPTH = 16
+
+FORMATS = ["cern", "apache"]
+
+
+class Site:
+    """Configuration of one site"""
+
+    # Attributes read from the config (and stored in the cache)
+    CONFIG_FIELDS = ["serverName", "url", "aliases", "documentRoot", "indexPage", "execDirs"]
+
+    __slots__ = CONFIG_FIELDS + ["pathIn", "pathOut", "execPaths"]
+
+    def __init__(self, serverName, url):
+        self.serverName = serverName
+        # Main host name (www. name for CERN MultiHost entries, first
+        # ServerAlias for Apache)
+        self.url = url
+        self.aliases = []
+        # Document root and exec (cgi-bin) dirs on the original server
+        self.documentRoot = None
+        self.indexPage = None
+        self.execDirs = []
+        # Document root and (input, output) pairs of exec dirs on the tape
+        # and in the restored tree; set by mapPaths
+        self.pathIn = None
+        self.pathOut = None
+        self.execPaths = []
+
+    def __repr__(self):
+        return "Site(" + self.serverName + ", " + str(self.documentRoot) + ")"
+
+    def toDict(self):
+        """Return config attributes as dictionary"""
+        return {field: getattr(self, field) for field in self.CONFIG_FIELDS}
+
+    @classmethod
+    def fromDict(cls, values):
+        """Return Site from dictionary returned by toDict"""
+        site = cls(values["serverName"], values["url"])
+        for field in cls.CONFIG_FIELDS:
+            setattr(site, field, values[field])
+        return site
+
+    def mapPaths(self, wwwPrefix, wwwIn, wwwOut):
+        """Set input and output paths by replacing www directory wwwPrefix of
+        the original server with wwwIn and wwwOut. Returns False if the
+        site's document root is not inside wwwPrefix"""
+        if self.documentRoot is None or not isBelow(self.documentRoot, wwwPrefix):
+            return False
+        self.pathIn = wwwIn + self.documentRoot[len(wwwPrefix):]
+        self.pathOut = wwwOut + self.documentRoot[len(wwwPrefix):]
+        self.execPaths = [(wwwIn + d[len(wwwPrefix):], wwwOut + d[len(wwwPrefix):])
+                          for d in self.execDirs if isBelow(d, wwwPrefix)]
+        return True
+
+
+def isBelow(path, directory):
+    """Return True if path is directory, or inside it"""
+    return path == directory or path.startswith(directory.rstrip("/") + "/")
+
+
+def mapSites(sites, wwwPrefix, wwwIn, wwwOut):
+    """Map paths of sites (see Site.mapPaths), and return list of sites that
+    can be restored"""
+    mapped = []
+    for site in sites:
+        if site.mapPaths(wwwPrefix, wwwIn, wwwOut):
+            mapped.append(site)
+        else:
+            print("WARNING: no document root in " + wwwPrefix + " for " + site.serverName +
+                  ", skipping", file=sys.stderr)
+    return mapped
+
+
+def parseCernConfig(lines):
+    """Parse lines of CERN httpd config, and return list of sites (test
+    entries excluded)"""
+    sites = []
+    site = None
+
+    def addSite(site):
+        # Ignore test entries
+        if site is not None and not site.serverName.startswith("test"):
+            sites.append(site)
+
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        keyword = words[0]
+
+        if keyword == "MultiHost" and len(words) > 1:
+            # Start of new site definition
+            addSite(site)
+            url = words[1]
+            serverName = url[len("www."):] if url.startswith("www.") else url
+            site = Site(serverName, url)
+        elif site is None or len(words) < 2:
+            continue
+        elif keyword == "Map" and len(words) > 2 and site.documentRoot is None:
+            # Only 1st map entry of a site defines its root
+            mapPath = words[2]
+            if mapPath != "/noproxy.htm":
+                if mapPath.startswith(MAP_PREFIX):
+                    mapPath = mapPath[len(MAP_PREFIX):]
+                if mapPath.endswith(MAP_SUFFIX):
+                    mapPath = mapPath[:-len(MAP_SUFFIX)]
+                site.documentRoot = mapPath
+        elif keyword == "Exec" and len(words) > 2:
+            execPath = words[2]
+            if execPath not in SHARED_EXEC_DIRS:
+                if execPath.endswith(EXEC_SUFFIX):
+                    execPath = execPath[:-len(EXEC_SUFFIX)]
+                site.execDirs.append(execPath)
+        elif keyword == "Welcome" and site.indexPage is None:
+            site.indexPage = words[1]
+
+    # Last entry isn't followed by another MultiHost
+    addSite(site)
+    return sites
+
+
+def parseApacheConfig(lines):
+    """Parse lines of Apache config (with includes already resolved), and
+    return list of sites, one for each VirtualHost section with a
+    ServerName"""
+    sites = []
+    values = None
+
+    for line in lines:
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+        keyword = words[0].lower()
+
+        if keyword.startswith("<virtualhost"):
+            values = {"aliases": []}
+        elif keyword == "</virtualhost>":
+            if values is not None and "servername" in values:
+                aliases = values["aliases"]
+                site = Site(values["servername"], aliases[0] if aliases else values["servername"])
+                site.aliases = aliases
+                site.documentRoot = values.get("documentroot")
+                site.indexPage = values.get("directoryindex")
+                site.execDirs = values.get("scriptalias", [])
+                sites.append(site)
+            values = None
+        elif values is None or len(words) < 2:
+            continue
+        elif keyword == "serveralias":
+            values["aliases"].extend(words[1:])
+        elif keyword == "scriptalias" and len(words) > 2:
+            values.setdefault("scriptalias", []).append(words[2].strip('"').rstrip("/"))
+        elif keyword in ["servername", "documentroot", "directoryindex"]:
+            values[keyword] = words[1].strip('"').rstrip("/") or "/"
+        elif keyword == "redirectmatch":
+            # Redirect of the domain root to the index page, as written by the
+            # restore scripts (optionally preceded by a status)
+            args = [w.strip('"') for w in words[1:] if not w.isdigit()]
+            if len(args) == 2 and args[0] == "^/$" and "directoryindex" not in values:
+                values["directoryindex"] = args[1].lstrip("/")
+
+    return sites
+
+
+def includeFiles(pattern, configFile, root):
+    """Return list of files for Include pattern in configFile. Absolute
+    patterns are looked up below root (the directory that holds the tape's
+    copy of the original file system, or part of it), relative ones in the
+    directory of configFile and its parents up to root"""
+    if os.path.isabs(pattern):
+        parts = pattern.strip("/").split("/")
+        candidates = [os.path.join(root, *parts[i:]) for i in range(len(parts))]
+    else:
+        candidates = []
+        current = os.path.dirname(configFile)
+        while True:
+            candidates.append(os.path.join(current, pattern))
+            if current == root or len(current) <= len(root):
+                break
+            current = os.path.dirname(current)
+
+    for candidate in candidates:
+        matches = sorted(glob.glob(candidate))
+        if matches:
+            files = []
+            for match in matches:
+                if os.path.isdir(match):
+                    files.extend(os.path.join(match, name) for name in sorted(os.listdir(match))
+                                 if os.path.isfile(os.path.join(match, name)))
+                else:
+                    files.append(match)
+            return files
+    return []
+
+
+def configDirFiles(configDir):
+    """Return paths of all config files in directory configDir"""
+    return [os.path.join(configDir, name) for name in sorted(os.listdir(configDir))
+            if os.path.isfile(os.path.join(configDir, name))]
+
+
+def readLines(configFile, root, filesRead, depth=0, expansions=None):
+    """Yield lines of Apache config file, with Include directives replaced
+    by the lines of the included files. Paths of all files that are read
+    are appended to filesRead, and Include patterns with the files they
+    expanded to to expansions"""
+    filesRead.append(configFile)
+    with open(configFile, encoding=ENCODING) as configIn:
+        lines = configIn.readlines()
+
+    for line in lines:
+        words = line.split()
+        if len(words) > 1 and words[0].lower() == "include":
+            pattern = words[1].strip('"')
+            included = includeFiles(pattern, configFile, root)
+            if expansions is not None:
+                expansions.append(["include", pattern, configFile, included])
+            if not included:
+                print("WARNING: cannot resolve Include " + pattern + " in " + configFile,
+                      file=sys.stderr)
+            elif depth >= MAX_INCLUDE_DEPTH:
+                print("WARNING: Include nested too deeply in " + configFile, file=sys.stderr)
+            for includedFile in included:
+                yield from readLines(includedFile, root, filesRead, depth + 1, expansions)
+        else:
+            yield line
+
+
+def fileStamps(files):
+    """Return list of [path, size, mtime] of files (None if a file is
+    gone)"""
+    stamps = []
+    for path in files:
+        try:
+            fileStat = os.stat(path)
+            stamps.append([path, fileStat.st_size, fileStat.st_mtime_ns])
+        except OSError:
+            return None
+    return stamps
+
+
+def filesHash(files):
+    """Return SHA-1 of the names and contents of files, or None if one is
+    gone"""
+    digest = hashlib.sha1()
+    for path in files:
+        digest.update(os.fsencode(path) + b"\0")
+        try:
+            with open(path, "rb") as fIn:
+                digest.update(fIn.read())
+        except OSError:
+            return None
+    return digest.hexdigest()
+
+
+def cacheFile(configPath, configFormat, root, cacheDir):
+    """Return path of cache entry for config"""
+    key = hashlib.sha1(os.fsencode(configFormat + ":" + configPath + ":" + root)).hexdigest()
+    return os.path.join(cacheDir, key + ".json")
+
+
+def expansionsCurrent(expansions, root):
+    """Return True if config directories and Include patterns (as recorded
+    by readConfig) still expand to the same files, so no config files were
+    added or removed"""
+    for expansion in expansions:
+        try:
+            if expansion[0] == "dir":
+                files = configDirFiles(expansion[1])
+            else:
+                files = includeFiles(expansion[1], expansion[2], root)
+        except OSError:
+            return False
+        if files != expansion[-1]:
+            return False
+    return True
+
+
+def loadCache(entryFile, root):
+    """Return cached sites of entryFile, or None if it is not valid"""
+    try:
+        with open(entryFile, encoding="utf-8") as fIn:
+            entry = json.load(fIn)
+    except (OSError, ValueError):
+        return None
+    if entry.get("version") != CACHE_VERSION:
+        return None
+
+    if not expansionsCurrent(entry["expansions"], root):
+        return None
+    files = [stamp[0] for stamp in entry["files"]]
+    if fileStamps(files) != entry["files"]:
+        if filesHash(files) != entry["hash"]:
+            return None
+        # Touched, but not changed
+        entry["files"] = fileStamps(files)
+        saveCache(entryFile, entry)
+    return [Site.fromDict(values) for values in entry["sites"]]
+
+
+def saveCache(entryFile, entry):
+    """Write cache entry (atomically)"""
+    try:
+        os.makedirs(os.path.dirname(entryFile), exist_ok=True)
+        entryTmp = entryFile + "." + str(os.getpid()) + ".tmp"
+        with open(entryTmp, "w", encoding="utf-8") as fOut:
+            json.dump(entry, fOut)
+        os.replace(entryTmp, entryFile)
+    except OSError as e:
+        print("WARNING: cannot write config cache " + entryFile + ": " + str(e),
+              file=sys.stderr)
+
+
+def readConfig(configPath, configFormat, root=None, cacheDir=CACHE_DIR):
+    """Return list of sites defined in config file (or, for Apache configs,
+    a directory of config files such as configdb). root is the directory that
+    corresponds to the original file system, for resolving Include
+    directives (default: the config's parent directory). If cacheDir is
+    None, the cache is not used"""
+    if configFormat not in FORMATS:
+        raise ValueError("unknown config format " + configFormat)
+    configPath = os.path.abspath(configPath)
+    root = os.path.abspath(root if root is not None else os.path.dirname(configPath))
+
+    if cacheDir is not None:
+        entryFile = cacheFile(configPath, configFormat, root, cacheDir)
+        sites = loadCache(entryFile, root)
+        if sites is not None:
+            return sites
+
+    expansions = []
+    if os.path.isdir(configPath):
+        configFiles = configDirFiles(configPath)
+        expansions.append(["dir", configPath, configFiles])
+    else:
+        configFiles = [configPath]
+
+    filesRead = []
+    sites = []
+    for configFile in configFiles:
+        if configFormat == "cern":
+            filesRead.append(configFile)
+            with open(configFile, encoding=ENCODING) as configIn:
+                sites.extend(parseCernConfig(configIn))
+        else:
+            sites.extend(parseApacheConfig(readLines(configFile, root, filesRead,
+                                                     expansions=expansions)))
+
+    if cacheDir is not None:
+        saveCache(entryFile, {"version": CACHE_VERSION,
+                              "files": fileStamps(filesRead),
+                              "expansions": expansions,
+                              "hash": filesHash(filesRead),
+                              "sites": [site.toDict() for site in sites]})
+    return sites
@@ -0,0 +1,175 @@
+"""
+Inventory of site directory trees
+
+Before a restore or capture run, each site's directory (pathIn for
+restores, DocumentRoot for captures) is walked once, and its file count,
+total bytes, number of directories and links, largest files and a histogram
+of file extensions are stored in an inventory index (a JSON file). Sites
+are walked in parallel, and sites that are already in the index are not
+walked again (unless a rescan is requested).
+
+The restore and capture scripts use the inventory to process the largest
+sites first (which gives better packing when sites are processed in
+parallel), and to estimate the remaining time of a run.
+
+"""
+
+import os
+import sys
+import time
+import json
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+SCAN_WORKERS = 8
+
+# Number of largest files that are kept for each site
+LARGEST_FILES = 10
+
+
+def scanTree(rootDir, largestFiles=LARGEST_FILES):
+    """Walk rootDir (without following links), and return dictionary with
+    its inventory"""
+    entry = {"files": 0, "bytes": 0, "dirs": 0, "links": 0, "errors": 0,
+             "largest": [], "extensions": {}}
+    # Min-heap of (size, relPath) of the largest files
+    largest = []
+    extensions = entry["extensions"]
+
+    stack = [rootDir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError as e:
+            print("ERROR reading " + current + ": " + str(e), file=sys.stderr)
+            entry["errors"] += 1
+            continue
+        entry["dirs"] += 1
+        for dirEntry in entries:
+            try:
+                if dirEntry.is_symlink():
+                    entry["links"] += 1
+                elif dirEntry.is_dir(follow_symlinks=False):
+                    stack.append(dirEntry.path)
+                elif dirEntry.is_file(follow_symlinks=False):
+                    size = dirEntry.stat(follow_symlinks=False).st_size
+                    entry["files"] += 1
+                    entry["bytes"] += size
+                    extension = os.path.splitext(dirEntry.name)[1].lower()
+                    counts = extensions.setdefault(extension, [0, 0])
+                    counts[0] += 1
+                    counts[1] += size
+                    item = (size, os.path.relpath(dirEntry.path, rootDir))
+                    if len(largest) < largestFiles:
+                        heapq.heappush(largest, item)
+                    elif item > largest[0]:
+                        heapq.heapreplace(largest, item)
+            except OSError as e:
+                print("ERROR reading " + dirEntry.path + ": " + str(e), file=sys.stderr)
+                entry["errors"] += 1
+
+    entry["largest"] = sorted(largest, reverse=True)
+    return entry
+
+
+class Inventory:
+    """Index of site inventories, by root directory"""
+
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+        self.sites = {}
+
+    def load(self):
+        """Read index file, if it exists"""
+        try:
+            with open(self.indexFile, encoding="utf-8") as fIn:
+                self.sites = json.load(fIn)
+        except FileNotFoundError:
+            self.sites = {}
+
+    def save(self):
+        """Write index file (atomically)"""
+        indexTmp = self.indexFile + ".tmp"
+        with open(indexTmp, "w", encoding="utf-8") as fOut:
+            json.dump(self.sites, fOut, indent=1)
+        os.replace(indexTmp, self.indexFile)
+
+    def get(self, rootDir):
+        """Return inventory of rootDir, or None"""
+        return self.sites.get(os.path.abspath(rootDir))
+
+    def scan(self, rootDirs, workers=SCAN_WORKERS, rescan=False):
+        """Walk all rootDirs that are not in the index yet (or all of them
+        with rescan) in parallel, and add their inventories. Returns number
+        of directories walked"""
+        rootDirs = [os.path.abspath(d) for d in rootDirs]
+        todo = [d for d in dict.fromkeys(rootDirs)
+                if os.path.isdir(d) and (rescan or d not in self.sites)]
+
+        def scanOne(rootDir):
+            entry = scanTree(rootDir)
+            entry["scanned"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            return entry
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for rootDir, entry in zip(todo, pool.map(scanOne, todo)):
+                self.sites[rootDir] = entry
+        return len(todo)
+
+    def cost(self, rootDir):
+        """Return (bytes, files) of rootDir, or (0, 0) if it is unknown"""
+        entry = self.get(rootDir)
+        if entry is None:
+            return 0, 0
+        return entry["bytes"], entry["files"]
+
+
+def formatDuration(seconds):
+    """Return seconds as h:mm:ss"""
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Eta:
+    """Estimate of the remaining time of a run, based on the bytes done so
+    far"""
+
+    def __init__(self, totalBytes, totalSites):
+        self.totalBytes = totalBytes
+        self.totalSites = totalSites
+        self.doneBytes = 0
+        self.doneSites = 0
+        self.timeStart = time.time()
+
+    def add(self, siteBytes):
+        """Register completed site of siteBytes bytes"""
+        self.doneBytes += siteBytes
+        self.doneSites += 1
+
+    def line(self):
+        """Return progress line with estimated time remaining"""
+        elapsed = time.time() - self.timeStart
+        line = "Done {} of {} sites, {} of {} bytes; elapsed {}".format(
+            self.doneSites, self.totalSites, self.doneBytes, self.totalBytes,
+            formatDuration(elapsed))
+        if 0 < self.doneBytes < self.totalBytes:
+            remaining = elapsed * (self.totalBytes - self.doneBytes) / self.doneBytes
+            line += ", ETA " + formatDuration(remaining)
+        return line
+
+
+def loadInventory(indexFile, rootDirs, rescan=False, workers=SCAN_WORKERS):
+    """Load inventory index, add rootDirs that are not in it yet (or all of
+    them with rescan), save it, and return it. If indexFile is None, all
+    rootDirs are walked and nothing is saved"""
+    inventory = Inventory(indexFile)
+    if indexFile is not None:
+        inventory.load()
+    scanned = inventory.scan(rootDirs, workers, rescan)
+    if scanned and indexFile is not None:
+        inventory.save()
+    print("Inventory: walked {} of {} site directories".format(scanned, len(rootDirs)),
+          file=sys.stderr)
+    return inventory
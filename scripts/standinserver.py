@@ -0,0 +1,291 @@
+"""
+Stand-in HTTP server for restored xxLINK sites
+
+Serves the VirtualHosts of a sites.conf file (as written by the restore
+scripts) straight from their DocumentRoots, so sites can be captured without
+a system Apache, /etc/hosts entries or root access. The server listens on an
+ephemeral port on 127.0.0.1, and routes requests by Host header (or by the
+host in an absolute request URI, so capture clients can simply use it as
+their HTTP proxy); unknown hosts go to the first VirtualHost, like Apache's
+default host. Since every capture run has its own server, tapes with the
+same host names can be captured at the same time.
+
+Responses follow the restored Apache configuration as closely as a static
+server can: RedirectMatch of the domain root to the index page (302),
+trailing-slash redirects for directories (301), index.html or a directory
+listing for directories, and the same headers as the direct capture engine
+for static files. CGI scripts are served as plain files, and directory
+listings are simpler than Apache's mod_autoindex pages.
+
+"""
+
+import os
+import sys
+import stat
+import asyncio
+import threading
+from html import escape
+from urllib.parse import urlsplit, unquote_to_bytes, quote
+from directcapture import staticHeaders, httpDate
+from sitecapture import URL_SAFE
+
+LISTEN_HOST = "127.0.0.1"
+
+# Apache's default DirectoryIndex
+DIRECTORY_INDEX = b"index.html"
+
+# Seconds an idle keep-alive connection is kept open (Apache's KeepAliveTimeout)
+KEEPALIVE_TIMEOUT = 5
+
+# Maximum number of header lines in a request
+MAX_HEADERS = 100
+
+REASONS = {200: "OK", 301: "Moved Permanently", 302: "Found", 400: "Bad Request",
+           403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error"}
+
+MESSAGES = {301: "The document has moved <a href=\"{location}\">here</a>.",
+            302: "The document has moved <a href=\"{location}\">here</a>.",
+            400: "Your browser sent a request that this server could not understand.",
+            403: "You don't have permission to access this resource.",
+            404: "The requested URL was not found on this server.",
+            405: "The requested method is not allowed for this URL.",
+            500: "The server encountered an internal error."}
+
+
+def errorPage(status, location=""):
+    """Return HTML body of error or redirect response, in Apache's format"""
+    return ("<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n"
+            "<html><head>\n<title>{status} {reason}</title>\n</head><body>\n"
+            "<h1>{reason}</h1>\n<p>{message}</p>\n</body></html>\n").format(
+            status=status, reason=REASONS[status],
+            message=MESSAGES[status].format(location=escape(location))).encode("latin-1")
+
+
+def listingPage(urlPath, names):
+    """Return HTML body of directory listing of urlPath (bytes) with entries
+    names (bytes; directories end with a slash)"""
+    title = escape(os.fsdecode(urlPath))
+    lines = ["<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 3.2 Final//EN\">",
+             "<html>", " <head>", "  <title>Index of " + title + "</title>", " </head>",
+             " <body>", "<h1>Index of " + title + "</h1>", "<ul>",
+             "<li><a href=\"../\"> Parent Directory</a></li>"]
+    for name in names:
+        lines.append("<li><a href=\"" + quote(name, safe=URL_SAFE) + "\"> " +
+                     escape(os.fsdecode(name)) + "</a></li>")
+    lines += ["</ul>", "</body></html>", ""]
+    return "\n".join(lines).encode("utf-8", "surrogateescape")
+
+
+class StandInServer:
+    """Static HTTP server for sites (list of Site objects with serverName,
+    url, aliases, documentRoot and indexPage), running in its own thread"""
+
+    def __init__(self, sites):
+        self.hosts = {}
+        self.default = None
+        for site in sites:
+            if site.documentRoot is None:
+                continue
+            if self.default is None:
+                self.default = site
+            for host in [site.serverName, site.url] + list(site.aliases):
+                self.hosts.setdefault(host.lower(), site)
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.port = None
+        self.requests = 0
+
+    def start(self):
+        """Start server thread, and return its address (host, port)"""
+        started = threading.Event()
+        errors = []
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.handle, LISTEN_HOST, 0))
+                self.port = self.server.sockets[0].getsockname()[1]
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            try:
+                self.loop.run_forever()
+            finally:
+                # Close open connections (e.g. idle keep-alive ones)
+                self.server.close()
+                tasks = asyncio.all_tasks(self.loop)
+                for task in tasks:
+                    task.cancel()
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                self.loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return LISTEN_HOST, self.port
+
+    def proxyUrl(self):
+        """Return address of server as proxy URL for capture clients"""
+        return "http://{}:{}".format(LISTEN_HOST, self.port)
+
+    def stop(self):
+        """Stop server thread"""
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def site(self, host):
+        """Return site for host name (with optional port)"""
+        host = host.lower().split(":")[0]
+        return self.hosts.get(host, self.default)
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until it is closed"""
+        try:
+            while True:
+                try:
+                    requestLine = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not requestLine:
+                    break
+                if requestLine in [b"\r\n", b"\n"]:
+                    # Stray line break between pipelined requests
+                    continue
+                headers = {}
+                for _ in range(MAX_HEADERS):
+                    line = await reader.readline()
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keepAlive = await self.respond(requestLine, headers, reader, writer)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Server is stopped
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, requestLine, headers, reader, writer):
+        """Write response to request; returns True if the connection is kept
+        open"""
+        self.requests += 1
+        words = requestLine.decode("latin-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.writeResponse(writer, 400, [], errorPage(400), False, True)
+            return False
+        method, target, version = words
+
+        if version == "HTTP/1.0":
+            keepAlive = headers.get("connection", "").lower() == "keep-alive"
+        else:
+            keepAlive = headers.get("connection", "").lower() != "close"
+
+        # Discard request body, if any
+        length = headers.get("content-length", "0")
+        if length.isdigit() and int(length) > 0:
+            await reader.readexactly(int(length))
+
+        isHead = method == "HEAD"
+        if method not in ["GET", "HEAD"]:
+            self.writeResponse(writer, 405, [("Allow", "GET,HEAD")], errorPage(405),
+                               keepAlive, isHead)
+            return keepAlive
+
+        # Absolute request URIs (proxy requests) take precedence over Host
+        parts = urlsplit(target)
+        host = parts.netloc or headers.get("host", "")
+        site = self.site(host)
+        urlPath = unquote_to_bytes(parts.path or "/")
+        if site is None or not urlPath.startswith(b"/") or b".." in urlPath.split(b"/"):
+            self.writeResponse(writer, 400, [], errorPage(400), keepAlive, isHead)
+            return keepAlive
+        hostName = host.split(":")[0] if host else site.url
+
+        # RedirectMatch ^/$ to the index page
+        if urlPath == b"/" and site.indexPage:
+            location = "http://" + hostName + "/" + site.indexPage.lstrip("/")
+            self.writeResponse(writer, 302, [("Location", location)],
+                               errorPage(302, location), keepAlive, isHead)
+            return keepAlive
+
+        if os.path.basename(urlPath).startswith(b".ht"):
+            self.writeResponse(writer, 403, [], errorPage(403), keepAlive, isHead)
+            return keepAlive
+
+        path = os.path.join(os.fsencode(site.documentRoot), urlPath.lstrip(b"/"))
+        try:
+            pathStat = os.stat(path)
+            if stat.S_ISDIR(pathStat.st_mode):
+                if not urlPath.endswith(b"/"):
+                    location = "http://" + hostName + quote(urlPath + b"/", safe=URL_SAFE)
+                    self.writeResponse(writer, 301, [("Location", location)],
+                                       errorPage(301, location), keepAlive, isHead)
+                    return keepAlive
+                indexPath = os.path.join(path, DIRECTORY_INDEX)
+                if os.path.isfile(indexPath):
+                    path = indexPath
+                else:
+                    self.writeListing(writer, path, urlPath, keepAlive, isHead)
+                    return keepAlive
+            await self.writeFile(writer, path, keepAlive, isHead)
+        except FileNotFoundError:
+            self.writeResponse(writer, 404, [], errorPage(404), keepAlive, isHead)
+        except (PermissionError, NotADirectoryError):
+            self.writeResponse(writer, 403, [], errorPage(403), keepAlive, isHead)
+        except OSError as e:
+            print("ERROR serving " + os.fsdecode(path) + ": " + str(e), file=sys.stderr)
+            self.writeResponse(writer, 500, [], errorPage(500), keepAlive, isHead)
+        return keepAlive
+
+    def writeHead(self, writer, status, headers, keepAlive):
+        """Write status line and headers"""
+        lines = ["HTTP/1.1 {} {}".format(status, REASONS[status])]
+        lines += ["{}: {}".format(name, value) for name, value in headers]
+        if not keepAlive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    def writeResponse(self, writer, status, headers, body, keepAlive, isHead,
+                      contentType="text/html; charset=iso-8859-1"):
+        """Write response with body (bytes)"""
+        headers = [("Date", httpDate(None))] + headers + \
+            [("Content-Length", str(len(body))), ("Content-Type", contentType)]
+        self.writeHead(writer, status, headers, keepAlive)
+        if not isHead:
+            writer.write(body)
+
+    def writeListing(self, writer, path, urlPath, keepAlive, isHead):
+        """Write directory listing"""
+        names = []
+        with os.scandir(path) as it:
+            for entry in sorted(it, key=lambda entry: entry.name):
+                if entry.name.startswith(b"."):
+                    continue
+                names.append(entry.name + b"/" if entry.is_dir() else entry.name)
+        self.writeResponse(writer, 200, [], listingPage(urlPath, names), keepAlive, isHead,
+                           "text/html;charset=UTF-8")
+
+    async def writeFile(self, writer, path, keepAlive, isHead):
+        """Write static file"""
+        with open(path, "rb") as fileIn:
+            fileStat = os.fstat(fileIn.fileno())
+            self.writeHead(writer, 200, staticHeaders(path, fileStat), keepAlive)
+            if isHead or fileStat.st_size == 0:
+                return
+            await writer.drain()
+            await self.loop.sendfile(writer.transport, fileIn, 0, fileStat.st_size)
@@ -0,0 +1,197 @@
+"""
+Catalog of xxLINK tape images
+
+The catalog is an SQLite database with one row for each tape image (.dd
+file), that records its format (dump or tar), and for dump images the byte
+order and the label information of the tape header (dump dates, file
+system, device and host). Images are identified from their first header
+block only, so scanning a complete tapes-DDS or tapes-DLT tree is fast;
+images that didn't change since the previous scan are skipped.
+
+"""
+
+import os
+import sys
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dumpreader import TP_BSIZE, DumpError, headerByteOrder, headerLabel, cString
+
+# Extension of tape image files
+IMAGE_SUFFIX = ".dd"
+
+SCAN_WORKERS = 16
+
+COLUMNS = ["path", "tapeSet", "tape", "fileName", "size", "mtime", "format", "byteOrder",
+           "dumpDate", "previousDate", "volume", "level", "label", "filesys", "device", "host",
+           "flags", "firstMember", "scanned"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    tapeSet TEXT NOT NULL,
+    tape TEXT NOT NULL,
+    fileName TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    byteOrder TEXT NOT NULL,
+    dumpDate TEXT NOT NULL,
+    previousDate TEXT NOT NULL,
+    volume INTEGER,
+    level INTEGER,
+    label TEXT NOT NULL,
+    filesys TEXT NOT NULL,
+    device TEXT NOT NULL,
+    host TEXT NOT NULL,
+    flags INTEGER,
+    firstMember TEXT NOT NULL,
+    scanned TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS imagesTape ON images (tapeSet, tape);
+"""
+
+
+def isoDate(timestamp):
+    """Return dump date as ISO 8601 string ("" if not set)"""
+    if not timestamp:
+        return ""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def tarChecksumOk(header):
+    """Return True if header is a valid (pre-POSIX) tar header"""
+    try:
+        checksum = int(header[148:156].strip(b" \0") or b"-1", 8)
+    except ValueError:
+        return False
+    return checksum == sum(header[:148]) + 8 * ord(" ") + sum(header[156:512])
+
+
+def identify(path):
+    """Return dictionary with catalog columns for image at path, read from
+    its first header block"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        imageStat = os.fstat(fd)
+        header = os.pread(fd, TP_BSIZE, 0)
+    finally:
+        os.close(fd)
+
+    parts = os.path.abspath(path).split(os.sep)
+    tapeSets = [p[len("tapes-"):] for p in parts if p.startswith("tapes-")]
+    image = dict.fromkeys(COLUMNS, "")
+    image.update({"path": os.path.abspath(path),
+                  "tapeSet": tapeSets[-1] if tapeSets else "",
+                  "tape": parts[-2] if len(parts) > 1 else "",
+                  "fileName": parts[-1],
+                  "size": imageStat.st_size,
+                  "mtime": int(imageStat.st_mtime),
+                  "format": "unknown",
+                  "volume": None,
+                  "level": None,
+                  "flags": None,
+                  "scanned": isoDate(time.time())})
+
+    if len(header) == TP_BSIZE:
+        try:
+            byteOrder = headerByteOrder(header)
+        except DumpError:
+            image["format"] = "old-dump"
+            return image
+        if byteOrder is not None:
+            label = headerLabel(header, byteOrder)
+            image.update({"format": "dump",
+                          "byteOrder": "big" if byteOrder == ">" else "little",
+                          "dumpDate": isoDate(label["date"]),
+                          "previousDate": isoDate(label["ddate"]),
+                          "volume": label["volume"],
+                          "level": label["level"],
+                          "label": label["label"],
+                          "filesys": label["filesys"],
+                          "device": label["dev"],
+                          "host": label["host"],
+                          "flags": label["flags"]})
+            return image
+
+    if len(header) >= 512 and (header[257:262] == b"ustar" or tarChecksumOk(header)):
+        image["format"] = "tar"
+        image["firstMember"] = cString(header[:100])
+    return image
+
+
+def findImages(dirs):
+    """Yield paths of all tape images below dirs"""
+    for topDir in dirs:
+        for root, subDirs, files in os.walk(topDir):
+            subDirs.sort()
+            for name in sorted(files):
+                if name.endswith(IMAGE_SUFFIX):
+                    yield os.path.join(root, name)
+
+
+class TapeCatalog:
+    """Catalog of tape images"""
+
+    def __init__(self, catalogFile):
+        self.catalogFile = catalogFile
+        self.db = sqlite3.connect(catalogFile, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def isCurrent(self, path):
+        """Return True if image at path is in the catalog, and didn't
+        change since it was scanned"""
+        row = self.db.execute("SELECT size, mtime FROM images WHERE path = ?",
+                              (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return False
+        imageStat = os.stat(path)
+        return row["size"] == imageStat.st_size and row["mtime"] == int(imageStat.st_mtime)
+
+    def scan(self, dirs, workers=SCAN_WORKERS, rescan=False):
+        """Identify all images below dirs in parallel, and store them in the
+        catalog. Returns (scanned, skipped) counts"""
+        allPaths = list(findImages(dirs))
+        paths = [p for p in allPaths if rescan or not self.isCurrent(p)]
+        skipped = len(allPaths) - len(paths)
+
+        def identifyOne(path):
+            try:
+                return identify(path)
+            except OSError as e:
+                print("ERROR reading " + path + ": " + str(e), file=sys.stderr)
+                return None
+
+        scanned = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            with self.db:
+                for image in pool.map(identifyOne, paths):
+                    if image is None:
+                        continue
+                    self.db.execute("INSERT OR REPLACE INTO images VALUES (" +
+                                    ", ".join("?" * len(COLUMNS)) + ")",
+                                    [image[c] for c in COLUMNS])
+                    scanned += 1
+        return scanned, skipped
+
+    def query(self, **conditions):
+        """Return rows of images that match all conditions (column=value
+        pairs; None values are ignored), ordered by path"""
+        conditions = {k: v for k, v in conditions.items() if v is not None}
+        for column in conditions:
+            if column not in COLUMNS:
+                raise ValueError("unknown catalog column " + column)
+        where = " AND ".join(column + " = ?" for column in conditions)
+        sql = "SELECT * FROM images" + (" WHERE " + where if where else "") + " ORDER BY path"
+        return self.db.execute(sql, list(conditions.values())).fetchall()
+
+    def lookup(self, path):
+        """Return row of image at path, or None"""
+        return self.db.execute("SELECT * FROM images WHERE path = ?",
+                               (os.path.abspath(path),)).fetchone()
+
+    def close(self):
+        """Close catalog"""
+        self.db.close()
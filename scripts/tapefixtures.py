@@ -0,0 +1,311 @@
+"""
+Synthetic xxLINK tape trees for benchmarks
+
+Generates restored tape trees with the shape of the real ones, but with
+made-up content, so the restore and capture scripts can be benchmarked
+without the (large, sensitive) real tapes:
+
+- DDS layout: home/local/etc/httpd.conf (CERN httpd, with MultiHost, Map,
+  Exec and Welcome blocks, a test entry and the shared cgi-bin), sites under
+  home/local/www, and shared icons that sites link to
+- DLT layout: apache.intel/conf/configdb with one VirtualHost file per site
+  (which Include a common file), sites under www
+
+Each site has a nested directory tree with thousands of small files (HTML
+pages that link to each other and to imagemaps, GIFs, imagemap files, text),
+a cgi-bin directory, Latin-1 file names, broken absolute symlinks, absolute
+symlinks to the shared icons and relative links. Content only depends on
+the random seed, so the same parameters always give the same trees.
+
+"""
+
+import os
+import json
+import random
+
+# Parameters file written in each generated tree
+PARAMS_FILE = "fixture.json"
+
+# Share of each file type
+FILE_TYPES = [(".html", 0.5), (".gif", 0.33), (".map", 0.05), (".txt", 0.07), (".jpg", 0.05)]
+
+# Maximum number of files in one directory, and directory depth
+FILES_PER_DIR = 24
+MAX_DEPTH = 3
+
+# Fractions of files with a Latin-1 name, and of broken absolute, absolute
+# (shared icon) and relative symlinks (per file)
+LATIN1_NAMES = 0.03
+BROKEN_LINKS = 0.01
+SHARED_LINKS = 0.01
+RELATIVE_LINKS = 0.005
+
+LATIN1_WORDS = ["caf\xe9", "m\xfcnchen", "cr\xe8me", "se\xf1or", "f\xf6hn", "gar\xe7on"]
+WORDS = ["home", "product", "news", "about", "contact", "info", "index", "prijs", "nieuws",
+         "over", "dienst", "klant", "foto", "logo", "kaart", "menu"]
+
+SHARED_ICONS = 20
+
+# Links on the home page to pages that don't exist, with characters that are
+# not Latin-1 (as character references, like in the original pages)
+MISSING_PAGES = ["/prijs-&#8364;.html", "/&#8220;nieuws&#8221;.html"]
+
+# Layouts: config location, www directory in the tree, and www directory on
+# the original server
+LAYOUTS = {"dds": ("home/local/etc/httpd.conf", "home/local/www", "/home/local/www"),
+           "dlt": ("apache.intel/conf/configdb", "www", "/export/home/local/www")}
+
+
+def gifBytes(rng, size):
+    """Return GIF-like file of size bytes"""
+    return b"GIF89a" + rng.randbytes(max(0, size - 7)) + b";"
+
+
+def htmlBytes(rng, title, links, images, mapUrl, size):
+    """Return HTML page that links to links, shows images and an imagemap,
+    and is padded with text to about size bytes"""
+    lines = ["<HTML><HEAD><TITLE>" + title + "</TITLE></HEAD>",
+             '<BODY BGCOLOR="#FFFFFF">',
+             "<H1>" + title + "</H1>"]
+    if mapUrl is not None:
+        lines.append('<A HREF="' + mapUrl + '"><IMG SRC="' + images[0] + '" ISMAP></A>'
+                     if images else '<A HREF="' + mapUrl + '">map</A>')
+    for image in images:
+        lines.append('<IMG SRC="' + image + '" ALT="">')
+    for link in links:
+        lines.append('<A HREF="' + link + '">' + link + "</A><BR>")
+    text = "\n".join(lines)
+    while len(text) < size:
+        text += "\n<P>" + " ".join(rng.choice(WORDS) for _ in range(12)) + "</P>"
+    return (text + "\n</BODY></HTML>\n").encode("latin-1")
+
+
+def mapBytes(rng, targets):
+    """Return CERN htimage map file with targets"""
+    lines = ["default " + targets[0]]
+    for target in targets[1:]:
+        x, y = rng.randrange(400), rng.randrange(300)
+        lines.append("rect ({},{}) ({},{}) {}".format(x, y, x + 40, y + 20, target))
+    return ("\n".join(lines) + "\n").encode("latin-1")
+
+
+class SiteGenerator:
+    """Generates the directory tree of one site"""
+
+    def __init__(self, rng, rootDir, wwwOriginal, siteDir, mapUrl):
+        self.rng = rng
+        self.rootDir = rootDir
+        self.wwwOriginal = wwwOriginal
+        self.siteDir = siteDir
+        self.mapUrl = mapUrl
+        self.stats = {"files": 0, "bytes": 0, "dirs": 0, "links": 0, "brokenLinks": 0}
+
+    def fileName(self, index, extension):
+        """Return name (bytes) of file number index"""
+        if self.rng.random() < LATIN1_NAMES:
+            word = self.rng.choice(LATIN1_WORDS)
+        else:
+            word = self.rng.choice(WORDS)
+        return "{}{}{}".format(word, index, extension).encode("latin-1")
+
+    def write(self, path, data, mode=0o644):
+        """Write file"""
+        with open(path, "wb") as fOut:
+            fOut.write(data)
+        os.chmod(path, mode)
+        self.stats["files"] += 1
+        self.stats["bytes"] += len(data)
+
+    def link(self, target, path, broken=False):
+        """Create symbolic link"""
+        os.symlink(target, path)
+        self.stats["links"] += 1
+        if broken:
+            self.stats["brokenLinks"] += 1
+
+    def generate(self, files):
+        """Create site with about files files"""
+        os.makedirs(self.rootDir)
+        self.stats["dirs"] += 1
+        rng = self.rng
+
+        # Plan directory tree: list of (relative dir, number of files)
+        dirs = [b""]
+        plan = []
+        remaining = files
+        while remaining > 0:
+            parent = rng.choice(dirs)
+            count = min(remaining, rng.randint(FILES_PER_DIR // 2, FILES_PER_DIR))
+            if parent.count(b"/") < MAX_DEPTH and len(plan) > 0:
+                relDir = os.path.join(parent, rng.choice(WORDS).encode("latin-1") +
+                                      str(len(plan)).encode("latin-1"))
+                dirs.append(relDir)
+            else:
+                relDir = parent
+            plan.append((relDir, count))
+            remaining -= count
+
+        for relDir in dirs[1:]:
+            os.makedirs(os.path.join(self.rootDir, relDir), exist_ok=True)
+            self.stats["dirs"] += 1
+
+        # Names of all files, so pages can link to each other
+        index = 0
+        entries = []
+        for relDir, count in plan:
+            for _ in range(count):
+                extension = rng.choices([t for t, _ in FILE_TYPES],
+                                        [w for _, w in FILE_TYPES])[0]
+                entries.append((relDir, self.fileName(index, extension), extension))
+                index += 1
+        urls = [("/" + os.path.join(d, n).decode("latin-1")) for d, n, _ in entries]
+        images = [u for u in urls if u.endswith(".gif")] or ["/logo.gif"]
+        pages = [u for u in urls if u.endswith(".html")] or ["/home.html"]
+
+        mapUrl = self.mapUrl + "/nav.map"
+        self.write(os.path.join(self.rootDir, b"home.html"),
+                   htmlBytes(rng, "Home",
+                             rng.sample(pages, min(20, len(pages))) + MISSING_PAGES,
+                             rng.sample(images, min(3, len(images))), mapUrl, 2048))
+        self.write(os.path.join(self.rootDir, b"nav.map"),
+                   mapBytes(rng, rng.sample(pages, min(6, len(pages)))))
+
+        for relDir, name, extension in entries:
+            path = os.path.join(self.rootDir, relDir, name)
+            roll = rng.random()
+            if roll < BROKEN_LINKS:
+                target = "{}/{}/old/{}".format(self.wwwOriginal, self.siteDir,
+                                               name.decode("latin-1"))
+                self.link(target, path, broken=True)
+                continue
+            roll -= BROKEN_LINKS
+            if roll < SHARED_LINKS:
+                target = "{}/shared/icons/icon{}.gif".format(self.wwwOriginal,
+                                                             rng.randrange(SHARED_ICONS))
+                self.link(target, path)
+                continue
+            roll -= SHARED_LINKS
+            if roll < RELATIVE_LINKS:
+                depth = relDir.count(b"/") + 1 if relDir else 0
+                self.link("../" * depth + "home.html", path)
+                continue
+            size = int(rng.lognormvariate(7.5, 0.8))
+            if extension == ".html":
+                data = htmlBytes(rng, name.decode("latin-1"),
+                                 rng.sample(pages, min(8, len(pages))),
+                                 rng.sample(images, min(2, len(images))),
+                                 mapUrl if rng.random() < 0.1 else None, size)
+            elif extension == ".map":
+                data = mapBytes(rng, rng.sample(pages, min(5, len(pages))))
+            elif extension == ".txt":
+                data = " ".join(rng.choice(WORDS) for _ in range(size // 6)).encode("latin-1")
+            else:
+                data = gifBytes(rng, size)
+            self.write(path, data)
+
+        # Scripts
+        cgiDir = os.path.join(self.rootDir, b"cgi-bin")
+        os.makedirs(cgiDir, exist_ok=True)
+        self.stats["dirs"] += 1
+        for name in [b"form.cgi", b"count.pl"]:
+            self.write(os.path.join(cgiDir, name), b"#!/bin/sh\necho Content-type: text/html\n",
+                       0o755)
+        return self.stats
+
+
+def cernConfig(sites, wwwOriginal):
+    """Return CERN httpd.conf for sites (list of (host, siteDir, ip))"""
+    lines = ["ServerRoot /home/local", "Port 80", "UserDir disabled",
+             "Exec /htbin/* " + wwwOriginal + "/cgi-bin/*"]
+    for n, (host, siteDir, ip) in enumerate(sites):
+        lines.append("MultiHost " + host + " " + ip)
+        if n % 5 == 0:
+            lines.append("Map /* /noproxy.htm")
+        lines.append("Map /* /htbin/htimage{}/{}/root/*.map".format(wwwOriginal, siteDir))
+        lines.append("Exec /cgi-bin/* {}/{}/root/cgi-bin/*".format(wwwOriginal, siteDir))
+        lines.append("Exec /htbin/* " + wwwOriginal + "//cgi-bin/*")
+        lines.append("Welcome home.html")
+        if n == 0:
+            lines += ["MultiHost test.xxlink.nl 10.9.9.9",
+                      "Map /* /htbin/htimage{}/test/root/*.map".format(wwwOriginal),
+                      "Welcome index.html"]
+    return "\n".join(lines) + "\n"
+
+
+def apacheSiteConfig(host, siteDir, ip, wwwOriginal):
+    """Return configdb VirtualHost file for site"""
+    serverName = host[len("www."):]
+    return "\n".join(["<VirtualHost " + ip + ">",
+                      "ServerName " + host,
+                      "ServerAlias " + serverName,
+                      "DocumentRoot {}/{}".format(wwwOriginal, siteDir),
+                      "ScriptAlias /cgi-bin/ {}/{}/cgi-bin/".format(wwwOriginal, siteDir),
+                      "DirectoryIndex home.html",
+                      "Include /export/apache.intel/conf/common.conf",
+                      "</VirtualHost>"]) + "\n"
+
+
+def generateTape(treeDir, layout="dds", sites=20, files=500, seed=1):
+    """Generate tape tree of layout (dds or dlt) in treeDir with sites
+    sites of about files files each, and return dictionary with its
+    parameters and totals (also written to PARAMS_FILE in treeDir)"""
+    configPath, wwwDir, wwwOriginal = LAYOUTS[layout]
+    rng = random.Random("{}-{}".format(layout, seed))
+    treeDir = os.path.abspath(treeDir)
+    wwwIn = os.path.join(treeDir, wwwDir)
+    totals = {"layout": layout, "sites": sites, "filesPerSite": files, "seed": seed,
+              "files": 0, "bytes": 0, "dirs": 0, "links": 0, "brokenLinks": 0}
+
+    # Shared icons that sites link to with absolute links
+    iconDir = os.path.join(wwwIn, "shared", "icons")
+    os.makedirs(iconDir)
+    for i in range(SHARED_ICONS):
+        data = gifBytes(rng, rng.randint(100, 1000))
+        with open(os.path.join(iconDir, "icon{}.gif".format(i)), "wb") as fOut:
+            fOut.write(data)
+        totals["files"] += 1
+        totals["bytes"] += len(data)
+
+    siteList = []
+    for n in range(sites):
+        host = "www.site{:03d}.nl".format(n)
+        siteDir = "site{:03d}".format(n)
+        ip = "10.0.{}.{}".format(n // 250, n % 250 + 1)
+        siteList.append((host, siteDir, ip))
+        if layout == "dds":
+            rootDir = os.path.join(wwwIn, siteDir, "root")
+            mapUrl = "/htbin/htimage{}/{}/root".format(wwwOriginal, siteDir)
+        else:
+            rootDir = os.path.join(wwwIn, siteDir)
+            mapUrl = ""
+        generator = SiteGenerator(rng, os.fsencode(rootDir), wwwOriginal, siteDir, mapUrl)
+        for key, value in generator.generate(files).items():
+            totals[key] += value
+
+    configFile = os.path.join(treeDir, configPath)
+    if layout == "dds":
+        os.makedirs(os.path.dirname(configFile))
+        with open(configFile, "w", encoding="latin-1") as fOut:
+            fOut.write(cernConfig(siteList, wwwOriginal))
+    else:
+        os.makedirs(configFile)
+        for host, siteDir, ip in siteList:
+            with open(os.path.join(configFile, host), "w", encoding="latin-1") as fOut:
+                fOut.write(apacheSiteConfig(host, siteDir, ip, wwwOriginal))
+        with open(os.path.join(os.path.dirname(configFile), "common.conf"), "w",
+                  encoding="latin-1") as fOut:
+            fOut.write("Options Indexes FollowSymLinks\nAddType text/html .shtml\n")
+
+    with open(os.path.join(treeDir, PARAMS_FILE), "w", encoding="utf-8") as fOut:
+        json.dump(totals, fOut, indent=1)
+    return totals
+
+
+def loadTape(treeDir):
+    """Return parameters and totals of generated tape tree, or None if there
+    is none"""
+    try:
+        with open(os.path.join(treeDir, PARAMS_FILE), encoding="utf-8") as fIn:
+            return json.load(fIn)
+    except (OSError, ValueError):
+        return None
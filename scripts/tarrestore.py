@@ -0,0 +1,417 @@
+"""
+Restore of xxLINK sites straight from TAR tape images
+
+Some tapes (e.g. DDS tapes 8 and 17) are plain TAR archives. Instead of
+extracting the whole image to disk and then copying the site directories
+out of it, the image is read once as a stream, and only members below the
+document roots of the sites in the embedded httpd.conf are written, directly
+to their final location and with their final permissions.
+
+Since the config file may come after (some of) the site data in the
+archive, members below the www directory are extracted provisionally until
+the config is found; whatever turns out not to belong to a site is removed
+afterwards.
+
+Absolute links to data outside the document roots (e.g. shared image
+directories) are followed: the link target is extracted to the output tree
+(with the home directory stripped from its path, like the directory restore
+does) and the link is pointed at it. Targets that come later in the archive
+are extracted in the same pass; targets that came earlier are extracted in
+a further pass over the image, if it is a regular file (and not a pipe or
+tape device).
+
+Member names are decoded with an explicit legacy encoding (latin-1 by
+default), and written to disk as the original bytes, so URLs of the restored
+files match those of the original server.
+
+"""
+
+import os
+import sys
+import csv
+import io
+import tarfile
+import posixpath
+from copyengine import CHUNK_SIZE, makeDir
+
+# Location of the config file, relative to the root of the original file
+# system (which is either the archive root, or its home directory)
+CONFIG_SUFFIX = "local/etc/httpd.conf"
+
+# www directories that are extracted provisionally, before the config is
+# found
+WWW_DIRS = ["home/local/www", "local/www"]
+
+REPORT_FIELDS = ["link", "target", "resolved", "status", "copiedBytes"]
+
+
+def memberName(name):
+    """Return normalized member name (without leading ./ or /, and with .
+    and .. components resolved as far as possible)"""
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.strip("/")
+    if not name:
+        return name
+    return posixpath.normpath(name)
+
+
+def isSafe(name):
+    """Return True if normalized member name stays inside the archive
+    root (i.e. it doesn't start with a .. component)"""
+    return name != ".." and not name.startswith("../")
+
+
+def isBelow(name, directory):
+    """Return True if name is directory, or inside it"""
+    return name == directory or name.startswith(directory + "/")
+
+
+class TarRestore:
+    """Restores sites from a TAR tape image"""
+
+    def __init__(self, imageFile, dirOut, encoding="latin-1", store=None):
+        self.imageFile = imageFile
+        self.dirOut = os.path.abspath(dirOut)
+        self.wwwOut = os.path.join(self.dirOut, "www")
+        self.encoding = encoding
+        self.store = store
+        self.realDirOut = os.path.realpath(os.fsencode(self.dirOut))
+        self.sites = None
+        # Archive path of the original file system root, once known
+        self.prefix = None
+        # Output paths of link targets outside the document roots, by
+        # member name
+        self.wanted = {}
+        # (pathIn, pathOut) of site document roots, with member names as
+        # input paths
+        self.roots = []
+        self.execDirs = []
+        # Output paths of members (files and links) that were extracted
+        # before the config was found
+        self.provisional = []
+        # Output paths of all extracted members (used for links)
+        self.extracted = {}
+        self.dirTimes = {}
+        self.report = []
+        self.stats = {"files": 0, "bytes": 0, "skipped": 0, "links": 0, "dirs": 0,
+                      "errors": 0, "removed": 0}
+
+    def encodeName(self, name):
+        """Return name encoded with the legacy encoding (so it gets its
+        original bytes back)"""
+        try:
+            return name.encode(self.encoding, "surrogateescape")
+        except UnicodeEncodeError:
+            # Names from PAX headers are Unicode
+            return name.encode("utf-8", "surrogateescape")
+
+    def diskPath(self, path):
+        """Return output path as bytes; the part below dirOut keeps the
+        original bytes of the member name"""
+        relPath = os.path.relpath(path, self.dirOut)
+        return os.path.join(os.fsencode(self.dirOut), self.encodeName(relPath))
+
+    def readConfig(self, member, tar, parseConfig):
+        """Parse embedded httpd.conf with parseConfig (which returns a list
+        of siteconfig.Site objects), and set up site document roots"""
+        name = memberName(member.name)
+        prefix = name[:-len(CONFIG_SUFFIX)]
+        self.prefix = prefix
+        wwwIn = prefix + "local/www"
+        text = tar.extractfile(member).read().decode(self.encoding)
+        self.sites = parseConfig(io.StringIO(text), wwwIn, self.wwwOut)
+
+        for site in self.sites:
+            self.roots.append((site.pathIn, site.pathOut))
+            self.execDirs.extend(execPathIn for execPathIn, _ in site.execPaths)
+
+        print("Found config " + name + " with " + str(len(self.roots)) + " sites",
+              file=sys.stderr)
+
+    def outPath(self, name):
+        """Return output path for member name, or None if it is not
+        restored"""
+        if self.sites is None:
+            for wwwDir in WWW_DIRS:
+                if isBelow(name, wwwDir):
+                    return self.wwwOut + name[len(wwwDir):]
+            return self.wantedPath(name)
+
+        for pathIn, pathOut in self.roots:
+            if isBelow(name, pathIn):
+                return pathOut + name[len(pathIn):]
+        return self.wantedPath(name)
+
+    def wantedPath(self, name):
+        """Return output path for member name if it is (inside) a link
+        target, or None"""
+        parts = name.split("/")
+        for i in range(len(parts), 0, -1):
+            target = "/".join(parts[:i])
+            if target in self.wanted:
+                return self.wanted[target] + name[len(target):]
+        return None
+
+    def targetNames(self, linkName):
+        """Return possible member names of absolute link target"""
+        name = memberName(linkName)
+        if name.startswith("home/") and self.prefix != "home/":
+            # Archive root may be the original home directory
+            if self.prefix is None:
+                return [name, name[len("home/"):]]
+            return [name[len("home/"):]]
+        return [name]
+
+    def addWanted(self, linkName):
+        """Extract target of absolute link if it comes later in the
+        archive"""
+        name = memberName(linkName)
+        if name.startswith("home/"):
+            name = name[len("home/"):]
+        if not name or not isSafe(name):
+            return
+        for target in self.targetNames(linkName):
+            self.wanted.setdefault(target, os.path.join(self.dirOut, name))
+
+    def fileMode(self, name):
+        """Return permission bits of restored file"""
+        if any(isBelow(name, execDir) for execDir in self.execDirs):
+            return 0o755
+        return 0o644
+
+    def makeDirs(self, path):
+        """Create directory path and its parents with mode 755"""
+        diskPath = self.diskPath(path)
+        if os.path.isdir(diskPath):
+            return
+        if path != self.dirOut:
+            self.makeDirs(os.path.dirname(path))
+        makeDir(diskPath, 0o755)
+        self.stats["dirs"] += 1
+
+    def extractFile(self, member, tar, name, path):
+        """Write regular file member to path"""
+        diskPath = self.diskPath(path)
+        try:
+            destStat = os.lstat(diskPath)
+            if destStat.st_size == member.size and int(destStat.st_mtime) == int(member.mtime):
+                # Restored before
+                self.stats["skipped"] += 1
+                return
+            os.remove(diskPath)
+        except FileNotFoundError:
+            pass
+
+        fileIn = tar.extractfile(member)
+        fdOut = os.open(diskPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            for chunk in iter(lambda: fileIn.read(CHUNK_SIZE), b""):
+                while chunk:
+                    chunk = chunk[os.write(fdOut, chunk):]
+            os.fchmod(fdOut, self.fileMode(name))
+            os.utime(fdOut, (member.mtime, member.mtime))
+        finally:
+            os.close(fdOut)
+
+        self.stats["files"] += 1
+        self.stats["bytes"] += member.size
+        if self.store is not None:
+            self.store.add(diskPath)
+
+    def linkTarget(self, linkName):
+        """Return (target, status) for symbolic link to linkName. Absolute
+        links into a restored document root are pointed at its output
+        location"""
+        if not linkName.startswith("/"):
+            return linkName, "ok"
+        for name in self.targetNames(linkName):
+            if self.sites is not None:
+                for pathIn, pathOut in self.roots:
+                    if isBelow(name, pathIn):
+                        return pathOut + name[len(pathIn):], "site"
+            if name in self.extracted:
+                return self.extracted[name], "extracted"
+        return linkName, "unresolved"
+
+    def makeLink(self, linkName, path):
+        """Create symbolic link to linkName at path, and return report row"""
+        target, status = self.linkTarget(linkName)
+        if status == "unresolved":
+            self.addWanted(linkName)
+        diskPath = self.diskPath(path)
+        if os.path.lexists(diskPath):
+            os.remove(diskPath)
+        if status in ["site", "extracted"]:
+            os.symlink(self.diskPath(target), diskPath)
+            return [path, linkName, target, status, 0]
+        os.symlink(self.encodeName(target), diskPath)
+        return [path, linkName, "", status, 0]
+
+    def extractLink(self, member, name, path):
+        """Create symbolic link member at path"""
+        self.report.append(self.makeLink(member.linkname, path))
+        self.stats["links"] += 1
+
+    def extractHardLink(self, member, name, path):
+        """Create hard link member at path, if its target was restored"""
+        targetPath = self.extracted.get(memberName(member.linkname))
+        if targetPath is None:
+            print("WARNING: target of hard link " + name + " was not restored",
+                  file=sys.stderr)
+            self.stats["errors"] += 1
+            return
+        diskPath = self.diskPath(path)
+        if os.path.lexists(diskPath):
+            os.remove(diskPath)
+        os.link(self.diskPath(targetPath), diskPath)
+        self.stats["files"] += 1
+
+    def isInside(self, name, path):
+        """Return True if member name is safe, and path stays inside dirOut,
+        also after resolving any symbolic links in its parent directories
+        (like tar -x, members are never written outside the output tree)"""
+        if not isSafe(name) or not isBelow(os.path.normpath(path), self.dirOut):
+            return False
+        parent = os.path.realpath(os.path.dirname(self.diskPath(path)))
+        return parent == self.realDirOut or parent.startswith(self.realDirOut + b"/")
+
+    def extractMember(self, member, tar, name, path):
+        """Restore one archive member to path"""
+        if not self.isInside(name, path):
+            print("WARNING: skipping " + name + " (outside output directory)",
+                  file=sys.stderr)
+            self.stats["errors"] += 1
+            return
+        if member.isdir():
+            self.makeDirs(path)
+            self.dirTimes[path] = member.mtime
+            self.extracted[name] = path
+            return
+
+        self.makeDirs(os.path.dirname(path))
+        if member.isfile():
+            self.extractFile(member, tar, name, path)
+        elif member.issym():
+            self.extractLink(member, name, path)
+        elif member.islnk():
+            self.extractHardLink(member, name, path)
+        else:
+            # Devices and fifos
+            return
+
+        self.extracted[name] = path
+        if self.sites is None:
+            self.provisional.append(path)
+
+    def removeProvisional(self):
+        """Remove provisionally extracted members that are not part of a
+        restored site"""
+        roots = [pathOut for _, pathOut in self.roots] + list(self.wanted.values())
+        for path in self.provisional:
+            if not any(isBelow(path, root) for root in roots):
+                try:
+                    os.remove(self.diskPath(path))
+                    self.stats["removed"] += 1
+                except OSError:
+                    pass
+        self.report = [row for row in self.report
+                       if any(isBelow(row[0], root) for root in roots)]
+        self.provisional = []
+
+        # Remove directories that are now empty (deepest first)
+        for path in sorted(self.dirTimes, key=len, reverse=True):
+            if not any(isBelow(path, root) or isBelow(root, path) for root in roots):
+                try:
+                    os.rmdir(self.diskPath(path))
+                except OSError:
+                    pass
+                del self.dirTimes[path]
+
+    def extractWanted(self):
+        """Extract link targets that came before their links in the archive,
+        with further passes over the image. Targets may contain links
+        themselves, so passes are repeated until no new targets turn up"""
+        tried = set()
+        while os.path.isfile(self.imageFile):
+            missing = [target for target in self.wanted
+                       if target not in self.extracted and target not in tried]
+            if not missing:
+                break
+            tried.update(missing)
+            with tarfile.open(self.imageFile, mode="r|", encoding=self.encoding,
+                              errors="surrogateescape") as tar:
+                for member in tar:
+                    name = memberName(member.name)
+                    if name in self.extracted:
+                        continue
+                    path = self.wantedPath(name)
+                    if path is None:
+                        continue
+                    try:
+                        self.extractMember(member, tar, name, path)
+                    except OSError as e:
+                        print("ERROR extracting " + name + ": " + str(e), file=sys.stderr)
+                        self.stats["errors"] += 1
+
+    def updateLinks(self):
+        """Update absolute links that were unresolved when they were
+        extracted (because they came before the config, or before their
+        target)"""
+        for i, row in enumerate(self.report):
+            if row[3] == "unresolved":
+                try:
+                    self.report[i] = self.makeLink(row[1], row[0])
+                except OSError as e:
+                    print("ERROR updating symlink " + row[0] + ": " + str(e), file=sys.stderr)
+
+    def restore(self, parseConfig):
+        """Read tape image, restore sites, and return list of sites (as
+        returned by parseConfig), or None if the image
+        doesn't contain a config file"""
+        with tarfile.open(self.imageFile, mode="r|", encoding=self.encoding,
+                          errors="surrogateescape") as tar:
+            for member in tar:
+                name = memberName(member.name)
+                if not isSafe(name):
+                    print("WARNING: skipping " + member.name + " (outside archive root)",
+                          file=sys.stderr)
+                    self.stats["errors"] += 1
+                    continue
+                if self.sites is None and name.endswith(CONFIG_SUFFIX) and member.isfile():
+                    self.readConfig(member, tar, parseConfig)
+                    continue
+
+                path = self.outPath(name)
+                if path is None:
+                    continue
+                try:
+                    self.extractMember(member, tar, name, path)
+                except OSError as e:
+                    print("ERROR extracting " + name + ": " + str(e), file=sys.stderr)
+                    self.stats["errors"] += 1
+
+        if self.sites is None:
+            print("WARNING: no " + CONFIG_SUFFIX + " found in " + self.imageFile,
+                  file=sys.stderr)
+        self.removeProvisional()
+        self.updateLinks()
+        self.extractWanted()
+        self.updateLinks()
+
+        # Directory times, set after all members are written
+        for path, mtime in self.dirTimes.items():
+            try:
+                os.utime(self.diskPath(path), (mtime, mtime))
+            except OSError:
+                pass
+
+        return self.sites
+
+    def writeReport(self, reportFile):
+        """Write link report as CSV"""
+        with open(reportFile, "w", encoding="utf-8", errors="surrogateescape",
+                  newline="") as fOut:
+            writer = csv.writer(fOut)
+            writer.writerow(REPORT_FIELDS)
+            writer.writerows(self.report)